@@ -0,0 +1,110 @@
+"""Benchmark suite for the Omnilib HTTP Servers and Probe Resource handlers.
+
+Runs the bundled load generator against servers on localhost over a matrix of
+serving modes, concurrency levels, keep-alive settings, payload sizes and probe
+counts. Servers keep connections open, so the keep-alive setting of the load
+generator decides whether connections are reused. Prints one JSON object per
+scenario so runs of different commits can be compared, eg:
+
+    $ python benchmarks/http_benchmark.py --duration 2 > before.jsonl
+"""
+import argparse
+import http
+import json
+import sys
+
+from omnilib import http as h
+from omnilib import util
+from omnilib.http import encoding
+from omnilib.http.loadtest import format_result, run_load_test
+
+SERVING_MODES = {
+    'single-thread': h.MultiHandlerSingleThreadHTTPServer,
+    'threading': h.MultiHandlerThreadingHTTPServer,
+}
+
+
+def payload_handler(size):
+    payload = b'x' * size
+
+    class PayloadHandler(h.StatelessHTTPHandler):
+        def handle(self):
+            self.read_body()
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', len(payload))
+            self._request_handler.end_headers()
+            self._request_handler.wfile.write(payload)
+
+    return PayloadHandler
+
+
+def probe_resource(num_probes):
+    prober = h.ProbeResource('/bench/' + str(num_probes))
+    for i in range(num_probes):
+        prober.add_probe('probe_' + str(i), util.MutableVariable(i),
+                         desc='Benchmark probe ' + str(i))
+    return prober
+
+
+def scenarios(args):
+    for size in args.payload_sizes:
+        yield ('payload', size, h.HTTPMethod.GET, '/payload/' + str(size), None)
+    for num_probes in args.probe_counts:
+        path = '/probes/bench/' + str(num_probes)
+        yield ('probe-get', num_probes, h.HTTPMethod.GET, path, None)
+        patch = encoding.encode({'probe_0': util.MutableVariable(-1)})
+        yield ('probe-patch', num_probes, h.HTTPMethod.PATCH, path,
+               bytes(patch, 'utf-8'))
+
+
+def run(args):
+    for mode in args.modes:
+        with SERVING_MODES[mode]('127.0.0.1', 0, request_queue_size=128,
+                                 log_requests=False, keep_alive=True) as server:
+            host, port = server.server_address
+            for size in args.payload_sizes:
+                server.register_handler(h.HTTPMethod.GET, '/payload/' + str(size),
+                                        payload_handler(size))
+            for num_probes in args.probe_counts:
+                h.export_probe_resource_to_server(server,
+                                                  probe_resource(num_probes))
+            server.start_serving_async()
+
+            for name, size, method, path, body in scenarios(args):
+                for concurrency in args.concurrency:
+                    for keep_alive in args.keep_alive:
+                        result = run_load_test(
+                            host, port, method=method, path=path, body=body,
+                            concurrency=concurrency, duration=args.duration,
+                            keep_alive=keep_alive, warmup_requests=args.warmup)
+                        record = result.to_dict()
+                        record['scenario'] = {
+                            'name': name, 'size': size, 'mode': mode,
+                            'concurrency': concurrency, 'keep_alive': keep_alive}
+                        print(json.dumps(record, sort_keys=True), flush=True)
+                        print('{} {}={} mode={} c={} keep_alive={}: {}'.format(
+                            name, 'probes' if name.startswith('probe') else 'bytes',
+                            size, mode, concurrency, keep_alive,
+                            format_result(result)), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', choices=sorted(SERVING_MODES),
+                        default=sorted(SERVING_MODES))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--keep-alive', nargs='+', type=lambda v: v == 'on',
+                        default=[True, False], metavar='{on,off}')
+    parser.add_argument('--payload-sizes', nargs='+', type=int,
+                        default=[0, 1024, 65536])
+    parser.add_argument('--probe-counts', nargs='+', type=int,
+                        default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help="Seconds per scenario")
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="Unmeasured requests per worker and scenario")
+    run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
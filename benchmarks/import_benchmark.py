@@ -0,0 +1,73 @@
+"""Cold-import time budget of the Omnilib packages.
+
+Imports every package in a fresh interpreter with `python -X importtime` and
+takes the best cumulative import time over several runs. Prints one JSON
+object per package and exits with status 1 if a package exceeds its budget,
+eg:
+
+    $ python benchmarks/import_benchmark.py --repeat 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# Cumulative cold-import budgets in milliseconds
+IMPORT_BUDGETS_MS = {
+    'omnilib': 50,
+    'omnilib.util': 50,
+    'omnilib.compute': 150,
+    'omnilib.http': 150,
+}
+
+# Modules that importing a package must not pull in, as they are only
+# imported on first use
+LAZY_MODULES = ('jsonpickle', 'numpy', 'mako')
+
+
+def measure_import(module):
+    """Returns a (milliseconds, lazy modules imported) tuple for importing the
+    module in a fresh interpreter. The milliseconds are None if the import
+    time of the module is missing from the -X importtime output.
+    """
+    code = ('import sys, {module}; print(",".join(name for name in {lazy!r} '
+            'if name in sys.modules))').format(module=module, lazy=LAZY_MODULES)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    cumulative_us = None
+    for line in process.stderr.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            cumulative_us = int(parts[1])
+    imported = [name for name in process.stdout.strip().split(',') if name]
+    milliseconds = None if cumulative_us is None else cumulative_us / 1000
+    return milliseconds, imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Runs per package, the best one counts")
+    parser.add_argument('--packages', nargs='+', default=list(IMPORT_BUDGETS_MS))
+    args = parser.parse_args(argv)
+
+    failed = False
+    for package in args.packages:
+        runs = [measure_import(package) for _ in range(args.repeat)]
+        measured = [run[0] for run in runs if run[0] is not None]
+        milliseconds = min(measured) if measured else None
+        imported = runs[0][1]
+        budget = IMPORT_BUDGETS_MS.get(package)
+        # An import that could not be measured cannot be within its budget
+        within_budget = (budget is None or milliseconds is not None and
+                         milliseconds <= budget) and not imported
+        failed = failed or not within_budget
+        print(json.dumps({'package': package, 'import_ms': milliseconds,
+                          'budget_ms': budget, 'lazy_modules_imported': imported,
+                          'within_budget': within_budget}, sort_keys=True))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Query time budget of the /probes index.
+
+Indexes a number of Probe Resources in a ProbeResourceIndex and times
+prefix, label and paginated searches over it, taking the best of several
+runs. Prints one JSON object per query and exits with status 1 if a query
+exceeds its budget, eg:
+
+    $ python benchmarks/index_benchmark.py --resources 20000
+"""
+import argparse
+import json
+import sys
+import time
+
+from omnilib import http as h
+from omnilib import util
+
+# Per-query budgets in milliseconds. Searches bisect the sorted paths, so
+# they stay far below the time of a scan over all resources.
+QUERY_BUDGETS_MS = {
+    'page': 1,
+    'prefix': 1,
+    'label': 1,
+    'prefix-label-after': 1,
+}
+
+
+def build_index(num_resources):
+    index = h.ProbeResourceIndex()
+    for number in range(num_resources):
+        prober = h.ProbeResource('resources/{:06d}'.format(number))
+        prober.add_probe('even' if number % 2 == 0 else 'odd',
+                         util.MutableVariable(number))
+        index.add(prober)
+    return index
+
+
+def queries(num_resources):
+    middle = 'resources/{:06d}'.format(num_resources // 2)
+    yield 'page', {'limit': 10}
+    yield 'prefix', {'prefix': 'resources/0001', 'limit': 10}
+    yield 'label', {'label': 'odd', 'limit': 10}
+    yield 'prefix-label-after', {'prefix': 'resources/', 'label': 'odd',
+                                 'after': middle, 'limit': 10}
+
+
+def measure_query(index, arguments, iterations):
+    """Returns the mean milliseconds of a find call with the arguments."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        index.find(**arguments)
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resources', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=100,
+                        help="Queries per run")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Runs per query, the best one counts")
+    args = parser.parse_args(argv)
+
+    index = build_index(args.resources)
+    failed = False
+    for name, arguments in queries(args.resources):
+        milliseconds = min(measure_query(index, arguments, args.iterations)
+                           for _ in range(args.repeat))
+        budget = QUERY_BUDGETS_MS.get(name)
+        within_budget = budget is None or milliseconds <= budget
+        failed = failed or not within_budget
+        print(json.dumps({'query': name, 'resources': args.resources,
+                          'query_ms': milliseconds, 'budget_ms': budget,
+                          'within_budget': within_budget}, sort_keys=True))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
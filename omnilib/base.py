@@ -1,18 +1,51 @@
+import importlib
+import warnings
+
 _omnilib_initialized = False
 
 
-def init():
+def init(preload=False, probe_snapshot_dir=None, probe_snapshot_interval=1.0):
     """Initialize the Omnilib Library!
 
     Calls initialization methods on various Omnilib components. `Init` should
-    be called only once and with keyword arguments preferably.
+    be called only once and with keyword arguments preferably. Later calls do
+    nothing, and warn if they pass preload or probe_snapshot_dir.
 
     All arguments have safe defaults. Ordering of arguments subject to change
     without notice.
+
+    Args:
+        preload (bool): Import the heavy optional dependencies of
+            omnilib.http, jsonpickle, NumPy and Mako, and register the
+            jsonpickle handlers now rather than on first use. eg: in a parent
+            process before forking workers that serve probes.
+        probe_snapshot_dir (str): Persist the probe values of every Probe
+            Resource exported to a server in this directory, and restore them
+            on export. The directory should be owned by this process only.
+            One resource is persisted per path, see
+            omnilib.http.export_probe_resource_to_server and
+            omnilib.http.ProbeSnapshotStore.
+        probe_snapshot_interval (float): Seconds between writes of the probe
+            value changes to the snapshot directory
     """
     global _omnilib_initialized
     if _omnilib_initialized:
+        if preload or probe_snapshot_dir is not None:
+            warnings.warn("omnilib.init was already called, ignoring its "
+                          "preload and probe_snapshot_dir arguments",
+                          RuntimeWarning, stacklevel=2)
         return
     _omnilib_initialized = True
 
     # Initialization Code here
+    if preload:
+        # Imported for its side effect of loading Mako into sys.modules
+        importlib.import_module('mako.template')
+
+        from .http import encoding
+        encoding.register_handlers()
+
+    if probe_snapshot_dir is not None:
+        from .http import persistence
+        persistence.set_default_snapshot_store(persistence.ProbeSnapshotStore(
+            probe_snapshot_dir, interval=probe_snapshot_interval))
@@ -1,2 +1,5 @@
 # MapReduce module imports
-from .mapreduce import MRJob, MRJobInput
+from .mapreduce import CPU_AFFINITY_CORE, CPU_AFFINITY_NUMA, MRJob, MRJobInput
+
+# CPU discovery
+from .cpu import get_effective_cpu_count
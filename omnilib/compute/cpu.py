@@ -0,0 +1,122 @@
+import glob
+import os
+
+_cgroup_root = '/sys/fs/cgroup'
+
+
+def parse_cpu_list(text):
+    """Parses a Linux CPU list, eg: '0-3,8,10-11', into a sorted list of CPU
+    numbers.
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def _read_file(filename):
+    try:
+        with open(filename) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _get_cgroup_paths(proc_cgroup_filename):
+    """Returns a dictionary mapping the cgroup v1 controllers, and '' for
+    cgroup v2, to the cgroup path of this process.
+    """
+    paths = {}
+    for line in (_read_file(proc_cgroup_filename) or '').splitlines():
+        parts = line.split(':', 2)
+        if len(parts) != 3:
+            continue
+        for controller in parts[1].split(','):
+            paths[controller] = parts[2]
+    return paths
+
+
+def _get_ancestor_directories(root, path):
+    """Yields root/path and each of its parent directories up to root."""
+    directory = os.path.join(root, path.strip('/'))
+    while True:
+        yield directory
+        if os.path.normpath(directory) == os.path.normpath(root):
+            return
+        directory = os.path.dirname(directory)
+
+
+def get_cgroup_cpu_limit(root=_cgroup_root,
+                         proc_cgroup_filename='/proc/self/cgroup'):
+    """Returns the CPU quota of this process's cgroup in CPUs, eg: 2.5, or
+    None if there is no quota.
+
+    Reads cpu.max of cgroup v2, or cpu.cfs_quota_us and cpu.cfs_period_us of
+    cgroup v1. The smallest quota of the cgroup and its ancestors applies.
+    """
+    paths = _get_cgroup_paths(proc_cgroup_filename)
+    limits = []
+    for directory in _get_ancestor_directories(root, paths.get('', '/')):
+        cpu_max = _read_file(os.path.join(directory, 'cpu.max'))
+        if cpu_max:
+            quota, _, period = cpu_max.partition(' ')
+            if quota != 'max' and period:
+                limits.append(int(quota) / int(period))
+    if not limits:
+        for controller_root in (os.path.join(root, 'cpu'),
+                                os.path.join(root, 'cpu,cpuacct')):
+            if not os.path.isdir(controller_root):
+                continue
+            for directory in _get_ancestor_directories(
+                    controller_root, paths.get('cpu', '/')):
+                quota = _read_file(os.path.join(directory, 'cpu.cfs_quota_us'))
+                period = _read_file(os.path.join(directory, 'cpu.cfs_period_us'))
+                if quota and period and int(quota) > 0:
+                    limits.append(int(quota) / int(period))
+            break
+    return min(limits) if limits else None
+
+
+def get_available_cpus():
+    """Returns the sorted CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_effective_cpu_count():
+    """Returns the number of CPUs this process can keep busy: the number of
+    CPUs in its affinity mask, capped by the cgroup CPU quota rounded down,
+    and at least 1.
+    """
+    count = len(get_available_cpus())
+    limit = get_cgroup_cpu_limit()
+    if limit is not None:
+        count = min(count, int(limit))
+    return max(count, 1)
+
+
+def get_numa_cpu_sets(node_root='/sys/devices/system/node'):
+    """Returns the CPUs of each NUMA node that this process may run on, as
+    sorted lists in node order. Returns a single list of all available CPUs if the NUMA
+    topology is not known.
+    """
+    available = set(get_available_cpus())
+    nodes = []
+    for filename in glob.glob(os.path.join(node_root, 'node*', 'cpulist')):
+        node = os.path.basename(os.path.dirname(filename))[len('node'):]
+        if node.isdigit():
+            nodes.append((int(node), filename))
+    cpu_sets = []
+    for _, filename in sorted(nodes):
+        cpus = [cpu for cpu in parse_cpu_list(_read_file(filename) or '')
+                if cpu in available]
+        if cpus:
+            cpu_sets.append(cpus)
+    return cpu_sets or [sorted(available)]
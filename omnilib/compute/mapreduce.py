@@ -1,9 +1,17 @@
 import collections
 import inspect
 import multiprocessing
+import os
+import warnings
 
 import dill
 
+from .cpu import get_available_cpus, get_effective_cpu_count, get_numa_cpu_sets
+
+# Values of the cpu_affinity argument of MRJob
+CPU_AFFINITY_CORE = 'core'
+CPU_AFFINITY_NUMA = 'numa'
+
 _MapArgs = collections.namedtuple("_MapArgs", ["fn", "arg"])
 
 
@@ -67,18 +75,27 @@ class MRJob(object):
     result.
     """
 
-    def __init__(self, num_processes=None, map_fn=None, reduce_fn=None, pool=None):
+    def __init__(self, num_processes=None, map_fn=None, reduce_fn=None, pool=None,
+                 cpu_affinity=None):
         """Creates a MRJob object.
 
         Args:
             num_processes (int): Map-phase worker pool size.
-                If not specified or if `None` is passed, the result is
-                dependent on `multiprocessing.Pool`.
+                If not specified or if `None` is passed, the number of CPUs
+                the process can use, see `cpu.get_effective_cpu_count`. It
+                accounts for the CPU affinity mask and the cgroup CPU quota,
+                eg: of a container. A RuntimeWarning is issued if more
+                processes are requested.
             map_fn (function): The map-phase worker function.
                 The function is executed by a single thread in each worker.
             reduce_fn (function): The final reduce function in the MR Job.
             pool (multiprocessing.Pool): An external worker-pool for the Map-phase
                 An external pool cannot be sent along with `num_processes`
+            cpu_affinity (str): Pins each worker of the created pool to a
+                distinct CPU with `CPU_AFFINITY_CORE`, or to the CPUs of one
+                NUMA node with `CPU_AFFINITY_NUMA`, spreading the workers
+                across the nodes. Workers share CPUs once there are more
+                workers than CPUs or nodes. By default workers are not pinned.
         """
         if num_processes is not None and num_processes <= 0:
             raise ValueError("Number of processes must be a positive integer!")
@@ -89,21 +106,49 @@ class MRJob(object):
         elif pool is not None and num_processes is not None:
             raise ValueError(
                 "Multiprocessing Pool and Number of Processes cannot be passed at the same time!")
+        elif cpu_affinity not in (None, CPU_AFFINITY_CORE, CPU_AFFINITY_NUMA):
+            raise ValueError("CPU affinity must be None, 'core' or 'numa'!")
+        elif cpu_affinity is not None and pool is not None:
+            raise ValueError("CPU affinity cannot be set for an external Pool!")
+        elif cpu_affinity is not None and not hasattr(os, 'sched_setaffinity'):
+            raise ValueError("CPU affinity is not supported on this platform!")
 
-        self.num_processes = num_processes
         self.map_fn = map_fn
         self.reduce_fn = reduce_fn
+        self.cpu_affinity = cpu_affinity
 
         # Initialize Pool of Workers
         if pool is not None:
+            self.num_processes = num_processes
             self.external_pool = True
             self.pool = pool
-        else:
-            self.external_pool = False
+            return
+
+        effective_cpu_count = get_effective_cpu_count()
+        if num_processes is None:
+            num_processes = effective_cpu_count
+        elif num_processes > effective_cpu_count:
+            warnings.warn(
+                "MRJob with {} processes oversubscribes the {} CPUs available "
+                "to this process".format(num_processes, effective_cpu_count),
+                RuntimeWarning, stacklevel=2)
+        self.num_processes = num_processes
+        self.external_pool = False
+        if cpu_affinity is None:
             self.pool = multiprocessing.Pool(processes=self.num_processes)
+        else:
+            if cpu_affinity == CPU_AFFINITY_CORE:
+                cpu_sets = [[cpu] for cpu in get_available_cpus()]
+            else:
+                cpu_sets = get_numa_cpu_sets()
+            self.pool = multiprocessing.Pool(
+                processes=self.num_processes, initializer=_pin_worker,
+                initargs=(cpu_sets, multiprocessing.Value('i', 0)))
 
     def __del__(self):
-        if self.external_pool is not None:
+        # Only close pools created here. Construction may have failed before
+        # the pool was set up
+        if getattr(self, 'external_pool', True) is False:
             self.pool.close()
             self.pool.join()
 
@@ -127,6 +172,14 @@ class MRJob(object):
         return self.reduce_fn(map_results)
 
 
+def _pin_worker(cpu_sets, worker_counter):
+    # Each worker takes the next CPU set, in the order the workers start
+    with worker_counter.get_lock():
+        index = worker_counter.value
+        worker_counter.value += 1
+    os.sched_setaffinity(0, cpu_sets[index % len(cpu_sets)])
+
+
 def _run_mapper(args):
     # Extract Mapper Arguments
     arg = dill.loads(args.arg)
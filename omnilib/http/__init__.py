@@ -1,3 +1,16 @@
-from .probe import ProbeResource, export_probe_resource_to_server
-from .server import (HTTPMethod, MultiHandlerSingleThreadHTTPServer,
+from .aggregation import (ProbeAggregator, ProbePublisher,
+                          publish_probe_resource)
+from .cache import HTTPResponseCache
+from .history import ProbeHistory
+from .limits import TokenBucket
+from .metrics import HTTPServerMetrics
+from .persistence import ProbeSnapshotStore, set_default_snapshot_store
+from .profiling import (deregister_profiling_handlers,
+                        register_profiling_handlers)
+from .probe import (ProbeResource, ProbeResourceIndex,
+                    ProbeVersionConflictError, export_probe_resource_to_server,
+                    remove_probe_resource, update_probe_resources)
+from .server import (ChunkedResponseWriter, HTTPMethod,
+                     MultiHandlerSingleThreadHTTPServer,
+                     MultiHandlerThreadingHTTPServer, RequestBodyReader,
                      StatelessHTTPHandler)
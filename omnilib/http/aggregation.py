@@ -0,0 +1,368 @@
+import contextlib
+import functools
+import os
+import queue
+import threading
+import time
+
+from ..util import MutableVariable
+from .probe import ProbeResource, export_probe_resource_to_server
+
+# Address of the last ProbeAggregator created in this process. Forked child
+# processes inherit it, so they can publish without being told the address.
+_default_aggregator_address = None
+# (pid, address) -> ProbePublisher shared by publish_probe_resource calls
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+class _ProbeOwner(object):
+    """A connection to a process that published Probe Resources.
+
+    Messages to the owner are queued and sent by a background thread, so
+    writers never block on the connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.paths = set()
+        self._outbox = queue.Queue()
+        self._sender = threading.Thread(target=self._send_messages,
+                                        daemon=True, name="ProbeOwner-Sender")
+        self._sender.start()
+
+    def send(self, message):
+        self._outbox.put(message)
+
+    def _send_messages(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                return
+            try:
+                self.connection.send(message)
+            except (OSError, ValueError):
+                # The owner is gone, its reader thread cleans up
+                return
+
+    def close(self):
+        self._outbox.put(None)
+        self.connection.close()
+
+
+class _MirrorProbeResource(ProbeResource):
+    """Local copy of a Probe Resource published by other processes.
+
+    Values written to the mirror are sent to the owners with one message per
+    update_probe_values batch, or per set_value outside of batches, once the
+    resource lock is released. Changes pushed by the owners are applied with
+    apply_owner_update and are not sent back.
+    """
+
+    def __init__(self, path, desc, send_to_owners):
+        super().__init__(path, desc=desc)
+        self._send_to_owners = send_to_owners
+        self._local = threading.local()
+
+    def add_mirrored_probe(self, label, value, desc=''):
+        mutable_variable = MutableVariable(value)
+        mutable_variable.subscribe(
+            functools.partial(self._on_mirror_changed, label))
+        self.add_probe(label, mutable_variable, desc=desc)
+
+    def apply_owner_update(self, values):
+        self._local.applying = True
+        try:
+            self.update_probe_values(
+                {label: value for label, value in values.items()
+                 if label in self.probe_dict})
+        finally:
+            self._local.applying = False
+
+    def _on_mirror_changed(self, label, mutable_variable):
+        if getattr(self._local, 'applying', False):
+            return
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            self._send_to_owners(self.path,
+                                 {label: mutable_variable.get_value()})
+        else:
+            pending[label] = mutable_variable.get_value()
+
+    @contextlib.contextmanager
+    def _sending_batch(self):
+        # Collects the values set by the outermost batch of this thread and
+        # sends them together once it is applied
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        pending = self._local.pending = {}
+        try:
+            yield
+        finally:
+            self._local.pending = None
+        if pending:
+            self._send_to_owners(self.path, pending)
+
+    def update_probe_values(self, values, expected_version=None):
+        with self._sending_batch():
+            return super().update_probe_values(values, expected_version)
+
+    def update_probe_slice(self, label, index, value, expected_version=None):
+        with self._sending_batch():
+            return super().update_probe_slice(label, index, value,
+                                              expected_version)
+
+
+class ProbeAggregator(object):
+    """Exposes Probe Resources published by other processes on a server.
+
+    Listens on a local socket for ProbePublisher connections. Each published
+    resource is mirrored by a local ProbeResource that is exported to the
+    server, so reads are served from the mirror without a round-trip to the
+    owning process. Publishers push changes of their resources to the mirror.
+    Writes to the mirror, eg: from a PATCH on the server, are sent to every
+    process that published the resource at that path, and a batch written
+    with update_probe_values is applied by the owners as one batch too.
+
+    Mirrors stay exported with their last values after their owners exit.
+    """
+
+    def __init__(self, server, address=None, family=None, authkey=None):
+        """
+        Args:
+            server (MultiHandlerSingleThreadHTTPServer): Server to export the
+                mirrored resources to
+            address: Listener address, see multiprocessing.connection.Listener.
+                Defaults to a fresh local socket.
+            family (str): Listener family, eg: 'AF_UNIX'
+            authkey (bytes): Key publishers must present. Defaults to the
+                authkey of the current process, which child processes inherit.
+        """
+        global _default_aggregator_address
+        # Imported here to keep importing omnilib.http cheap
+        import multiprocessing.connection
+        if authkey is None:
+            authkey = multiprocessing.current_process().authkey
+        self.server = server
+        self._listener = multiprocessing.connection.Listener(
+            address, family=family, authkey=authkey)
+        self.address = self._listener.address
+        self.resources = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._accept_thread = threading.Thread(
+            target=self._accept_connections, daemon=True,
+            name="ProbeAggregator::Address:" + str(self.address))
+        self._accept_thread.start()
+        _default_aggregator_address = self.address
+
+    def _accept_connections(self):
+        import multiprocessing
+        retry_delay = 0.01
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except (EOFError, multiprocessing.AuthenticationError):
+                # A publisher that failed the handshake
+                continue
+            except OSError:
+                if self._closed:
+                    return
+                # eg: EMFILE, which persists until connections are closed
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 1.0)
+                continue
+            retry_delay = 0.01
+            owner = _ProbeOwner(connection)
+            threading.Thread(target=self._serve_owner, args=(owner,),
+                             daemon=True).start()
+
+    def _serve_owner(self, owner):
+        try:
+            while True:
+                message = owner.connection.recv()
+                if message[0] == 'publish':
+                    self._publish(owner, *message[1:])
+                elif message[0] == 'update':
+                    self._apply_update(*message[1:])
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                for path in owner.paths:
+                    self._owners[path].remove(owner)
+            owner.close()
+
+    def _publish(self, owner, path, desc, probes):
+        with self._lock:
+            resource = self.resources.get(path)
+            if resource is None:
+                resource = _MirrorProbeResource(path, desc,
+                                                self._send_to_owners)
+                self.resources[path] = resource
+                self._owners[path] = []
+            self._owners[path].append(owner)
+            owner.paths.add(path)
+        for label, probe_desc, value in probes:
+            if label not in resource.probe_dict:
+                resource.add_mirrored_probe(label, value, desc=probe_desc)
+            else:
+                resource.apply_owner_update({label: value})
+        export_probe_resource_to_server(self.server, resource)
+
+    def _apply_update(self, path, values):
+        resource = self.resources.get(path)
+        if resource is not None:
+            resource.apply_owner_update(values)
+
+    def _send_to_owners(self, path, values):
+        with self._lock:
+            owners = list(self._owners.get(path, ()))
+        for owner in owners:
+            owner.send(('set', path, values))
+
+    def get_owner_count(self, path):
+        """Returns the number of connected processes owning the resource at
+        the path.
+        """
+        with self._lock:
+            return len(self._owners.get(path.strip('/'), ()))
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+        with self._lock:
+            owners = {id(owner): owner for owners in self._owners.values()
+                      for owner in owners}
+        for owner in owners.values():
+            owner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+class ProbePublisher(object):
+    """Publishes Probe Resources of this process to a ProbeAggregator.
+
+    For every published resource, a background thread waits for changes and
+    sends the changed values, at most max_rate times per second. Setting a
+    probe therefore costs no more than for an unpublished resource. Values
+    set through the aggregator's server are applied to the local resource
+    with ProbeResource.update_probe_values.
+    Probe values must be picklable.
+    """
+
+    def __init__(self, address=None, authkey=None, max_rate=20):
+        """
+        Args:
+            address: Address of the ProbeAggregator. Defaults to the address
+                of the last aggregator created in this process or, with the
+                fork start method, in a parent process.
+            authkey (bytes): Defaults to the authkey of the current process
+            max_rate (float): Maximum updates sent per second per resource
+
+        Raises:
+            ValueError: If no address is passed or known
+        """
+        if address is None:
+            address = _default_aggregator_address
+        if address is None:
+            raise ValueError("No ProbeAggregator address passed or known!")
+        if max_rate <= 0:
+            raise ValueError("Maximum rate should be a positive number")
+        import multiprocessing.connection
+        if authkey is None:
+            authkey = multiprocessing.current_process().authkey
+        self.address = address
+        self.min_interval = 1 / max_rate
+        self.resources = {}
+        self._connection = multiprocessing.connection.Client(
+            address, authkey=authkey)
+        self._send_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._receive_thread = threading.Thread(
+            target=self._receive, daemon=True, name="ProbePublisher-Receiver")
+        self._receive_thread.start()
+
+    def _send(self, message):
+        with self._send_lock:
+            self._connection.send(message)
+
+    def _receive(self):
+        try:
+            while not self._closed.is_set():
+                message = self._connection.recv()
+                resource = self.resources.get(message[1])
+                if message[0] == 'set' and resource is not None:
+                    resource.update_probe_values(
+                        {label: value for label, value in message[2].items()
+                         if label in resource.probe_dict})
+        except (EOFError, OSError):
+            self._closed.set()
+
+    def publish(self, probe_resource):
+        """Publishes the Probe Resource and keeps the aggregator's copy up to
+        date until close is called. Probes added after publishing are not
+        published.
+        """
+        path = probe_resource.get_path()
+        with probe_resource.lock:
+            version, values = probe_resource.get_probe_snapshot()
+            probes = [(label, probe_resource.get_probe_desc(label), value)
+                      for label, value in values.items()]
+        self.resources[path] = probe_resource
+        self._send(('publish', path, probe_resource.get_desc(), probes))
+        threading.Thread(target=self._push_changes,
+                         args=(probe_resource, version), daemon=True,
+                         name="ProbePublisher::Path:" + path).start()
+
+    def _push_changes(self, probe_resource, since_version):
+        path = probe_resource.get_path()
+        while not self._closed.is_set():
+            version, labels = probe_resource.wait_for_changes(since_version, 0.5)
+            if not labels:
+                continue
+            _, values = probe_resource.get_probe_snapshot(
+                [label for label in labels if label in probe_resource.probe_dict])
+            try:
+                self._send(('update', path, values))
+            except (OSError, ValueError):
+                self._closed.set()
+                return
+            since_version = version
+            self._closed.wait(self.min_interval)
+
+    def close(self):
+        self._closed.set()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+def publish_probe_resource(probe_resource, address=None, authkey=None):
+    """Publishes a Probe Resource to a ProbeAggregator, typically running in
+    a parent process. Reuses one ProbePublisher connection per process and
+    address.
+
+    Returns:
+        ProbePublisher: The publisher the resource was published with
+    """
+    if address is None:
+        address = _default_aggregator_address
+    key = (os.getpid(), address)
+    with _publishers_lock:
+        publisher = _publishers.get(key)
+        if publisher is None or publisher._closed.is_set():
+            publisher = ProbePublisher(address, authkey=authkey)
+            _publishers[key] = publisher
+    publisher.publish(probe_resource)
+    return publisher
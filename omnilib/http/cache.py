@@ -0,0 +1,165 @@
+import collections
+import threading
+import time
+
+
+class RecordingStream(object):
+    """Wraps a writable binary stream and keeps a copy of everything written
+    to it, up to `limit` bytes. Recording stops for good once the limit is
+    exceeded; writes always go through to the wrapped stream.
+    """
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._limit = limit
+        self._size = 0
+        self.chunks = []
+        self.overflowed = False
+
+    def write(self, data):
+        if not self.overflowed:
+            self._size += len(data)
+            if self._size > self._limit:
+                self.overflowed = True
+                self.chunks = []
+            else:
+                self.chunks.append(bytes(data))
+        return self._stream.write(data)
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class CachePolicy(object):
+    """Caching rules of a route: how long responses stay fresh and which
+    request headers, besides the method and path, select the response.
+    """
+
+    def __init__(self, ttl, vary_headers=()):
+        if ttl <= 0:
+            raise ValueError("TTL should be a positive number")
+        self.ttl = ttl
+        self.vary_headers = tuple(header.lower() for header in vary_headers)
+
+    def get_key(self, method, path, headers):
+        return (method.name, path) + tuple(
+            headers.get(header) for header in self.vary_headers)
+
+
+class HTTPResponseCache(object):
+    """Thread-safe in-memory cache of complete raw HTTP responses.
+
+    Entries expire after the TTL of their CachePolicy. The total size of the
+    cached responses is bounded by max_bytes, evicting the least recently used
+    entries first. Entries are indexed by request path without the query
+    string so that all variants of a path can be invalidated at once.
+
+    Every invalidation increments generation. A response rendered while an
+    invalidation happened may be stale, so put skips it when passed the
+    generation read before rendering.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_entry_bytes=None):
+        """
+        Args:
+            max_bytes (int): Upper bound on the total size of cached responses
+            max_entry_bytes (int): Responses larger than this are not cached.
+                Defaults to max_bytes.
+        """
+        if max_bytes <= 0:
+            raise ValueError("Maximum bytes should be a positive integer")
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes or max_bytes, max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        # key -> (expiry time, path, response bytes), in LRU order
+        self._entries = collections.OrderedDict()
+        # path -> set of keys cached for that path
+        self._path_index = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached response bytes for the key, or None if there is
+        no fresh entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, path, response, ttl, generation=None):
+        """Caches response bytes for the key for ttl seconds. Returns False if
+        the response is too large to be cached, or if generation is passed
+        and the cache was invalidated since.
+        """
+        if len(response) > self.max_entry_bytes:
+            return False
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, path, response)
+            self._path_index.setdefault(path, set()).add(key)
+            self.size += len(response)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return True
+
+    def invalidate(self, path=None):
+        """Drops all cached responses for the path, ignoring query strings.
+        Drops everything if no path is passed.
+        """
+        with self._lock:
+            self.generation += 1
+            if path is None:
+                self._entries.clear()
+                self._path_index.clear()
+                self.size = 0
+                return
+            for key in list(self._path_index.get(path, ())):
+                self._remove(key)
+
+    def invalidate_prefix(self, prefix):
+        """Drops all cached responses for paths starting with the prefix."""
+        with self._lock:
+            self.generation += 1
+            for path in [p for p in self._path_index if p.startswith(prefix)]:
+                for key in list(self._path_index[path]):
+                    self._remove(key)
+
+    def invalidate_tree(self, path):
+        """Drops all cached responses for the path, for its ancestors, eg: /a
+        and / for /a/b, and for the paths below it, eg: /a/b/c. A write to a
+        path can change all of them.
+        """
+        base = path.rstrip('/') + '/'
+        with self._lock:
+            self.generation += 1
+            for cached_path in [p for p in self._path_index
+                                if p == path or p.startswith(base) or
+                                path.startswith(p.rstrip('/') + '/')]:
+                for key in list(self._path_index[cached_path]):
+                    self._remove(key)
+
+    def _remove(self, key):
+        _, path, response = self._entries.pop(key)
+        self.size -= len(response)
+        keys = self._path_index[path]
+        keys.discard(key)
+        if not keys:
+            del self._path_index[path]
@@ -0,0 +1,77 @@
+"""jsonpickle encoding of probe values.
+
+Importing this module imports jsonpickle, and registering the handlers
+imports NumPy, so omnilib.http only imports it once a probe is encoded or
+decoded. Use encode and decode, which register the handlers on first use, or
+call register_handlers up front, eg: through omnilib.init(preload=True).
+"""
+import threading
+
+import jsonpickle
+
+from ..util import MutableVariable, ProbeBlock
+
+_handlers_registered = False
+_handlers_lock = threading.Lock()
+
+
+class MutableVariableHandler(jsonpickle.handlers.BaseHandler):
+    """jsonpickle handler encoding a MutableVariable as its class and
+    contained value only, eg: {"py/object": "...", "_value": 1}. Subscribers
+    and other process-local state are left out.
+    """
+
+    def flatten(self, obj, data):
+        data['_value'] = self.context.flatten(obj.get_value(), reset=False)
+        return data
+
+    def restore(self, data):
+        cls = jsonpickle.unpickler.loadclass(data['py/object'])
+        obj = cls.__new__(cls)
+        obj.__setstate__(
+            {'_value': self.context.restore(data.get('_value'), reset=False)})
+        return obj
+
+
+class ProbeBlockHandler(jsonpickle.handlers.BaseHandler):
+    """jsonpickle handler encoding a ProbeBlock as its dtype, labels and
+    values, eg: {"py/object": "...", "dtype": "float64", "labels": ["a"],
+    "_value": [1.0]}.
+    """
+
+    def flatten(self, obj, data):
+        data['dtype'] = obj.dtype
+        data['labels'] = list(obj.labels)
+        data['_value'] = obj.tolist()
+        return data
+
+    def restore(self, data):
+        return ProbeBlock(data['dtype'], data['labels'], data['_value'])
+
+
+def register_handlers():
+    """Registers the NumPy and Omnilib jsonpickle handlers. Only the first
+    call has an effect.
+    """
+    global _handlers_registered
+    if _handlers_registered:
+        return
+    with _handlers_lock:
+        if _handlers_registered:
+            return
+        import jsonpickle.ext.numpy as jsonpickle_numpy
+        jsonpickle_numpy.register_handlers()
+        jsonpickle.handlers.register(MutableVariable, MutableVariableHandler,
+                                     base=True)
+        jsonpickle.handlers.register(ProbeBlock, ProbeBlockHandler)
+        _handlers_registered = True
+
+
+def encode(value, **kwargs):
+    register_handlers()
+    return jsonpickle.encode(value, **kwargs)
+
+
+def decode(text, **kwargs):
+    register_handlers()
+    return jsonpickle.decode(text, **kwargs)
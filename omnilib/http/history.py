@@ -0,0 +1,195 @@
+import array
+import math
+import numbers
+import threading
+import time
+
+# Resolution names served by ProbeHistory.get_range and their bucket widths
+# in seconds. Raw samples are not bucketed.
+HISTORY_RESOLUTIONS = {'raw': None, '1s': 1, '1m': 60}
+
+
+class _SampleRing(object):
+    """Fixed-capacity ring of (timestamp, value) samples in two arrays."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.values = array.array('d', bytes(8 * capacity))
+        self.count = 0
+        self.next = 0
+
+    def append(self, timestamp, value):
+        self.times[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def get_indices(self, start, end):
+        """Yields the indices of the samples in [start, end], oldest first."""
+        first = (self.next - self.count) % self.capacity
+        for offset in range(self.count):
+            index = (first + offset) % self.capacity
+            if start <= self.times[index] <= end:
+                yield index
+
+    def get_range(self, start, end):
+        indices = list(self.get_indices(start, end))
+        return {'t': [self.times[index] for index in indices],
+                'v': [self.values[index] for index in indices]}
+
+
+class _AggregateRing(object):
+    """Fixed-capacity ring of per-bucket count, min, max and sum of the
+    samples falling in consecutive buckets of width seconds.
+
+    The bucket being filled is kept in plain attributes and moved into the
+    ring once a sample of a later bucket arrives.
+    """
+
+    def __init__(self, width, capacity):
+        self.width = width
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.counts = array.array('q', bytes(8 * capacity))
+        self.minimums = array.array('d', bytes(8 * capacity))
+        self.maximums = array.array('d', bytes(8 * capacity))
+        self.sums = array.array('d', bytes(8 * capacity))
+        self.count = 0
+        self.next = 0
+        self.bucket_start = None
+        self.bucket_count = 0
+        self.bucket_min = 0.0
+        self.bucket_max = 0.0
+        self.bucket_sum = 0.0
+
+    def _flush(self):
+        index = self.next
+        self.times[index] = self.bucket_start
+        self.counts[index] = self.bucket_count
+        self.minimums[index] = self.bucket_min
+        self.maximums[index] = self.bucket_max
+        self.sums[index] = self.bucket_sum
+        self.next = (index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def add(self, timestamp, value):
+        bucket_start = timestamp - timestamp % self.width
+        if bucket_start != self.bucket_start:
+            if self.bucket_count:
+                self._flush()
+            self.bucket_start = bucket_start
+            self.bucket_count = 1
+            self.bucket_min = self.bucket_max = self.bucket_sum = value
+            return
+        self.bucket_count += 1
+        self.bucket_sum += value
+        if value < self.bucket_min:
+            self.bucket_min = value
+        elif value > self.bucket_max:
+            self.bucket_max = value
+
+    def get_range(self, start, end):
+        result = {'t': [], 'count': [], 'min': [], 'max': [], 'mean': []}
+
+        def add_bucket(bucket_start, count, minimum, maximum, total):
+            # Buckets overlapping the range are included
+            if bucket_start + self.width > start and bucket_start <= end:
+                result['t'].append(bucket_start)
+                result['count'].append(count)
+                result['min'].append(minimum)
+                result['max'].append(maximum)
+                result['mean'].append(total / count)
+
+        first = (self.next - self.count) % self.capacity
+        for offset in range(self.count):
+            index = (first + offset) % self.capacity
+            add_bucket(self.times[index], self.counts[index],
+                       self.minimums[index], self.maximums[index],
+                       self.sums[index])
+        if self.bucket_count:
+            add_bucket(self.bucket_start, self.bucket_count, self.bucket_min,
+                       self.bucket_max, self.bucket_sum)
+        return result
+
+
+class ProbeHistory(object):
+    """Bounded history of the numeric values of a probe.
+
+    Keeps the last raw_capacity samples, plus per-second and per-minute
+    aggregates (count, min, max and mean) of the last second_capacity seconds
+    and minute_capacity minutes with samples. All samples are stored as
+    floats in arrays allocated up front, so memory stays fixed and recording
+    a sample allocates no storage.
+    Only real numbers are recorded. Other values, eg: lists or numeric
+    strings, and NaN and infinite values, which JSON cannot represent, are
+    skipped.
+    """
+
+    def __init__(self, raw_capacity=1024, second_capacity=3600,
+                 minute_capacity=1440, clock=time.time):
+        """
+        Args:
+            raw_capacity (int): Number of raw samples kept
+            second_capacity (int): Number of per-second buckets kept
+            minute_capacity (int): Number of per-minute buckets kept
+            clock (function): Returns the current time in seconds
+        """
+        if min(raw_capacity, second_capacity, minute_capacity) <= 0:
+            raise ValueError("History capacities should be positive integers")
+        self.clock = clock
+        self._raw = _SampleRing(raw_capacity)
+        self._aggregates = {'1s': _AggregateRing(1, second_capacity),
+                            '1m': _AggregateRing(60, minute_capacity)}
+        self._lock = threading.Lock()
+
+    def record(self, value, timestamp=None):
+        """Records a sample at the timestamp, by default now. Returns False if
+        the value is skipped.
+        """
+        if not isinstance(value, numbers.Real):
+            return False
+        try:
+            value = float(value)
+        except OverflowError:
+            return False
+        if not math.isfinite(value):
+            return False
+        if timestamp is None:
+            timestamp = self.clock()
+        with self._lock:
+            self._raw.append(timestamp, value)
+            for aggregate in self._aggregates.values():
+                aggregate.add(timestamp, value)
+        return True
+
+    def get_range(self, resolution='raw', start=None, end=None):
+        """Returns the samples or buckets between the start and end times in
+        seconds, oldest first, as parallel lists.
+
+        Args:
+            resolution (str): 'raw' for {'t': [...], 'v': [...]}. '1s' or '1m'
+                for {'t': [...], 'count': [...], 'min': [...], 'max': [...],
+                'mean': [...]}, where t is the start of each bucket.
+            start (float): Defaults to the oldest sample. Values of zero or
+                less are relative to now, eg: -60 for the last minute.
+            end (float): Defaults to the newest sample. Relative like start.
+
+        Raises:
+            ValueError: If the resolution is not known
+        """
+        if resolution not in HISTORY_RESOLUTIONS:
+            raise ValueError("Unknown history resolution: " + str(resolution))
+        now = self.clock()
+        start = -math.inf if start is None else (
+            now + start if start <= 0 else start)
+        end = math.inf if end is None else (now + end if end <= 0 else end)
+        with self._lock:
+            if resolution == 'raw':
+                result = self._raw.get_range(start, end)
+            else:
+                result = self._aggregates[resolution].get_range(start, end)
+        result['resolution'] = resolution
+        return result
@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter.
+
+    Tokens are added continuously at `rate` tokens per second up to `burst`
+    tokens. Every admitted request consumes one token.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (float): Tokens added per second. Must be positive.
+            burst (int): Bucket capacity. Defaults to max(1, rate).
+        """
+        if rate <= 0:
+            raise ValueError("Rate should be a positive number")
+        if burst is None:
+            burst = max(1, rate)
+        elif burst < 1:
+            raise ValueError("Burst should be at least 1")
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Takes a token if one is available.
+
+        Returns:
+            float: 0.0 if a token was taken, else the seconds until the next
+                token becomes available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
@@ -0,0 +1,291 @@
+import argparse
+import http.client
+import json
+import math
+import sys
+import threading
+import time
+
+from .server import HTTPMethod
+
+
+def percentile(sorted_values, fraction):
+    """Returns the nearest-rank percentile of an ascending list of values.
+    Returns None for an empty list.
+    """
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values)) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+class LoadTestResult(object):
+    """Aggregated outcome of a load test run.
+
+    Latencies are in seconds and only cover successful requests. A request
+    counts as an error if it failed without a response or was answered with a
+    5xx status.
+    """
+
+    def __init__(self, config, latencies, status_counts, failures,
+                 connections_opened, bytes_received, elapsed):
+        self.config = config
+        self.latencies = sorted(latencies)
+        self.status_counts = status_counts
+        self.failures = failures
+        self.connections_opened = connections_opened
+        self.bytes_received = bytes_received
+        self.elapsed = elapsed
+
+    @property
+    def requests(self):
+        return sum(self.status_counts.values()) + self.failures
+
+    @property
+    def errors(self):
+        return self.failures + sum(count for status, count in
+                                   self.status_counts.items() if status >= 500)
+
+    @property
+    def throughput(self):
+        return self.requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def error_rate(self):
+        return self.errors / self.requests if self.requests else 0.0
+
+    def get_latency(self, fraction):
+        return percentile(self.latencies, fraction)
+
+    def to_dict(self):
+        """Returns the result as a JSON-serializable dictionary."""
+        return {
+            'config': self.config,
+            'requests': self.requests,
+            'errors': self.errors,
+            'failures': self.failures,
+            'error_rate': self.error_rate,
+            'elapsed_seconds': self.elapsed,
+            'throughput_rps': self.throughput,
+            'latency_seconds': {
+                'mean': (sum(self.latencies) / len(self.latencies)
+                         if self.latencies else None),
+                'p50': self.get_latency(0.50),
+                'p99': self.get_latency(0.99),
+                'p999': self.get_latency(0.999),
+                'max': self.latencies[-1] if self.latencies else None,
+            },
+            'status_counts': {str(status): count for status, count in
+                              sorted(self.status_counts.items())},
+            'connections_opened': self.connections_opened,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class _Worker(object):
+    def __init__(self, host, port, method, path, body, headers, keep_alive,
+                 timeout):
+        self.host = host
+        self.port = port
+        self.method = method.name
+        self.path = path
+        self.body = body
+        self.headers = dict(headers or {})
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.latencies = []
+        self.status_counts = {}
+        self.failures = 0
+        self.connections_opened = 0
+        self.bytes_received = 0
+        self._connection = None
+
+    def _get_connection(self):
+        if self._connection is None or self._connection.sock is None:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+            self._connection.connect()
+            self.connections_opened += 1
+        return self._connection
+
+    def request_once(self):
+        start = time.perf_counter()
+        try:
+            connection = self._get_connection()
+            connection.request(self.method, self.path, body=self.body,
+                               headers=self.headers)
+            response = connection.getresponse()
+            self.bytes_received += len(response.read())
+        except (OSError, http.client.HTTPException):
+            self.failures += 1
+            self.close()
+            return
+        latency = time.perf_counter() - start
+        self.status_counts[response.status] = self.status_counts.get(
+            response.status, 0) + 1
+        if response.status < 500:
+            self.latencies.append(latency)
+        if not self.keep_alive or response.will_close:
+            self.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def run_load_test(host, port, method=HTTPMethod.GET, path='/', body=None,
+                  headers=None, concurrency=1, requests=None, duration=None,
+                  keep_alive=True, warmup_requests=0, timeout=10):
+    """Runs a closed-loop load test against an HTTP server.
+
+    Args:
+        host (string): Server host
+        port (int): Server port
+        method (HTTPMethod): HTTP verb of every request
+        path (string): Request path
+        body (bytes): Request body, if any
+        headers (dict): Extra request headers
+        concurrency (int): Number of worker threads, each with one connection
+        requests (int): Total number of requests to send, split across the
+            workers. Either requests or duration must be passed.
+        duration (float): Seconds to keep sending requests for
+        keep_alive (bool): Reuse connections between requests when the server
+            allows it. Otherwise every request opens a new connection.
+        warmup_requests (int): Requests per worker sent before measuring
+        timeout (float): Socket timeout of each request in seconds
+
+    Returns:
+        LoadTestResult
+    """
+    if concurrency <= 0:
+        raise ValueError("Concurrency should be a positive integer")
+    elif (requests is None) == (duration is None):
+        raise ValueError("Exactly one of requests and duration must be passed")
+    elif requests is not None and requests < concurrency:
+        raise ValueError("Requests should be at least the concurrency")
+
+    workers = [_Worker(host, port, method, path, body, headers, keep_alive,
+                       timeout) for _ in range(concurrency)]
+    for worker in workers:
+        for _ in range(warmup_requests):
+            worker.request_once()
+        # An idle warm connection would hold a single-threaded server
+        worker.close()
+        worker.latencies = []
+        worker.status_counts = {}
+        worker.failures = 0
+        worker.connections_opened = 0
+        worker.bytes_received = 0
+
+    barrier = threading.Barrier(concurrency + 1)
+
+    def run_worker(index):
+        worker = workers[index]
+        barrier.wait()
+        if requests is not None:
+            share = requests // concurrency + (
+                1 if index < requests % concurrency else 0)
+            for _ in range(share):
+                worker.request_once()
+        else:
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                worker.request_once()
+        worker.close()
+
+    threads = [threading.Thread(target=run_worker, args=(index,),
+                                name="LoadTest-Worker-" + str(index))
+               for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    status_counts = {}
+    for worker in workers:
+        for status, count in worker.status_counts.items():
+            status_counts[status] = status_counts.get(status, 0) + count
+    config = {
+        'host': host, 'port': port, 'method': method.name, 'path': path,
+        'body_bytes': len(body) if body else 0, 'concurrency': concurrency,
+        'requests': requests, 'duration': duration, 'keep_alive': keep_alive,
+    }
+    return LoadTestResult(
+        config=config,
+        latencies=[latency for worker in workers for latency in worker.latencies],
+        status_counts=status_counts,
+        failures=sum(worker.failures for worker in workers),
+        connections_opened=sum(worker.connections_opened for worker in workers),
+        bytes_received=sum(worker.bytes_received for worker in workers),
+        elapsed=elapsed)
+
+
+def format_result(result):
+    """Returns a one-line human readable summary of a LoadTestResult."""
+    summary = result.to_dict()
+    latency = summary['latency_seconds']
+
+    def ms(value):
+        return '-' if value is None else '{:.3f}ms'.format(value * 1000)
+
+    return ('{requests} requests in {elapsed:.2f}s: {rps:.1f} req/s, '
+            'p50 {p50}, p99 {p99}, p999 {p999}, errors {error_rate:.2%}').format(
+                requests=summary['requests'], elapsed=summary['elapsed_seconds'],
+                rps=summary['throughput_rps'], p50=ms(latency['p50']),
+                p99=ms(latency['p99']), p999=ms(latency['p999']),
+                error_rate=summary['error_rate'])
+
+
+def main(argv=None):
+    """Command line interface. eg:
+
+        $ python -m omnilib.http.loadtest --port 8000 --path /probes/vars \\
+            --concurrency 8 --duration 10 --json
+    """
+    parser = argparse.ArgumentParser(
+        description="Closed-loop HTTP load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--method', default='GET',
+                        choices=[method.name for method in HTTPMethod])
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--body-file', help="File whose content is sent as body")
+    parser.add_argument('--concurrency', type=int, default=1)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--requests', type=int)
+    group.add_argument('--duration', type=float)
+    parser.add_argument('--no-keep-alive', action='store_true')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help="Unmeasured requests per worker")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the result as a JSON object")
+    args = parser.parse_args(argv)
+
+    body = None
+    if args.body_file:
+        with open(args.body_file, 'rb') as f:
+            body = f.read()
+    if args.requests is None and args.duration is None:
+        args.duration = 10.0
+    result = run_load_test(
+        args.host, args.port, method=HTTPMethod[args.method], path=args.path,
+        body=body, concurrency=args.concurrency, requests=args.requests,
+        duration=args.duration, keep_alive=not args.no_keep_alive,
+        warmup_requests=args.warmup)
+    if args.json:
+        print(json.dumps(result.to_dict(), sort_keys=True))
+    else:
+        print(format_result(result))
+    return 0 if result.errors == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds of the request latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CountingStream(object):
+    """Wraps a binary stream and counts the bytes read from and written to it.
+
+    All other attribute accesses are forwarded to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self._stream.readline(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        size = self._stream.readinto(buffer)
+        self.bytes_read += size or 0
+        return size
+
+    def write(self, data):
+        written = self._stream.write(data)
+        self.bytes_written += len(data) if written is None else written
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _RouteMetrics(object):
+    __slots__ = ('statuses', 'buckets', 'latency_sum', 'count', 'bytes_in',
+                 'bytes_out', 'in_flight')
+
+    def __init__(self, num_buckets):
+        self.statuses = {}
+        self.buckets = [0] * (num_buckets + 1)
+        self.latency_sum = 0.0
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.in_flight = 0
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class HTTPServerMetrics(object):
+    """Per-route request metrics of an HTTP Server.
+
+    Records request counts by status code, a latency histogram, bytes received
+    and sent, and the number of in-flight requests for every (method, route)
+    pair. Routes are the registered paths of the handlers and not the raw
+    request paths, so the number of series stays bounded.
+    Updates are thread-safe and cost a lock acquisition and a bisect per
+    request.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, latency_buckets=DEFAULT_LATENCY_BUCKETS):
+        self.latency_buckets = tuple(sorted(latency_buckets))
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def _get_route(self, key):
+        route_metrics = self._routes.get(key)
+        if route_metrics is None:
+            route_metrics = _RouteMetrics(len(self.latency_buckets))
+            self._routes[key] = route_metrics
+        return route_metrics
+
+    def request_started(self, method, route):
+        """Marks a request as in-flight. Returns the start timestamp to be
+        passed to request_finished.
+        """
+        with self._lock:
+            self._get_route((method.name, route)).in_flight += 1
+        return time.perf_counter()
+
+    def request_finished(self, method, route, start, status, bytes_in=0,
+                         bytes_out=0):
+        """Records a completed request.
+
+        Args:
+            method (HTTPMethod): HTTP verb of the request
+            route (string): Route the request was dispatched to
+            start (float): Value returned by request_started
+            status (int): Response status code. None if nothing was sent.
+            bytes_in (int): Bytes received for the request
+            bytes_out (int): Bytes sent in the response
+        """
+        latency = time.perf_counter() - start
+        status = 'none' if status is None else str(int(status))
+        bucket = bisect.bisect_left(self.latency_buckets, latency)
+        with self._lock:
+            route_metrics = self._get_route((method.name, route))
+            route_metrics.in_flight -= 1
+            route_metrics.count += 1
+            route_metrics.statuses[status] = route_metrics.statuses.get(
+                status, 0) + 1
+            route_metrics.buckets[bucket] += 1
+            route_metrics.latency_sum += latency
+            route_metrics.bytes_in += bytes_in
+            route_metrics.bytes_out += bytes_out
+
+    def get_request_count(self, method, route, status=None):
+        """Returns the number of completed requests on a route, optionally
+        only those answered with the passed status code.
+        """
+        with self._lock:
+            route_metrics = self._routes.get((method.name, route))
+            if route_metrics is None:
+                return 0
+            if status is None:
+                return route_metrics.count
+            return route_metrics.statuses.get(str(int(status)), 0)
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            snapshot = [(key, dict(m.statuses), list(m.buckets), m.latency_sum,
+                         m.count, m.bytes_in, m.bytes_out, m.in_flight)
+                        for key, m in routes]
+
+        lines = []
+
+        def family(name, metric_type, help_text):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        def labels(key, **extra):
+            pairs = [('method', key[0]), ('route', key[1])] + sorted(extra.items())
+            return '{' + ','.join('{}="{}"'.format(k, _escape_label(v))
+                                  for k, v in pairs) + '}'
+
+        family('omnilib_http_requests_total', 'counter',
+               'Completed HTTP requests by route and status code.')
+        for key, statuses, _, _, _, _, _, _ in snapshot:
+            for status, count in sorted(statuses.items()):
+                lines.append('omnilib_http_requests_total{} {}'.format(
+                    labels(key, status=status), count))
+
+        family('omnilib_http_request_duration_seconds', 'histogram',
+               'HTTP request latency in seconds.')
+        for key, _, buckets, latency_sum, count, _, _, _ in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.latency_buckets, buckets):
+                cumulative += bucket_count
+                lines.append('omnilib_http_request_duration_seconds_bucket{} {}'.format(
+                    labels(key, le=repr(bound)), cumulative))
+            lines.append('omnilib_http_request_duration_seconds_bucket{} {}'.format(
+                labels(key, le='+Inf'), count))
+            lines.append('omnilib_http_request_duration_seconds_sum{} {!r}'.format(
+                labels(key), latency_sum))
+            lines.append('omnilib_http_request_duration_seconds_count{} {}'.format(
+                labels(key), count))
+
+        family('omnilib_http_request_bytes_total', 'counter',
+               'Bytes received in HTTP requests.')
+        for key, _, _, _, _, bytes_in, _, _ in snapshot:
+            lines.append('omnilib_http_request_bytes_total{} {}'.format(
+                labels(key), bytes_in))
+
+        family('omnilib_http_response_bytes_total', 'counter',
+               'Bytes sent in HTTP responses.')
+        for key, _, _, _, _, _, bytes_out, _ in snapshot:
+            lines.append('omnilib_http_response_bytes_total{} {}'.format(
+                labels(key), bytes_out))
+
+        family('omnilib_http_requests_in_flight', 'gauge',
+               'HTTP requests currently being handled.')
+        for key, _, _, _, _, _, _, in_flight in snapshot:
+            lines.append('omnilib_http_requests_in_flight{} {}'.format(
+                labels(key), in_flight))
+
+        return '\n'.join(lines) + '\n'
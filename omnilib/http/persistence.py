@@ -0,0 +1,273 @@
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import urllib.parse
+import zlib
+
+# Every record is its payload length and CRC-32 followed by the payload, a
+# pickled dictionary mapping labels to values
+_record_header = struct.Struct('<II')
+_snapshot_file_extension = '.probes'
+
+_logger = logging.getLogger(__name__)
+
+# Store that export_probe_resource_to_server attaches resources to
+_default_snapshot_store = None
+
+
+def set_default_snapshot_store(store):
+    """Sets the ProbeSnapshotStore Probe Resources are attached to when they
+    are exported to a server, or None to not persist them. See
+    omnilib.init(probe_snapshot_dir=...).
+    """
+    global _default_snapshot_store
+    _default_snapshot_store = store
+
+
+def get_default_snapshot_store():
+    return _default_snapshot_store
+
+
+def _encode_record(values):
+    try:
+        payload = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        # Leave out the values that cannot be pickled
+        picklable = {}
+        for label, value in values.items():
+            try:
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                continue
+            picklable[label] = value
+        payload = pickle.dumps(picklable, pickle.HIGHEST_PROTOCOL)
+    return _record_header.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_snapshot_records(filename):
+    """Returns the merged values of the records of a snapshot file and the
+    size of its valid records, which is less than the file size if the file
+    ends with a torn or corrupt record.
+    """
+    values = {}
+    offset = 0
+    try:
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return values, offset
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while offset + _record_header.size <= len(data):
+                    length, checksum = _record_header.unpack_from(data, offset)
+                    start = offset + _record_header.size
+                    payload = data[start:start + length]
+                    if len(payload) != length or zlib.crc32(payload) != checksum:
+                        break
+                    try:
+                        values.update(pickle.loads(payload))
+                    except Exception:
+                        # eg: the class of a value no longer exists
+                        pass
+                    offset = start + length
+    except FileNotFoundError:
+        pass
+    return values, offset
+
+
+def read_snapshot_file(filename):
+    """Returns the values of the records of a snapshot file merged in order,
+    or an empty dictionary if the file does not exist. Reading stops at the
+    first torn or corrupt record, eg: from a crash during an append.
+    """
+    return _read_snapshot_records(filename)[0]
+
+
+class _AttachedResource(object):
+    def __init__(self, probe_resource, filename, version):
+        self.probe_resource = probe_resource
+        self.filename = filename
+        self.version = version
+        self.snapshot_size = 0
+
+
+class ProbeSnapshotStore(object):
+    """Persists the probe values of Probe Resources in a directory, so they
+    survive restarts.
+
+    Every attached resource has an append-only file of records holding the
+    values of the probes changed since the previous record. A background
+    thread appends the changes every interval seconds, so setting a probe
+    costs nothing extra. Each record is written with a single append and
+    checksummed, so a crash loses at most the changes of the last interval.
+    Once a file grows to compact_ratio times the size of the resource's
+    values and past compact_min_bytes, it is replaced atomically with a single
+    record of the current values.
+
+    Values are pickled. Values that cannot be pickled are not persisted, and
+    like for every probe, changes made by mutating a value in place are only
+    noticed once the probe is set. Errors writing the changes of a resource,
+    eg: a full disk, are logged and the changes are retried on the next write.
+
+    The snapshot file of a path has a single owner: only one Probe Resource
+    per path can be attached to a store, and a directory should only be used
+    by one store at a time. Use separate directories for servers that export
+    resources with the same paths.
+    """
+
+    def __init__(self, directory, interval=1.0, compact_min_bytes=64 * 1024,
+                 compact_ratio=4):
+        """
+        Args:
+            directory (str): Created if it does not exist
+            interval (float): Seconds between writes of the changes
+            compact_min_bytes (int): Files smaller than this are not compacted
+            compact_ratio (float): See class docstring
+        """
+        if interval <= 0:
+            raise ValueError("Interval should be a positive number")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+        self.compact_min_bytes = compact_min_bytes
+        self.compact_ratio = compact_ratio
+        self._attached = {}
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def get_filename(self, path):
+        """Returns the snapshot file of the Probe Resource path."""
+        return os.path.join(self.directory, urllib.parse.quote(
+            path.strip('/'), safe='') + _snapshot_file_extension)
+
+    def attach(self, probe_resource):
+        """Restores the persisted values of the resource's probes and persists
+        its changes from then on. Persisted values of labels the resource
+        does not have are ignored. Does nothing if the resource is attached.
+
+        A torn or corrupt record at the end of the file, eg: from a crash
+        during an append, is truncated so that later changes can be appended.
+
+        Returns:
+            dict: The restored values
+
+        Raises:
+            ValueError: If another resource with the same path is attached
+        """
+        with self._lock:
+            if id(probe_resource) in self._attached:
+                return {}
+            filename = self.get_filename(probe_resource.get_path())
+            for other in self._attached.values():
+                if other.filename == filename:
+                    raise ValueError(
+                        "Another Probe Resource with the path {} is already "
+                        "attached".format(probe_resource.get_path()))
+            with probe_resource.lock:
+                restored, valid_size = _read_snapshot_records(filename)
+                if os.path.exists(filename) and \
+                        os.path.getsize(filename) > valid_size:
+                    os.truncate(filename, valid_size)
+                values = {label: value for label, value in restored.items()
+                          if label in probe_resource.probe_dict}
+                if values:
+                    probe_resource.update_probe_values(values)
+                attached = _AttachedResource(probe_resource, filename,
+                                             probe_resource.version)
+            self._attached[id(probe_resource)] = attached
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._write_changes, daemon=True,
+                    name="ProbeSnapshotStore::Directory:" + self.directory)
+                self._thread.start()
+            return values
+
+    def detach(self, probe_resource):
+        """Writes the pending changes of the resource and stops persisting it.
+        The snapshot file is kept.
+        """
+        with self._lock:
+            attached = self._attached.pop(id(probe_resource), None)
+            if attached is not None:
+                self._flush_logging_errors(attached)
+
+    def is_attached(self, probe_resource):
+        return id(probe_resource) in self._attached
+
+    def _write_changes(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
+
+    def _flush(self, attached):
+        version, labels = attached.probe_resource.get_changes(attached.version)
+        if not labels:
+            return
+        _, values = attached.probe_resource.get_probe_snapshot(labels)
+        record = _encode_record(values)
+        with open(attached.filename, 'ab', buffering=0) as f:
+            offset = f.tell()
+            try:
+                view = memoryview(record)
+                while view:
+                    view = view[f.write(view):]
+            except BaseException:
+                # Do not leave a torn record that would hide later records
+                os.ftruncate(f.fileno(), offset)
+                raise
+            size = f.tell()
+        attached.version = version
+        if size >= self.compact_min_bytes and \
+                size >= self.compact_ratio * attached.snapshot_size:
+            self._compact(attached)
+
+    def _flush_logging_errors(self, attached):
+        try:
+            self._flush(attached)
+        except Exception:
+            _logger.exception("Failed to write the probe snapshot file %s",
+                              attached.filename)
+
+    def flush(self):
+        """Writes the pending changes of all attached resources now. Errors
+        are logged per resource.
+        """
+        with self._lock:
+            for attached in list(self._attached.values()):
+                self._flush_logging_errors(attached)
+
+    def _compact(self, attached):
+        version, values = attached.probe_resource.get_probe_snapshot()
+        record = _encode_record(values)
+        temporary_filename = attached.filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_filename, attached.filename)
+        attached.version = version
+        attached.snapshot_size = len(record)
+
+    def compact(self, probe_resource):
+        """Replaces the snapshot file of an attached resource with a single
+        record of its current values.
+        """
+        with self._lock:
+            attached = self._attached.get(id(probe_resource))
+            if attached is not None:
+                self._compact(attached)
+
+    def close(self):
+        """Writes the pending changes and stops the background thread."""
+        self._closed.set()
+        self.flush()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
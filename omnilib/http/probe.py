@@ -1,79 +1,930 @@
+import bisect
+import contextlib
+import functools
 import http
-import inspect
+import json
+import math
+import operator
 import os
+import sys
+import threading
+import time
+import urllib.parse
+import warnings
 
-import jsonpickle
-import jsonpickle.ext.numpy as jsonpickle_numpy
-from mako.template import Template
-
-from ..util import MutableVariable, Singleton
+from ..util import (MutableVariable, ProbeBlock, Singleton,
+                    VersionedMutableVariable)
+from .history import ProbeHistory
+from .persistence import get_default_snapshot_store
 from .server import HTTPMethod, StatelessHTTPHandler
 
 _probe_root_path = "/probes"
-jsonpickle_numpy.register_handlers()
+_prober_template_filename = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'data', 'probes', 'prober.html')
+# Probe values of these types are immutable, so their encoding can be reused
+# for as long as the value compares equal.
+_immutable_value_types = (bool, int, float, complex, str, bytes, type(None))
 
 
 def _get_probe_absolute_path(resource):
     return _probe_root_path + '/' + resource.get_path()
 
 
+def _to_json_value(value):
+    """json.dumps fallback for probe values that are not plain JSON types."""
+    if isinstance(value, MutableVariable):
+        return value.get_value()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    from . import encoding
+    return json.loads(encoding.encode(value, unpicklable=False))
+
+
+def _encode_json(obj):
+    return json.dumps(obj, default=_to_json_value, separators=(',', ':'))
+
+
+def _parse_slice(text):
+    """Parses an index in Python syntax, eg: '100:200,::2', into a tuple of
+    ints and slices.
+
+    Raises:
+        ValueError: If the text is not a valid index
+    """
+    index = []
+    for part in text.split(','):
+        part = part.strip()
+        if part == '...':
+            index.append(Ellipsis)
+        elif ':' in part:
+            bounds = part.split(':')
+            if len(bounds) > 3:
+                raise ValueError("Invalid slice: " + part)
+            index.append(slice(*[int(bound) if bound.strip() else None
+                                 for bound in bounds]))
+        else:
+            index.append(int(part))
+    return tuple(index)
+
+
+def _parse_shape(text):
+    text = text.strip()
+    if not text:
+        return ()
+    shape = tuple(int(size) for size in text.split(','))
+    if any(size < 0 for size in shape):
+        raise ValueError("Invalid shape: " + text)
+    return shape
+
+
+def _is_numpy_array(value):
+    """True if the value is a NumPy array. Does not import NumPy, as no
+    value can be an array if NumPy is not imported yet.
+    """
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def _get_probe_slice(value, index):
+    if _is_numpy_array(value):
+        return value[index]
+    if len(index) != 1:
+        raise TypeError("Only NumPy array probes support multi-dimensional slices")
+    return value[index[0]]
+
+
+def _get_probe_block_array(probe_block):
+    """Returns a NumPy array sharing the buffer of the ProbeBlock."""
+    import numpy
+    return numpy.frombuffer(probe_block.buffer, dtype=probe_block.typecode)
+
+
+def _is_binary_array(value):
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and \
+        isinstance(value, (numpy.ndarray, numpy.generic)) and \
+        not value.dtype.hasobject and value.dtype.fields is None
+
+
+class _RequestBodyTooLargeError(ValueError):
+    """Raised when a request body is too large to be accepted."""
+
+
+class ProbeVersionConflictError(ValueError):
+    """Raised when a compare-and-set update of a Probe Resource expected a
+    different version than the current one.
+    """
+
+    def __init__(self, probe_resource, expected_version):
+        super().__init__("Probe Resource {} is at version {}, expected {}".format(
+            probe_resource.get_path(), probe_resource.version, expected_version))
+        self.probe_resource = probe_resource
+        self.expected_version = expected_version
+
+
+def update_probe_resources(updates):
+    """Applies updates to several Probe Resources as one atomic change.
+
+    The locks of all resources are taken in a global order, by path and then
+    by identity for resources of the same path on different servers, and
+    every update is validated before any is applied, so either all resources
+    are updated or none is.
+
+    Args:
+        updates (list): (ProbeResource, values dict, expected version or
+            None) tuples, see ProbeResource.update_probe_values
+
+    Returns:
+        list: The version of each resource after the update
+
+    Raises:
+        ValueError: If a label does not exist
+        ProbeVersionConflictError: If a resource is not at its expected version
+    """
+    resources = sorted({id(update[0]): update[0] for update in updates}.values(),
+                       key=lambda resource: (resource.get_path(), id(resource)))
+    with contextlib.ExitStack() as stack:
+        for resource in resources:
+            stack.enter_context(resource.lock)
+        for resource, values, expected_version in updates:
+            resource.check_probe_values(values, expected_version)
+        return [resource.update_probe_values(values)
+                for resource, values, _ in updates]
+
+
+def _invalidate_cached_tree(server, probe_path):
+    # Drops the cached responses of the resource, of its single probes and of
+    # the /probes index listing it
+    if server.response_cache is not None:
+        server.response_cache.invalidate_tree(probe_path)
+
+
 def export_probe_resource_to_server(server, probe_resource):
     """Exports the Probe Resource to the given server for editing.
 
     Registers a GET Handler at /probes/{probe_resource.path}
     Registers a PATCH Handler at /probes/{probe_resource.path}
+    Registers GET and PATCH prefix Handlers at /probes/ for the JSON API of
+    single probes at /probes/{probe_resource.path}/{label}
+    Registers a PATCH Handler at /probes for atomically updating several
+    Probe Resources of the server in one request
+    Registers a GET Handler at /probes listing the Probe Resources of the
+    server, see ProbeIndexGETHandler
 
     The GET Handler is served by a HTML page that allows for easy viewing and
-    editing of the Probe Resource.
+    editing of the Probe Resource. It serves a JSON object mapping labels to
+    plain values instead if the request asks for JSON, see
+    ProbeResourceGETHandler.
     Overwrites any existing Probe Resource at the same path on this server.
+    If a default ProbeSnapshotStore is set, eg: by
+    omnilib.init(probe_snapshot_dir=...), the persisted probe values are
+    restored and changes are persisted from then on. An overwritten resource
+    is detached from the store unless another server exports it. The store
+    persists one resource per path: a different resource with the path of a
+    resource persisted for another server is exported without persistence,
+    with a RuntimeWarning.
+    May be called from any thread, including while the server is serving.
     """
-    ProbeResourceHandlerRegistry().register_probe_resource(
-        server.server_address, probe_resource)
+    registry = ProbeResourceHandlerRegistry()
+    snapshot_store = get_default_snapshot_store()
     probe_path = _get_probe_absolute_path(probe_resource)
-    server.register_handler(HTTPMethod.GET, probe_path,
-                            ProbeResourceGETHandler)
-    server.register_handler(HTTPMethod.PATCH, probe_path,
-                            ProbeResourcePATCHHandler)
+    with server.handler_registry.lock:
+        if snapshot_store is not None:
+            replaced = registry.get_probe_resource(server.server_address,
+                                                   probe_path)
+            if replaced is not None and replaced is not probe_resource and \
+                    registry.get_server_addresses(replaced) == \
+                    [server.server_address]:
+                snapshot_store.detach(replaced)
+            try:
+                snapshot_store.attach(probe_resource)
+            except ValueError:
+                warnings.warn(
+                    "Probe Resource {} is not persisted, as another resource "
+                    "with the same path is".format(probe_resource.get_path()),
+                    RuntimeWarning, stacklevel=2)
+        registry.register_probe_resource(server.server_address, probe_resource)
+        server.register_handler(HTTPMethod.GET, probe_path,
+                                ProbeResourceGETHandler)
+        server.register_handler(HTTPMethod.PATCH, probe_path,
+                                ProbeResourcePATCHHandler)
+        server.register_prefix_handler(HTTPMethod.GET, _probe_root_path + '/',
+                                       ProbeGETHandler)
+        server.register_prefix_handler(HTTPMethod.PATCH, _probe_root_path + '/',
+                                       ProbePATCHHandler)
+        server.register_handler(HTTPMethod.PATCH, _probe_root_path,
+                                ProbeResourcesPATCHHandler)
+        server.register_handler(HTTPMethod.GET, _probe_root_path,
+                                ProbeIndexGETHandler)
+    _invalidate_cached_tree(server, probe_path)
+
+
+def remove_probe_resource(server, probe_resource):
+    """Removes a Probe Resource exported with export_probe_resource_to_server
+    from the server. Deregisters its GET and PATCH Handlers and drops it from
+    the /probes index. The resource is detached from the default
+    ProbeSnapshotStore, if any, unless another server exports it. Does
+    nothing if the resource is not exported.
+
+    Args:
+        server (MultiHandlerSingleThreadHTTPServer): Server the resource was
+            exported to
+        probe_resource (ProbeResource or str): The resource or its path
+    """
+    if isinstance(probe_resource, ProbeResource):
+        probe_resource = probe_resource.get_path()
+    probe_path = _probe_root_path + '/' + probe_resource.strip('/')
+    with server.handler_registry.lock:
+        removed = ProbeResourceHandlerRegistry().remove_probe_resource(
+            server.server_address, probe_path)
+        if removed is None:
+            return
+        server.deregister_handler(HTTPMethod.GET, probe_path)
+        server.deregister_handler(HTTPMethod.PATCH, probe_path)
+        snapshot_store = get_default_snapshot_store()
+        if snapshot_store is not None and not \
+                ProbeResourceHandlerRegistry().get_server_addresses(removed):
+            snapshot_store.detach(removed)
+    _invalidate_cached_tree(server, probe_path)
+
+
+class ProbeHandler(StatelessHTTPHandler):
+    """Base class of the Probe Resource handlers with shared helpers."""
+
+    def get_probe_resource(self, path=None):
+        if path is None:
+            path = self._request_handler.get_request_path()
+        return ProbeResourceHandlerRegistry().get_probe_resource(
+            self._request_handler.server.server_address, path)
+
+    def get_probe_resource_and_label(self):
+        """Splits a /probes/{probe_resource.path}/{label} request path.
+        Returns a (probe resource or None, label) tuple.
+        """
+        resource_path, _, label = \
+            self._request_handler.get_request_path().rpartition('/')
+        return (self.get_probe_resource(resource_path),
+                urllib.parse.unquote(label))
+
+    def wants_json(self):
+        """True if the request asks for JSON through the query string or the
+        Accept header rather than for the HTML page.
+        """
+        query = self._request_handler.get_request_query()
+        if 'fields' in query or query.get('format') == ['json']:
+            return True
+        accept = self._request_handler.headers.get('Accept', '')
+        return 'application/json' in accept and 'text/html' not in accept
+
+    def has_json_body(self):
+        content_type = self._request_handler.headers.get('Content-Type', '')
+        return content_type.split(';', 1)[0].strip() == 'application/json'
+
+    def read_json_body(self):
+        """Returns the decoded JSON request body.
+
+        Raises:
+            ValueError: If the body is empty or not valid JSON
+        """
+        request_body = self.read_body()
+        if not request_body:
+            raise ValueError("Request body is empty")
+        return json.loads(request_body.decode('utf-8'))
+
+    def get_expected_version(self):
+        """Returns the version in the If-Match header, or None if the header
+        is missing or `*`.
+
+        Raises:
+            ValueError: If the header is not a version
+        """
+        if_match = self._request_handler.headers.get('If-Match', '*').strip()
+        if if_match == '*':
+            return None
+        if if_match.startswith('W/'):
+            if_match = if_match[2:]
+        return int(if_match.strip('"'))
+
+    def send_version_conflict(self, error):
+        self.send_json({'error': str(error),
+                        'version': error.probe_resource.version},
+                       http.HTTPStatus.PRECONDITION_FAILED,
+                       version=error.probe_resource.version)
 
+    def get_slice(self):
+        """Returns the index tuple of the `slice` query parameter, or None.
+
+        Raises:
+            ValueError: If the parameter is not a valid index
+        """
+        query = self._request_handler.get_request_query()
+        if 'slice' not in query:
+            return None
+        return _parse_slice(query['slice'][0])
+
+    def send_array(self, array, version=None):
+        """Sends a NumPy array as its raw C-ordered buffer.
+
+        The buffer is written straight from the array's memory, copying only
+        arrays that are not C-contiguous. X-Omnilib-Dtype holds the NumPy
+        dtype string, eg: '<f8', and X-Omnilib-Shape the comma separated shape.
+        """
+        import numpy
+        array = numpy.ascontiguousarray(array)
+        self._request_handler.send_response(http.HTTPStatus.OK)
+        self._request_handler.send_header('Content-Type',
+                                          'application/octet-stream')
+        self._request_handler.send_header('X-Omnilib-Dtype', array.dtype.str)
+        self._request_handler.send_header(
+            'X-Omnilib-Shape', ','.join(str(size) for size in array.shape))
+        if version is not None:
+            self._request_handler.send_header('ETag', '"{}"'.format(version))
+        self._request_handler.send_header('Content-Length', array.nbytes)
+        self._request_handler.end_headers()
+        self._request_handler.wfile.write(array.reshape(-1).view(numpy.uint8).data)
+
+    def send_json(self, obj, status=http.HTTPStatus.OK, version=None):
+        response = bytes(_encode_json(obj), 'utf-8')
+        self._request_handler.send_response(status)
+        self._request_handler.send_header('Content-Type', 'application/json')
+        if version is not None:
+            self._request_handler.send_header('ETag', '"{}"'.format(version))
+        self._request_handler.send_header('Content-Length', len(response))
+        self._request_handler.end_headers()
+        self._request_handler.wfile.write(response)
+
+    def send_json_error(self, status, message):
+        self.send_json({'error': message}, status)
+
+
+class ProbeResourceGETHandler(ProbeHandler):
+    """Serves a Probe Resource as an HTML page.
+
+    Requests asking for JSON, with `?format=json`, `?fields=label1,label2` or
+    an `Accept: application/json` header, get a JSON object mapping the
+    selected labels, or all labels, to their plain values instead.
+
+    Changes can be watched in two ways. Both hold the request open, so
+    watching needs a MultiHandlerThreadingHTTPServer to not block other
+    requests.
+    Long-poll: `?since=<version>&timeout=<seconds>` answers once a probe
+    changes after the version, or with no values on timeout, with
+    {"version": <current version>, "values": {<changed label>: <value>}}.
+    Server-Sent Events: `Accept: text/event-stream` or `?watch=sse` streams a
+    `change` event with the same JSON for every change, starting with all
+    values unless a `Last-Event-ID` header gives a version. Rapid changes are
+    coalesced into at most `?max_rate=<events per second>` events. Event ids
+    are versions. `?duration=<seconds>` ends the stream.
+    """
 
-class ProbeResourceGETHandler(StatelessHTTPHandler):
     def handle(self):
-        probe_resource = ProbeResourceHandlerRegistry().get_probe_resource(
-            self._request_handler.server.server_address, self._request_handler.path)
-        html_template = Template(filename=os.path.join(os.path.dirname(
-            inspect.getfile(ProbeResourceGETHandler)), 'data', 'probes', 'prober.html'))
-        html_response = html_template.render(prober_path=probe_resource.get_path(), prober_desc=probe_resource.get_desc(), prober_dict=jsonpickle.encode(
-            probe_resource.get_probe_values()), prober_desc_dict=jsonpickle.encode(probe_resource.get_probe_descriptions()))
+        probe_resource = self.get_probe_resource()
+        query = self._request_handler.get_request_query()
+        if query.get('watch') == ['sse'] or 'text/event-stream' in \
+                self._request_handler.headers.get('Accept', ''):
+            self.handle_event_stream(probe_resource, query)
+            return
+        if 'since' in query:
+            self.handle_long_poll(probe_resource, query)
+            return
+        if self.wants_json():
+            self.handle_json(probe_resource)
+            return
+        html_template = TemplateCache().get_template(_prober_template_filename)
+        html_response = bytes(html_template.render(
+            prober_path=probe_resource.get_path(),
+            prober_desc=probe_resource.get_desc(),
+            prober_dict=probe_resource.get_encoded_probe_values(),
+            prober_desc_dict=probe_resource.get_encoded_probe_descriptions()),
+            'utf-8')
         self._request_handler.send_response(http.HTTPStatus.OK)
         self._request_handler.send_header('Content-Length', len(html_response))
         self._request_handler.end_headers()
-        self._request_handler.wfile.write(bytes(html_response, 'utf-8'))
+        self._request_handler.wfile.write(html_response)
+
+    def handle_json(self, probe_resource):
+        probe_dict = probe_resource.get_probe_values()
+        fields = self._request_handler.get_request_query().get('fields')
+        if fields:
+            labels = [label for field in fields for label in field.split(',')
+                      if label]
+            unknown = [label for label in labels if label not in probe_dict]
+            if unknown:
+                self.send_json_error(http.HTTPStatus.BAD_REQUEST,
+                                     "Unknown probes: " + ', '.join(unknown))
+                return
+        else:
+            labels = None
+        version, values = probe_resource.get_probe_snapshot(labels)
+        self.send_json(values, version=version)
 
+    def get_float_param(self, query, name, default, minimum, maximum):
+        try:
+            value = float(query[name][0]) if name in query else default
+        except ValueError:
+            value = default
+        return min(max(value, minimum), maximum)
+
+    def get_change_event(self, probe_resource, since_version):
+        with probe_resource.lock:
+            version, labels = probe_resource.get_changes(since_version)
+            _, values = probe_resource.get_probe_snapshot(labels)
+        return (version, {'version': version, 'values': values})
+
+    def handle_long_poll(self, probe_resource, query):
+        try:
+            since_version = int(query['since'][0])
+        except ValueError:
+            self.send_json_error(http.HTTPStatus.BAD_REQUEST,
+                                 "since should be an integer version")
+            return
+        timeout = self.get_float_param(query, 'timeout', 30, 0, 300)
+        probe_resource.wait_for_changes(since_version, timeout)
+        self.send_json(self.get_change_event(probe_resource, since_version)[1])
+
+    def handle_event_stream(self, probe_resource, query):
+        try:
+            since_version = int(
+                self._request_handler.headers.get('Last-Event-ID', -1))
+        except ValueError:
+            since_version = -1
+        min_interval = 1 / self.get_float_param(query, 'max_rate', 10, 0.01, 1000)
+        duration = self.get_float_param(query, 'duration', math.inf, 0, math.inf)
+        heartbeat_interval = 15
+        server = self._request_handler.server
+
+        deadline = time.monotonic() + duration
+        last_sent = -math.inf
+        try:
+            with self.start_chunked_response(headers={
+                    'Content-Type': 'text/event-stream',
+                    'Cache-Control': 'no-cache'}) as writer:
+                while server.serving:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        break
+                    # Coalesce changes that arrive faster than max_rate
+                    if now < last_sent + min_interval:
+                        time.sleep(min(last_sent + min_interval, deadline) - now)
+                        continue
+                    version, labels = probe_resource.wait_for_changes(
+                        since_version, min(heartbeat_interval, deadline - now))
+                    if not labels:
+                        # Also skips versions without labels, eg: of a
+                        # resource without probes, so the next wait blocks
+                        since_version = version
+                        writer.write(': heartbeat\n\n')
+                        continue
+                    since_version, event = self.get_change_event(
+                        probe_resource, since_version)
+                    writer.write('id: {}\nevent: change\ndata: {}\n\n'.format(
+                        since_version, _encode_json(event)))
+                    last_sent = time.monotonic()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            self._request_handler.close_connection = True
+
+
+class ProbeResourcePATCHHandler(ProbeHandler):
+    """Updates the probes of a Probe Resource as one atomic change.
+
+    The body is a jsonpickle encoded dictionary mapping labels to
+    MutableVariables, as sent by the HTML page. With a
+    `Content-Type: application/json` header, the body is a plain JSON object
+    mapping labels to bare values instead. All labels are validated before
+    any probe is updated.
+    With an `If-Match: "<version>"` header, the update is only applied if the
+    resource is still at that version, else it is answered with a 412. The
+    ETag header of the response holds the new version.
+    """
 
-class ProbeResourcePATCHHandler(StatelessHTTPHandler):
     def handle(self):
-        content_length = int(self._request_handler.headers['Content-Length'])
-        response_string = self._request_handler.rfile.read(content_length)
-        probes = jsonpickle.decode(response_string)
-        probe_resource = ProbeResourceHandlerRegistry().get_probe_resource(
-            self._request_handler.server.server_address, self._request_handler.path)
+        from . import encoding
+        probe_resource = self.get_probe_resource()
+        json_body = self.has_json_body()
+        try:
+            expected_version = self.get_expected_version()
+            if json_body:
+                probes = self.read_json_body()
+            else:
+                request_body = self.read_body()
+                probes = encoding.decode(request_body) if request_body else None
+        except ValueError:
+            probes = None
 
         # Check if response is valid
-        for key, value in probes.items():
-            if not isinstance(value, MutableVariable):
-                self._request_handler.send_response(
-                    http.HTTPStatus.BAD_REQUEST)
-                self._request_handler.end_headers()
-                return
+        if not isinstance(probes, dict) or not (json_body or all(
+                isinstance(value, MutableVariable) for value in probes.values())):
+            self._request_handler.send_response(http.HTTPStatus.BAD_REQUEST)
+            self._request_handler.end_headers()
+            return
+        if not json_body:
+            probes = {key: value.get_value() for key, value in probes.items()}
 
-        # Set received value
-        for key, value in probes.items():
-            probe_resource.get_probe_value(key).set_value(value.get_value())
+        # Set received values
+        try:
+            version = probe_resource.update_probe_values(probes, expected_version)
+        except ProbeVersionConflictError as e:
+            self.send_version_conflict(e)
+            return
+        except ValueError:
+            self._request_handler.send_response(http.HTTPStatus.BAD_REQUEST)
+            self._request_handler.end_headers()
+            return
 
         self._request_handler.send_response(http.HTTPStatus.OK)
+        self._request_handler.send_header('ETag', '"{}"'.format(version))
         self._request_handler.end_headers()
 
 
+class ProbeGETHandler(ProbeHandler):
+    """Serves the plain JSON value of a single probe at
+    /probes/{probe_resource.path}/{label}
+
+    `?slice=<index>` serves only part of a sequence or NumPy array probe.
+    The index uses Python syntax with dimensions separated by commas,
+    eg: `?slice=100:200,::2`.
+    NumPy array probes are served as their raw buffer if the request accepts
+    `application/octet-stream`. The X-Omnilib-Dtype and X-Omnilib-Shape
+    response headers describe the buffer, see send_array.
+    ProbeBlock probes are served as a JSON object mapping the block labels to
+    values, or like a NumPy array of the values in label order when sliced or
+    asked for the raw buffer.
+    `?history=raw|1s|1m` serves the recorded history of the probe instead,
+    see ProbeResource.enable_history and ProbeHistory.get_range. `start` and
+    `end` parameters select a time range in seconds since the epoch, or
+    relative to now if zero or less, eg: `?history=1s&start=-300`.
+    """
+
+    def handle(self):
+        probe_resource, label = self.get_probe_resource_and_label()
+        if probe_resource is None or probe_resource.get_probe_value(label) is None:
+            self.send_json_error(http.HTTPStatus.NOT_FOUND, "Unknown probe")
+            return
+        query = self._request_handler.get_request_query()
+        if 'history' in query:
+            self.handle_history(probe_resource, label, query)
+            return
+        mutable_variable = probe_resource.get_probe_value(label)
+        accept = self._request_handler.headers.get('Accept', '')
+        try:
+            index = self.get_slice()
+            if isinstance(mutable_variable, ProbeBlock) and (
+                    index is not None or 'application/octet-stream' in accept):
+                value = _get_probe_block_array(mutable_variable)
+            else:
+                value = mutable_variable.get_value()
+            if index is not None:
+                value = _get_probe_slice(value, index)
+        except (IndexError, TypeError, ValueError) as e:
+            self.send_json_error(http.HTTPStatus.BAD_REQUEST, str(e))
+            return
+        if 'application/octet-stream' in accept:
+            if not _is_binary_array(value):
+                self.send_json_error(http.HTTPStatus.NOT_ACCEPTABLE,
+                                     "Probe is not a plain NumPy array")
+                return
+            self.send_array(value)
+            return
+        self.send_json(value)
+
+    def handle_history(self, probe_resource, label, query):
+        history = probe_resource.get_probe_history(label)
+        if history is None:
+            self.send_json_error(http.HTTPStatus.NOT_FOUND,
+                                 "Probe history is not enabled")
+            return
+        try:
+            start, end = (float(query[name][0]) if name in query else None
+                          for name in ('start', 'end'))
+            result = history.get_range(query['history'][0], start, end)
+        except ValueError as e:
+            self.send_json_error(http.HTTPStatus.BAD_REQUEST, str(e))
+            return
+        self.send_json(result)
+
+
+class ProbePATCHHandler(ProbeHandler):
+    """Sets a single probe at /probes/{probe_resource.path}/{label} from a
+    bare JSON value in the request body. Supports If-Match like
+    ProbeResourcePATCHHandler.
+
+    With `?slice=<index>`, only that part of a NumPy array or list probe is
+    assigned, in place. See ProbeGETHandler for the index syntax.
+    NumPy array probes also accept a raw buffer with
+    `Content-Type: application/octet-stream`. Its X-Omnilib-Dtype and
+    X-Omnilib-Shape headers default to the dtype of the probe and the shape
+    of the assigned slice or array.
+    ProbeBlock probes take a JSON object mapping any of the block labels to
+    values, and are otherwise sliced and sent as raw buffers like a NumPy
+    array of the values in label order.
+    Sliced and binary updates are answered with a 204.
+    A raw buffer must be exactly as large as its dtype and shape. Chunked raw
+    buffers, whose size is only known once read, are answered with a 413 if
+    their dtype and shape exceed max_chunked_array_bytes.
+    """
+
+    max_chunked_array_bytes = 64 * 1024 * 1024
+
+    def handle(self):
+        probe_resource, label = self.get_probe_resource_and_label()
+        if probe_resource is None or probe_resource.get_probe_value(label) is None:
+            self.send_json_error(http.HTTPStatus.NOT_FOUND, "Unknown probe")
+            return
+        content_type = self._request_handler.headers.get('Content-Type', '')
+        binary_body = content_type.startswith('application/octet-stream')
+        try:
+            expected_version = self.get_expected_version()
+            index = self.get_slice()
+            if binary_body:
+                mutable_variable = probe_resource.get_probe_value(label)
+                if isinstance(mutable_variable, ProbeBlock):
+                    current_value = _get_probe_block_array(mutable_variable)
+                else:
+                    current_value = mutable_variable.get_value()
+                value = self.read_array_body(current_value, index)
+            else:
+                value = self.read_json_body()
+            if index is not None:
+                version = probe_resource.update_probe_slice(
+                    label, index, value, expected_version)
+            else:
+                version = probe_resource.update_probe_values(
+                    {label: value}, expected_version)
+        except ProbeVersionConflictError as e:
+            self.send_version_conflict(e)
+            return
+        except _RequestBodyTooLargeError as e:
+            self.send_json_error(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE, str(e))
+            return
+        except MemoryError:
+            self.send_json_error(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                 "Array is too large")
+            return
+        except (IndexError, TypeError, ValueError) as e:
+            self.send_json_error(http.HTTPStatus.BAD_REQUEST, str(e))
+            return
+        if binary_body or index is not None:
+            self._request_handler.send_response(http.HTTPStatus.NO_CONTENT)
+            self._request_handler.send_header('ETag', '"{}"'.format(version))
+            self._request_handler.end_headers()
+            return
+        self.send_json(value, version=version)
+
+    def read_array_body(self, current_value, index):
+        """Reads a raw array buffer from the request body straight into a new
+        NumPy array.
+
+        Raises:
+            ValueError: If the headers do not describe the body
+            _RequestBodyTooLargeError: If a chunked body would exceed
+                max_chunked_array_bytes
+        """
+        import numpy
+        headers = self._request_handler.headers
+        if 'X-Omnilib-Dtype' in headers:
+            dtype = numpy.dtype(headers['X-Omnilib-Dtype'])
+        elif isinstance(current_value, numpy.ndarray):
+            dtype = current_value.dtype
+        else:
+            raise ValueError("Missing X-Omnilib-Dtype header")
+        if 'X-Omnilib-Shape' in headers:
+            shape = _parse_shape(headers['X-Omnilib-Shape'])
+        elif isinstance(current_value, numpy.ndarray):
+            target = current_value if index is None else current_value[index]
+            shape = numpy.shape(target)
+        else:
+            raise ValueError("Missing X-Omnilib-Shape header")
+        if dtype.hasobject:
+            raise ValueError("Object arrays cannot be sent as raw buffers")
+
+        # Checked before allocating, as the headers are chosen by the client
+        nbytes = functools.reduce(operator.mul, shape, 1) * dtype.itemsize
+        reader = self.get_body_reader()
+        if reader.chunked:
+            if nbytes > self.max_chunked_array_bytes:
+                raise _RequestBodyTooLargeError(
+                    "Array exceeds {} bytes".format(self.max_chunked_array_bytes))
+        elif nbytes != reader.content_length:
+            raise ValueError("Body size does not match dtype and shape")
+        array = numpy.empty(shape, dtype=dtype)
+        if reader.readinto(array.reshape(-1).view(numpy.uint8)) != array.nbytes \
+                or reader.read(1):
+            raise ValueError("Body size does not match dtype and shape")
+        return array
+
+
+class ProbeResourcesPATCHHandler(ProbeHandler):
+    """Updates several Probe Resources of the server as one atomic change.
+
+    The body is a JSON object mapping resource paths to
+    {"values": {<label>: <bare value>}, "version": <expected version>}
+    objects, where the version is optional. Either every resource is updated
+    or, on an unknown resource or label or a version conflict, none is. The
+    response maps the resource paths to their new versions.
+    """
+
+    def handle(self):
+        try:
+            body = self.read_json_body()
+            updates = []
+            for path, update in body.items():
+                probe_resource = self.get_probe_resource(
+                    _probe_root_path + '/' + path.strip('/'))
+                if probe_resource is None:
+                    raise ValueError("Unknown Probe Resource: " + path)
+                if not isinstance(update, dict) or \
+                        not isinstance(update.get('values'), dict):
+                    raise ValueError("Missing values for " + path)
+                expected_version = update.get('version')
+                if expected_version is not None and \
+                        not isinstance(expected_version, int):
+                    raise ValueError("Invalid version for " + path)
+                updates.append((probe_resource, update['values'],
+                                expected_version))
+        except (ValueError, AttributeError) as e:
+            self.send_json_error(http.HTTPStatus.BAD_REQUEST, str(e))
+            return
+
+        try:
+            versions = update_probe_resources(updates)
+        except ProbeVersionConflictError as e:
+            self.send_version_conflict(e)
+            return
+        except ValueError as e:
+            self.send_json_error(http.HTTPStatus.BAD_REQUEST, str(e))
+            return
+        self.send_json({update[0].get_path(): version
+                        for update, version in zip(updates, versions)})
+
+
+class ProbeIndexGETHandler(ProbeHandler):
+    """Lists the Probe Resources of the server at /probes, sorted by path.
+
+    Query parameters:
+        prefix: Only list resources whose path starts with the prefix,
+            eg: `?prefix=workers/`
+        label: Only list resources with a probe of that label
+        limit: Maximum number of resources listed, at least 1, 100 by default
+            and at most 1000
+        after: Only list resources whose path sorts after this one. Pass the
+            `next` value of the previous page to get the following page.
+
+    Responds with {"total": <matching resources>, "next": <path or null>,
+    "resources": [{"path": ..., "desc": ..., "labels": [...]}]}.
+    """
+
+    default_limit = 100
+    max_limit = 1000
+
+    def handle(self):
+        query = self._request_handler.get_request_query()
+        try:
+            limit = int(query['limit'][0]) if 'limit' in query \
+                else self.default_limit
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            # A page without resources would have no next page to follow
+            self.send_json_error(http.HTTPStatus.BAD_REQUEST,
+                                 "limit should be a positive integer")
+            return
+        index = ProbeResourceHandlerRegistry().get_probe_index(
+            self._request_handler.server.server_address)
+        resources, total, next_path = index.find(
+            prefix=query.get('prefix', [''])[0].lstrip('/'),
+            label=query.get('label', [None])[0],
+            after=query.get('after', [None])[0],
+            limit=min(limit, self.max_limit))
+        self.send_json({
+            'total': total,
+            'next': next_path,
+            'resources': [{'path': resource.get_path(),
+                           'desc': resource.get_desc(),
+                           'labels': resource.get_probe_labels()}
+                          for resource in resources]})
+
+
+def _get_prefix_end(prefix):
+    """Returns the smallest string sorting after every string starting with
+    the prefix, or None for an empty prefix.
+    """
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class ProbeResourceIndex(object):
+    """Sorted index of the Probe Resources of one server.
+
+    Keeps the resource paths in a sorted list and, for every probe label, the
+    sorted paths of the resources having a probe with the label. Listing a
+    page by prefix or label then takes a binary search plus the page itself,
+    however many resources the server has. Labels of probes added after a
+    resource is indexed are indexed as they are added.
+    """
+
+    def __init__(self):
+        self.resources = {}
+        self.paths = []
+        self.label_paths = {}
+        self._label_callbacks = {}
+        self._lock = threading.Lock()
+
+    def _add_label(self, path, label):
+        paths = self.label_paths.setdefault(label, [])
+        position = bisect.bisect_left(paths, path)
+        if position == len(paths) or paths[position] != path:
+            paths.insert(position, path)
+
+    def _on_probe_added(self, path, probe_resource, label):
+        with self._lock:
+            if self.resources.get(path) is probe_resource:
+                self._add_label(path, label)
+
+    def add(self, probe_resource):
+        """Indexes the resource, replacing any resource at the same path."""
+        path = probe_resource.get_path()
+        self.remove(path)
+        callback = functools.partial(self._on_probe_added, path)
+        with self._lock:
+            self.resources[path] = probe_resource
+            bisect.insort(self.paths, path)
+            self._label_callbacks[path] = callback
+            probe_resource.subscribe_probe_added(callback)
+            for label in probe_resource.get_probe_labels():
+                self._add_label(path, label)
+
+    def remove(self, path):
+        """Drops the resource at the path from the index and returns it, or
+        None if there is none.
+        """
+        with self._lock:
+            probe_resource = self.resources.pop(path, None)
+            if probe_resource is None:
+                return None
+            del self.paths[bisect.bisect_left(self.paths, path)]
+            probe_resource.unsubscribe_probe_added(
+                self._label_callbacks.pop(path))
+            for label in probe_resource.get_probe_labels():
+                paths = self.label_paths.get(label)
+                position = bisect.bisect_left(paths, path) if paths else 0
+                if paths and position < len(paths) and paths[position] == path:
+                    del paths[position]
+                    if not paths:
+                        del self.label_paths[label]
+            return probe_resource
+
+    def find(self, prefix='', label=None, after=None, limit=100):
+        """Returns a (resources, total, next) tuple for the resources whose
+        path starts with the prefix and, if passed, that have a probe with
+        the label. Resources are sorted by path and start after the path
+        passed as after. total counts all matching resources, and next is the
+        path to pass as after for the next page, or None on the last page.
+        """
+        with self._lock:
+            paths = self.paths if label is None \
+                else self.label_paths.get(label, [])
+            first = bisect.bisect_left(paths, prefix)
+            prefix_end = _get_prefix_end(prefix)
+            end = len(paths) if prefix_end is None \
+                else bisect.bisect_left(paths, prefix_end)
+            start = first if after is None \
+                else max(first, bisect.bisect_right(paths, after))
+            stop = min(end, start + limit)
+            resources = [self.resources[path] for path in paths[start:stop]]
+            next_path = paths[stop - 1] if stop < end and stop > start else None
+            return resources, end - first, next_path
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class TemplateCache(metaclass=Singleton):
+    """Global Singleton cache of compiled Mako templates.
+
+    A template is parsed and compiled once and recompiled only when the
+    modification time of its file changes.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self._lock = threading.Lock()
+
+    def get_template(self, filename):
+        mtime = os.stat(filename).st_mtime_ns
+        cached = self.templates.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with self._lock:
+            cached = self.templates.get(filename)
+            if cached is None or cached[0] != mtime:
+                from mako.template import Template
+                cached = (mtime, Template(filename=filename))
+                self.templates[filename] = cached
+        return cached[1]
+
+
 class ProbeResourceHandlerRegistry(metaclass=Singleton):
     """Global Singleton Handler Registry for all Omnilib Probe Resources
 
@@ -83,16 +934,43 @@ class ProbeResourceHandlerRegistry(metaclass=Singleton):
 
     def __init__(self):
         self.registry = {}
+        self.indexes = {}
 
     def register_probe_resource(self, server_address, resource):
         if server_address not in self.registry:
             self.registry[server_address] = {}
+            self.indexes[server_address] = ProbeResourceIndex()
         self.registry[server_address][_get_probe_absolute_path(
             resource)] = resource
+        self.indexes[server_address].add(resource)
+
+    def remove_probe_resource(self, server_address, path):
+        """Removes the resource at the absolute path, eg: /probes/vars, and
+        returns it, or None if there is none.
+        """
+        resource = self.registry.get(server_address, {}).pop(path, None)
+        if resource is not None:
+            self.indexes[server_address].remove(resource.get_path())
+        return resource
 
     def get_probe_resource(self, server_address, path):
         return self.registry.get(server_address, {}).get(path, None)
 
+    def get_server_addresses(self, resource):
+        """Returns the addresses of the servers the resource is exported
+        to.
+        """
+        path = _get_probe_absolute_path(resource)
+        return [server_address for server_address, resources in
+                list(self.registry.items()) if resources.get(path) is resource]
+
+    def get_probe_index(self, server_address):
+        """Returns the ProbeResourceIndex of the server, which is empty if no
+        resource was exported to it.
+        """
+        index = self.indexes.get(server_address)
+        return ProbeResourceIndex() if index is None else index
+
 
 class ProbeResource(object):
     """A Probe Resource encapsulates a group of probes defined as labelled
@@ -102,6 +980,18 @@ class ProbeResource(object):
     the /probes root.
     A probe must have a label and can have an optional description. All probe
     values must be Mutable Variables.
+
+    The resource carries a version that is incremented whenever a probe is
+    added, replaced or set through MutableVariable.set_value, and remembers
+    the version at which each probe last changed. See wait_for_changes.
+
+    update_probe_values sets several probes as one atomic change, optionally
+    only if the resource is still at an expected version. Readers see either
+    none or all of such a batch through get_probe_snapshot or by holding the
+    resource lock.
+
+    enable_history keeps a bounded ProbeHistory of the values a numeric probe
+    is set to, see get_probe_history.
     """
 
     def __init__(self, path, desc=''):
@@ -109,6 +999,39 @@ class ProbeResource(object):
         self.desc = desc
         self.probe_dict = {}
         self.probe_desc_dict = {}
+        self.version = 0
+        self.lock = threading.RLock()
+        self._probe_versions = {}
+        self._probe_callbacks = {}
+        self._changed = threading.Condition(self.lock)
+        # Labels set by the batch being applied, None outside of batches
+        self._batch_labels = None
+        self._encoded_probe_descriptions = None
+        # label -> (MutableVariable, value or version, jsonpickle encoding of
+        # the variable)
+        self._encoded_probe_values = {}
+        self._probe_histories = {}
+        # See subscribe_probe_added
+        self._probe_added_callbacks = []
+
+    def _watch_probe(self, label, mutable_variable):
+        if label in self._probe_callbacks:
+            self.probe_dict[label].unsubscribe(self._probe_callbacks[label])
+        callback = functools.partial(self._on_probe_changed, label)
+        self._probe_callbacks[label] = callback
+        mutable_variable.subscribe(callback)
+
+    def _on_probe_changed(self, label, mutable_variable=None):
+        with self._changed:
+            history = self._probe_histories.get(label)
+            if history is not None:
+                history.record(self.probe_dict[label].get_value())
+            if self._batch_labels is not None:
+                self._batch_labels.append(label)
+                return
+            self.version += 1
+            self._probe_versions[label] = self.version
+            self._changed.notify_all()
 
     def add_probe(self, label, mutable_variable, desc=''):
         """Adds a labelled probe to the Probe Resource. Overwrites any
@@ -124,8 +1047,30 @@ class ProbeResource(object):
         """
         if not isinstance(mutable_variable, MutableVariable):
             raise ValueError("Passed probe should be of type MutableVariable!")
-        self.probe_dict[label] = mutable_variable
-        self.probe_desc_dict[label] = desc
+        with self.lock:
+            is_new_label = label not in self.probe_dict
+            self._watch_probe(label, mutable_variable)
+            self.probe_dict[label] = mutable_variable
+            self.probe_desc_dict[label] = desc
+            self._encoded_probe_descriptions = None
+            self._on_probe_changed(label)
+        # Called outside of the lock, as callbacks may take their own locks
+        if is_new_label:
+            for callback in list(self._probe_added_callbacks):
+                callback(self, label)
+
+    def subscribe_probe_added(self, callback):
+        """Calls callback(probe_resource, label) whenever a probe with a new
+        label is added, eg: to keep a ProbeResourceIndex up to date.
+        """
+        self._probe_added_callbacks.append(callback)
+
+    def unsubscribe_probe_added(self, callback):
+        """Removes a callback subscribed with subscribe_probe_added. Does
+        nothing if it is not subscribed.
+        """
+        if callback in self._probe_added_callbacks:
+            self._probe_added_callbacks.remove(callback)
 
     def set_probe_value(self, label, value):
         """Sets the MutableVariable value of a probe with the given label.
@@ -135,8 +1080,11 @@ class ProbeResource(object):
         """
         if not isinstance(value, MutableVariable):
             raise ValueError("Passed value should be of type MutableVariable!")
-        if label in self.probe_dict:
-            self.probe_dict[label] = value
+        with self.lock:
+            if label in self.probe_dict:
+                self._watch_probe(label, value)
+                self.probe_dict[label] = value
+                self._on_probe_changed(label)
 
     def get_probe_value(self, label):
         """Gets the probe MutableVariable value with the label. Returns None if
@@ -145,6 +1093,40 @@ class ProbeResource(object):
         if label in self.probe_dict:
             return self.probe_dict[label]
 
+    def enable_history(self, label, raw_capacity=1024, second_capacity=3600,
+                       minute_capacity=1440):
+        """Starts recording the values the probe is set to in a ProbeHistory,
+        including the current value. Does nothing if the history of the probe
+        is already enabled. See ProbeHistory for the capacities.
+
+        Returns:
+            ProbeHistory: The history of the probe
+
+        Raises:
+            ValueError: If the probe does not exist
+        """
+        with self.lock:
+            if label not in self.probe_dict:
+                raise ValueError("Unknown probe: " + str(label))
+            history = self._probe_histories.get(label)
+            if history is None:
+                history = ProbeHistory(raw_capacity, second_capacity,
+                                       minute_capacity)
+                history.record(self.probe_dict[label].get_value())
+                self._probe_histories[label] = history
+            return history
+
+    def disable_history(self, label):
+        """Stops recording and drops the history of the probe."""
+        with self.lock:
+            self._probe_histories.pop(label, None)
+
+    def get_probe_history(self, label):
+        """Returns the ProbeHistory of the probe, or None if its history is
+        not enabled.
+        """
+        return self._probe_histories.get(label)
+
     def get_probe_desc(self, label):
         if label in self.probe_desc_dict:
             return self.probe_desc_dict[label]
@@ -160,11 +1142,175 @@ class ProbeResource(object):
         return self.probe_dict
 
     def get_probe_labels(self):
-        return list(self.probe_dict.keys())
+        with self.lock:
+            return list(self.probe_dict.keys())
 
     def get_probe_descriptions(self):
         return self.probe_desc_dict
 
+    def check_probe_values(self, values, expected_version=None):
+        """Validates an update without applying it.
+
+        Raises:
+            ValueError: If a label does not exist
+            ProbeVersionConflictError: If expected_version is not None and
+                differs from the current version
+        """
+        unknown = [label for label in values if label not in self.probe_dict]
+        if unknown:
+            raise ValueError("Unknown probes: " + ', '.join(map(str, unknown)))
+        if expected_version is not None and expected_version != self.version:
+            raise ProbeVersionConflictError(self, expected_version)
+
+    def update_probe_values(self, values, expected_version=None):
+        """Sets the values of several probes as one atomic change.
+
+        All labels are validated before any probe is set. The version is
+        incremented once for the whole batch.
+
+        Args:
+            values (dict): Maps labels to bare values, not MutableVariables
+            expected_version (int): If passed, the update is only applied if
+                the resource is still at this version
+
+        Returns:
+            int: The version of the resource after the update
+
+        Raises:
+            ValueError: If a label does not exist
+            ProbeVersionConflictError: If the resource is not at
+                expected_version
+        """
+        with self._changed:
+            self.check_probe_values(values, expected_version)
+            self._batch_labels = []
+            try:
+                for label, value in values.items():
+                    self.probe_dict[label].set_value(value)
+            finally:
+                labels, self._batch_labels = self._batch_labels, None
+            if labels:
+                self.version += 1
+                for label in labels:
+                    self._probe_versions[label] = self.version
+                self._changed.notify_all()
+            return self.version
+
+    def update_probe_slice(self, label, index, value, expected_version=None):
+        """Assigns value to probe_value[index] in place as one atomic change.
+
+        Args:
+            label (str): Label of a probe holding a NumPy array, a list or a
+                ProbeBlock
+            index (tuple): Index into the probe value, eg: (slice(0, 10),)
+            value: Value assigned to the indexed part
+            expected_version (int): See update_probe_values
+
+        Returns:
+            int: The version of the resource after the update
+        """
+        with self._changed:
+            self.check_probe_values({label: None}, expected_version)
+            mutable_variable = self.probe_dict[label]
+            if isinstance(mutable_variable, ProbeBlock):
+                _get_probe_block_array(mutable_variable)[index] = value
+                mutable_variable.notify()
+                return self.version
+            target = mutable_variable.get_value()
+            if _is_numpy_array(target):
+                target[index] = value
+            elif len(index) == 1:
+                target[index[0]] = value
+            else:
+                raise TypeError(
+                    "Only NumPy array probes support multi-dimensional slices")
+            # Setting the same object again records the change
+            return self.update_probe_values({label: target})
+
+    def get_probe_snapshot(self, labels=None):
+        """Returns a (version, values) tuple where values maps the passed
+        labels, or all labels, to the bare values of the probes at that
+        version.
+        """
+        with self.lock:
+            if labels is None:
+                labels = self.probe_dict.keys()
+            return (self.version, {label: self.probe_dict[label].get_value()
+                                   for label in labels})
+
+    def get_changes(self, since_version):
+        """Returns a (version, labels) tuple with the current version and the
+        labels of the probes changed after since_version. A since_version
+        ahead of the current version, eg: from before a restart, yields all
+        labels.
+        """
+        with self._changed:
+            if since_version > self.version:
+                since_version = -1
+            return (self.version, [label for label, version in
+                                   self._probe_versions.items()
+                                   if version > since_version])
+
+    def wait_for_changes(self, since_version, timeout=None):
+        """Blocks until a probe changes after since_version or the timeout
+        in seconds passes. Returns the same tuple as get_changes, with no
+        labels on timeout.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != since_version,
+                                   timeout)
+            return self.get_changes(since_version)
+
+    def get_encoded_probe_descriptions(self):
+        """Returns the jsonpickle encoding of the probe descriptions. The
+        encoding is cached until a probe is added.
+        """
+        from . import encoding
+        with self.lock:
+            if self._encoded_probe_descriptions is None:
+                self._encoded_probe_descriptions = encoding.encode(
+                    self.probe_desc_dict)
+            return self._encoded_probe_descriptions
+
+    def get_encoded_probe_values(self):
+        """Returns the jsonpickle encoding of the probe values dictionary.
+
+        Probes are encoded one by one. The encoding of a probe holding an
+        immutable value is reused while the value stays the same. The encoding
+        of a VersionedMutableVariable probe, whatever its value, is reused
+        while its version stays the same. Only changed and other mutable
+        values are encoded again. The probes are listed holding the lock, so
+        probes added concurrently are either fully included or left out.
+        """
+        from . import encoding
+        with self.lock:
+            probes = list(self.probe_dict.items())
+        encoded_values = {}
+        for label, mutable_variable in probes:
+            cached = self._encoded_probe_values.get(label)
+            if isinstance(mutable_variable, VersionedMutableVariable):
+                version = mutable_variable.version
+                if cached is not None and cached[0] is mutable_variable and \
+                        cached[1] == version:
+                    encoded_values[label] = cached
+                else:
+                    encoded_values[label] = (mutable_variable, version,
+                                             encoding.encode(mutable_variable))
+                continue
+            value = mutable_variable.get_value()
+            if cached is not None and cached[0] is mutable_variable and \
+                    type(cached[1]) is type(value) and cached[1] == value:
+                encoded_values[label] = cached
+                continue
+            encoded = encoding.encode(mutable_variable)
+            if type(value) in _immutable_value_types:
+                encoded_values[label] = (mutable_variable, value, encoded)
+            else:
+                encoded_values[label] = (None, None, encoded)
+        self._encoded_probe_values = encoded_values
+        return '{' + ', '.join(json.dumps(label) + ': ' + cached[2]
+                               for label, cached in encoded_values.items()) + '}'
+
     def get_path(self):
         return self.path
 
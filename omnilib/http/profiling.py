@@ -0,0 +1,231 @@
+import abc
+import http
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+from .server import HTTPMethod, StatelessHTTPHandler
+
+# Held while a CPU or allocation profile runs, so profiles never overlap
+_profile_lock = threading.Lock()
+
+
+def _get_frame_label(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                               code.co_firstlineno).replace(';', ',')
+
+
+def sample_stacks(duration, interval=0.01, exclude_thread_ids=()):
+    """Samples the stacks of all threads every interval seconds for duration
+    seconds.
+
+    Returns:
+        dict: Maps collapsed stacks, eg: 'MainThread;main (app.py:10);run
+            (app.py:20)', to the number of samples they were seen in. Stacks
+            start with the thread name and list the functions root first, the
+            format flame graph tools read.
+    """
+    exclude_thread_ids = set(exclude_thread_ids)
+    exclude_thread_ids.add(threading.get_ident())
+    counts = {}
+    deadline = time.monotonic() + duration
+    while True:
+        thread_names = {thread.ident: thread.name
+                        for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in exclude_thread_ids:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_get_frame_label(frame))
+                frame = frame.f_back
+            labels.append(thread_names.get(thread_id, str(thread_id))
+                          .replace(';', ','))
+            stack = ';'.join(reversed(labels))
+            counts[stack] = counts.get(stack, 0) + 1
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return counts
+        time.sleep(min(interval, remaining))
+
+
+def format_collapsed_stacks(counts):
+    """Returns the stacks of sample_stacks as lines of `<stack> <count>`,
+    most sampled first.
+    """
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in
+                   sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+
+def _format_statistic(statistic):
+    frame = statistic.traceback[0]
+    result = {'file': frame.filename, 'line': frame.lineno,
+              'size_bytes': statistic.size, 'count': statistic.count}
+    if hasattr(statistic, 'size_diff'):
+        result['size_diff_bytes'] = statistic.size_diff
+        result['count_diff'] = statistic.count_diff
+    return result
+
+
+def compare_allocations(duration, limit=20, group_by='lineno', frames=1):
+    """Takes a tracemalloc snapshot, waits duration seconds and takes another.
+    Starts tracing for the duration if tracemalloc is not tracing yet.
+
+    Returns:
+        dict: {"top": [...], "diff": [...]} with the limit largest
+            allocation sites of the second snapshot and the limit largest
+            size changes between the snapshots. Each site is a dictionary
+            with file, line, size_bytes and count, and for the diff also
+            size_diff_bytes and count_diff.
+    """
+    import tracemalloc
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        first = tracemalloc.take_snapshot()
+        time.sleep(duration)
+        second = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    # Allocations of tracemalloc itself are not interesting
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    first = first.filter_traces(filters)
+    second = second.filter_traces(filters)
+    return {
+        'top': [_format_statistic(statistic) for statistic in
+                second.statistics(group_by)[:limit]],
+        'diff': [_format_statistic(statistic) for statistic in
+                 second.compare_to(first, group_by)[:limit]],
+    }
+
+
+class ProfileHandler(StatelessHTTPHandler):
+    """Base class of the profiling handlers. Runs at most one profile at a
+    time across all servers of the process and answers other requests with a
+    409 meanwhile.
+    """
+
+    max_seconds = 60
+
+    def get_param(self, name, default, minimum, maximum, parse=float):
+        """Returns the query parameter clamped to [minimum, maximum].
+
+        Raises:
+            ValueError: If the parameter cannot be parsed or is not finite
+        """
+        query = self._request_handler.get_request_query()
+        value = parse(query[name][0]) if name in query else default
+        # NaN would pass the clamp and make durations never elapse
+        if not math.isfinite(value):
+            raise ValueError("{} should be a finite number".format(name))
+        return min(max(value, minimum), maximum)
+
+    def send_text(self, text, content_type, status=http.HTTPStatus.OK):
+        body = bytes(text, 'utf-8')
+        self._request_handler.send_response(status)
+        self._request_handler.send_header('Content-Type', content_type)
+        self._request_handler.send_header('Content-Length', len(body))
+        self._request_handler.end_headers()
+        self._request_handler.wfile.write(body)
+
+    def handle(self):
+        try:
+            arguments = self.get_arguments()
+        except ValueError as e:
+            self.send_text(str(e) + '\n', 'text/plain; charset=utf-8',
+                           http.HTTPStatus.BAD_REQUEST)
+            return
+        if not _profile_lock.acquire(blocking=False):
+            self.send_text("A profile is already running\n",
+                           'text/plain; charset=utf-8',
+                           http.HTTPStatus.CONFLICT)
+            return
+        try:
+            self.profile(*arguments)
+        finally:
+            _profile_lock.release()
+
+    @abc.abstractmethod
+    def get_arguments(self):
+        """Returns the arguments of profile parsed from the request.
+
+        Raises:
+            ValueError: If the request is invalid, answered with a 400
+        """
+        pass
+
+    @abc.abstractmethod
+    def profile(self, *arguments):
+        """Runs the profile and sends the response."""
+        pass
+
+
+class CPUProfileHandler(ProfileHandler):
+    """Samples the stacks of all threads and serves them as collapsed stacks
+    in text/plain, one `<stack> <count>` line each, for flame graph tools.
+
+    `?seconds=<duration>` defaults to 10 and is at most 60.
+    `?interval=<milliseconds>` between samples defaults to 10.
+    The request is answered after the duration, so a
+    MultiHandlerSingleThreadHTTPServer serves nothing else meanwhile. Its
+    serving thread is then not in the samples.
+    """
+
+    def get_arguments(self):
+        return (self.get_param('seconds', 10, 0, self.max_seconds),
+                self.get_param('interval', 10, 1, 1000) / 1000)
+
+    def profile(self, seconds, interval):
+        counts = sample_stacks(seconds, interval)
+        self.send_text(format_collapsed_stacks(counts),
+                       'text/plain; charset=utf-8')
+
+
+class AllocationProfileHandler(ProfileHandler):
+    """Serves the top allocation sites and their changes over a time span as
+    JSON, see compare_allocations.
+
+    `?seconds=<duration>` between the snapshots defaults to 10 and is at
+    most 60. `?limit=<sites>` defaults to 20. `?group_by=lineno|filename`
+    defaults to lineno. `?frames=<depth>` is the traceback depth recorded if
+    tracing is started for the request, 1 by default.
+    """
+
+    def get_arguments(self):
+        group_by = self._request_handler.get_request_query().get(
+            'group_by', ['lineno'])[0]
+        if group_by not in ('lineno', 'filename'):
+            raise ValueError("group_by should be lineno or filename")
+        return (self.get_param('seconds', 10, 0, self.max_seconds),
+                self.get_param('limit', 20, 1, 1000, int), group_by,
+                self.get_param('frames', 1, 1, 100, int))
+
+    def profile(self, seconds, limit, group_by, frames):
+        result = compare_allocations(seconds, limit, group_by, frames)
+        self.send_text(json.dumps(result), 'application/json')
+
+
+def register_profiling_handlers(server, prefix='/debug/profile'):
+    """Registers the profiling handlers on the server:
+    GET {prefix}/cpu, see CPUProfileHandler
+    GET {prefix}/allocations, see AllocationProfileHandler
+
+    The handlers expose source paths and slow the process down while they
+    run, so only register them on servers reachable by trusted clients.
+    """
+    prefix = prefix.rstrip('/')
+    server.register_handler(HTTPMethod.GET, prefix + '/cpu', CPUProfileHandler)
+    server.register_handler(HTTPMethod.GET, prefix + '/allocations',
+                            AllocationProfileHandler)
+
+
+def deregister_profiling_handlers(server, prefix='/debug/profile'):
+    prefix = prefix.rstrip('/')
+    server.deregister_handler(HTTPMethod.GET, prefix + '/cpu')
+    server.deregister_handler(HTTPMethod.GET, prefix + '/allocations')
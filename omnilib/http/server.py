@@ -1,9 +1,19 @@
 import abc
+import http
+import io
+import math
+import socket
 import threading
+import time
+import urllib.parse
 from enum import Enum, unique
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 from ..util import Singleton
+from .cache import CachePolicy, HTTPResponseCache, RecordingStream
+from .limits import TokenBucket
+from .metrics import CountingStream, HTTPServerMetrics
 
 
 @unique
@@ -14,22 +24,42 @@ class HTTPMethod(Enum):
     PATCH = 3
 
 
+DEFAULT_ROUTE = '<default>'
+UNHANDLED_ROUTE = '<unhandled>'
+
+
 class HTTPHandlerRegistry(object):
     """Registry for an HTTP Server.
 
     This enables adding and removing HTTP Request handlers on the go.
     Supports regular handlers for responding to requests on a specific path.
+    Supports prefix handlers for responding to requests on all paths under a
+    prefix. The longest matching prefix wins, and a regular handler for the
+    exact path takes precedence over any prefix handler.
     Supports default handlers for various HTTP methods.
+    Handlers may be registered from any thread. Hold lock to make several
+    registrations appear to the serving threads at once.
     """
 
     def __init__(self):
         self.request_handlers = {}
+        self.prefix_request_handlers = {}
         self.default_request_handlers = {}
+        self.rate_limits = {}
+        self.cache_policies = {}
+        self.lock = threading.RLock()
 
     def register_request_handler(self, method, path, handler):
-        if method not in self.request_handlers:
-            self.request_handlers[method] = {}
-        self.request_handlers[method][path] = handler
+        with self.lock:
+            if method not in self.request_handlers:
+                self.request_handlers[method] = {}
+            self.request_handlers[method][path] = handler
+
+    def register_prefix_request_handler(self, method, prefix, handler):
+        with self.lock:
+            if method not in self.prefix_request_handlers:
+                self.prefix_request_handlers[method] = {}
+            self.prefix_request_handlers[method][prefix] = handler
 
     def register_default_request_handler(self, method, handler):
         self.default_request_handlers[method] = handler
@@ -38,25 +68,337 @@ class HTTPHandlerRegistry(object):
         request_handler = self.get_request_handler(method, path)
         if request_handler:
             return request_handler
+        prefix_handler = self.get_prefix_request_handler(method, path)[1]
+        if prefix_handler:
+            return prefix_handler
         default_handler = self.get_default_request_handler(method)
         if default_handler:
             return default_handler
         else:
             return None
 
+    def resolve_handler(self, method, path):
+        """Returns a (route, handler) tuple for a request.
+
+        The route is the registered path or prefix of the matched handler,
+        DEFAULT_ROUTE if the default handler matched and UNHANDLED_ROUTE if
+        there is no handler at all, in which case the handler is None.
+        """
+        request_handler = self.get_request_handler(method, path)
+        if request_handler:
+            return (path, request_handler)
+        prefix, prefix_handler = self.get_prefix_request_handler(method, path)
+        if prefix_handler:
+            return (prefix, prefix_handler)
+        default_handler = self.get_default_request_handler(method)
+        if default_handler:
+            return (DEFAULT_ROUTE, default_handler)
+        return (UNHANDLED_ROUTE, None)
+
     def get_request_handler(self, method, path):
         return self.request_handlers.get(method, {}).get(path, None)
 
+    def get_prefix_request_handler(self, method, path):
+        """Returns a (prefix, handler) tuple for the longest registered prefix
+        of the path, or (None, None) if no prefix matches.
+        """
+        best_prefix = None
+        with self.lock:
+            for prefix in self.prefix_request_handlers.get(method, {}):
+                if path.startswith(prefix) and \
+                        (best_prefix is None or len(prefix) > len(best_prefix)):
+                    best_prefix = prefix
+            if best_prefix is None:
+                return (None, None)
+            return (best_prefix,
+                    self.prefix_request_handlers[method][best_prefix])
+
     def get_default_request_handler(self, method):
         return self.default_request_handlers.get(method, None)
 
     def deregister_request_handler(self, method, path):
-        if self.get_request_handler(method, path):
-            del self.request_handlers[method][path]
+        with self.lock:
+            self.request_handlers.get(method, {}).pop(path, None)
+
+    def deregister_prefix_request_handler(self, method, prefix):
+        with self.lock:
+            self.prefix_request_handlers.get(method, {}).pop(prefix, None)
 
     def deregister_default_request_handler(self, method):
-        if self.get_default_request_handler(method):
-            del self.default_request_handlers[method]
+        with self.lock:
+            self.default_request_handlers.pop(method, None)
+
+    def register_rate_limit(self, method, route, rate, burst=None):
+        if method not in self.rate_limits:
+            self.rate_limits[method] = {}
+        self.rate_limits[method][route] = TokenBucket(rate, burst)
+
+    def deregister_rate_limit(self, method, route):
+        self.rate_limits.get(method, {}).pop(route, None)
+
+    def register_cache_policy(self, route, policy):
+        self.cache_policies[route] = policy
+
+    def deregister_cache_policy(self, route):
+        self.cache_policies.pop(route, None)
+
+    def get_cache_policy(self, method, route):
+        if method != HTTPMethod.GET:
+            return None
+        return self.cache_policies.get(route, None)
+
+    def acquire_rate_limit(self, method, route):
+        """Takes a token from the rate limit of the route, if it has one.
+
+        Returns:
+            float: 0.0 if the request is admitted, else the seconds to wait
+                before retrying.
+        """
+        bucket = self.rate_limits.get(method, {}).get(route, None)
+        if bucket is None:
+            return 0.0
+        return bucket.try_acquire()
+
+
+class RequestBodyReader(object):
+    """Incremental reader for the body of an HTTP request.
+
+    Supports bodies framed by a Content-Length header as well as bodies sent
+    with chunked transfer encoding. Data is read from the underlying stream
+    only when asked for, so arbitrarily large bodies can be consumed in
+    constant memory.
+    A request with neither a Content-Length nor a chunked Transfer-Encoding
+    has an empty body.
+    """
+
+    def __init__(self, rfile, content_length=None, chunked=False,
+                 connection=None, timeout=None):
+        """
+        Args:
+            rfile (file): Buffered stream positioned at the start of the body
+            content_length (int): Body length. Ignored for chunked bodies.
+            chunked (bool): True if the body uses chunked transfer encoding
+            connection (socket.socket): Socket underlying rfile. Required for
+                the timeout.
+            timeout (float): Seconds allowed for reading the whole body,
+                counted from the first read. Exceeding it raises
+                socket.timeout.
+        """
+        if content_length is not None and content_length < 0:
+            raise ValueError("Content length should be non-negative integer")
+        self._rfile = rfile
+        self.chunked = chunked
+        self.content_length = None if chunked else (content_length or 0)
+        self._connection = connection if timeout is not None else None
+        self._timeout = timeout
+        self._deadline = None
+        # Socket timeout restored after every read shortened it
+        self._connection_timeout = None if self._connection is None else \
+            self._connection.gettimeout()
+        # Bytes left in the current chunk, or in the whole body if not chunked
+        self._remaining = 0 if chunked else (content_length or 0)
+        self._eof = not chunked and self._remaining == 0
+        self.bytes_read = 0
+
+    def _check_deadline(self):
+        if self._connection is None:
+            return
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self._timeout
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Timed out reading request body")
+        self._connection.settimeout(remaining)
+
+    def _restore_timeout(self):
+        if self._connection is not None:
+            self._connection.settimeout(self._connection_timeout)
+
+    def _next_chunk(self):
+        line = self._rfile.readline(65537)
+        if not line:
+            raise ValueError("Connection closed while reading chunk size")
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Invalid chunk size line: {!r}".format(line))
+        if size < 0:
+            raise ValueError("Invalid chunk size line: {!r}".format(line))
+        if size == 0:
+            # Consume optional trailers up to the terminating empty line
+            while True:
+                line = self._rfile.readline(65537)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            self._eof = True
+        self._remaining = size
+
+    def _start_read(self):
+        """Positions the stream at body data. Returns False at end of body."""
+        while not self._eof and self._remaining == 0:
+            self._check_deadline()
+            self._next_chunk()
+        if self._eof:
+            return False
+        self._check_deadline()
+        return True
+
+    def _consumed(self, size):
+        if not size:
+            raise ValueError("Connection closed before end of request body")
+        self._remaining -= size
+        self.bytes_read += size
+        if self._remaining == 0:
+            if self.chunked:
+                self._rfile.readline(65537)
+            else:
+                self._eof = True
+
+    def _read_some(self, size):
+        """Reads at most size bytes. Returns b'' only at end of body."""
+        try:
+            if not self._start_read():
+                return b''
+            data = self._rfile.read(min(size, self._remaining))
+        finally:
+            self._restore_timeout()
+        self._consumed(len(data))
+        return data
+
+    def readinto(self, buffer):
+        """Reads body bytes directly into a writable buffer until it is full
+        or the body ends. Returns the number of bytes read.
+        """
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        try:
+            while filled < len(view) and self._start_read():
+                size = min(len(view) - filled, self._remaining)
+                read = self._rfile.readinto(view[filled:filled + size])
+                self._consumed(read)
+                filled += read
+        finally:
+            self._restore_timeout()
+        return filled
+
+    def read(self, size=-1):
+        """Reads up to size bytes of the body. Reads the remaining body if size
+        is negative. Returns b'' once the body is exhausted.
+        """
+        if size is not None and size >= 0:
+            chunks = []
+            while size > 0:
+                data = self._read_some(size)
+                if not data:
+                    break
+                chunks.append(data)
+                size -= len(data)
+            return b''.join(chunks)
+        return b''.join(self.iter_chunks())
+
+    def iter_chunks(self, chunk_size=65536):
+        """Yields the body in pieces of at most chunk_size bytes."""
+        while True:
+            data = self._read_some(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def at_eof(self):
+        return self._eof
+
+
+class _DeadlineSocketReader(io.RawIOBase):
+    """Raw stream reading a socket until a deadline.
+
+    While deadline is set, every receive waits at most until the deadline and
+    reading past it raises socket.timeout, so a client trickling bytes cannot
+    extend it. The socket timeout is restored after each receive.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.deadline = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.deadline is None:
+            return self._connection.recv_into(buffer)
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Timed out reading request headers")
+        timeout = self._connection.gettimeout()
+        self._connection.settimeout(remaining)
+        try:
+            return self._connection.recv_into(buffer)
+        finally:
+            self._connection.settimeout(timeout)
+
+
+class ChunkedResponseWriter(object):
+    """Writes a streamed HTTP response of unknown length.
+
+    The status line and headers are sent on construction. Every call to write
+    emits one chunk with Transfer-Encoding: chunked. HTTP/1.0 clients do not
+    understand chunked encoding, so for them the body is written as is and the
+    end of the response is marked by closing the connection.
+    The writer must be closed to terminate the response.
+
+    Usage:
+        with ChunkedResponseWriter(request_handler, http.HTTPStatus.OK) as w:
+            for piece in generate():
+                w.write(piece)
+    """
+
+    def __init__(self, http_request_handler, status=http.HTTPStatus.OK,
+                 headers=None):
+        self._request_handler = http_request_handler
+        self._chunked = http_request_handler.request_version >= 'HTTP/1.1'
+        self.closed = False
+        if self._chunked:
+            # Chunked framing requires an HTTP/1.1 status line
+            http_request_handler.protocol_version = 'HTTP/1.1'
+        http_request_handler.send_response(status)
+        for key, value in (headers or {}).items():
+            http_request_handler.send_header(key, value)
+        if self._chunked:
+            http_request_handler.send_header('Transfer-Encoding', 'chunked')
+        http_request_handler.send_header('Connection', 'close')
+        http_request_handler.end_headers()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("Write to a closed ChunkedResponseWriter")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data:
+            # An empty chunk would terminate the response
+            return
+        wfile = self._request_handler.wfile
+        if self._chunked:
+            wfile.write(b'%x\r\n' % len(data))
+            wfile.write(data)
+            wfile.write(b'\r\n')
+        else:
+            wfile.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self._chunked:
+                self._request_handler.wfile.write(b'0\r\n\r\n')
+            self._request_handler.wfile.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
 
 
 class StatelessHTTPHandler(abc.ABC):
@@ -66,15 +408,66 @@ class StatelessHTTPHandler(abc.ABC):
     BaseHTTPRequestHandler object that is handling the request on behalf of the
     HTTPServer.
     The handle method needs to be overridden by subclasses.
+
+    Request bodies can be consumed incrementally with get_body_reader and
+    responses can be streamed with start_chunked_response, so handlers do not
+    need to hold a whole body in memory.
     """
 
     def __init__(self, http_request_handler):
         self._request_handler = http_request_handler
+        self._body_reader = None
 
     @abc.abstractmethod
     def handle(self):
         pass
 
+    def get_body_reader(self):
+        """Returns the RequestBodyReader for the body of this request.
+
+        Raises:
+            ValueError: If the framing headers of the request are invalid
+        """
+        if self._body_reader is None:
+            headers = self._request_handler.headers
+            transfer_encoding = headers.get('Transfer-Encoding', '')
+            chunked = transfer_encoding.lower().strip().endswith('chunked')
+            content_length = None
+            if not chunked and headers.get('Content-Length') is not None:
+                try:
+                    content_length = int(headers['Content-Length'])
+                except ValueError:
+                    raise ValueError("Invalid Content-Length header")
+            self._body_reader = RequestBodyReader(
+                self._request_handler.rfile, content_length=content_length,
+                chunked=chunked, connection=self._request_handler.connection,
+                timeout=self._request_handler.server.body_timeout)
+        return self._body_reader
+
+    def read_body(self):
+        """Reads and returns the complete request body as bytes."""
+        return self.get_body_reader().read()
+
+    def start_chunked_response(self, status=http.HTTPStatus.OK, headers=None):
+        """Sends the response headers and returns a ChunkedResponseWriter for
+        streaming the response body.
+        """
+        return ChunkedResponseWriter(self._request_handler, status, headers)
+
+
+class MetricsHandler(StatelessHTTPHandler):
+    """Serves the server's HTTPServerMetrics in the Prometheus text format."""
+
+    def handle(self):
+        metrics = self._request_handler.server.metrics
+        body = bytes(metrics.render() if metrics else '', 'utf-8')
+        self._request_handler.send_response(http.HTTPStatus.OK)
+        self._request_handler.send_header('Content-Type',
+                                          HTTPServerMetrics.CONTENT_TYPE)
+        self._request_handler.send_header('Content-Length', len(body))
+        self._request_handler.end_headers()
+        self._request_handler.wfile.write(body)
+
 
 class HTTPRequestDispatcher(BaseHTTPRequestHandler):
     """Dispatches HTTP Request to the appropriate handler
@@ -82,26 +475,259 @@ class HTTPRequestDispatcher(BaseHTTPRequestHandler):
     Handlers are externally stored. This class acts as the RequestHandlerClass
     for the HTTPServer.
 
+    Handlers are matched on the request path without its query string.
+    If the server has metrics enabled, every dispatched request is recorded in
+    the server's HTTPServerMetrics under the route it was dispatched to.
+
+    Connections are persistent as per HTTP/1.1 if the server's keep_alive is
+    set. A connection is closed after a response without a Content-Length or
+    chunked encoding, since only closing it marks the end of such a body,
+    after a request whose body the handler did not read completely, and after
+    a request left unanswered. The unread rest of a body of up to
+    max_discarded_body_bytes is read and dropped first, so the connection can
+    stay open, and closing it does not reset it while the client still sends.
+
     Supported HTTP Methods: GET, POST, PUT
     """
 
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, which Nagle's algorithm would
+    # delay on a persistent connection until the client acknowledges
+    disable_nagle_algorithm = True
+    # Limits on reading and dropping the body a handler left unread
+    max_discarded_body_bytes = 64 * 1024
+    discard_timeout = 1.0
+
+    def setup(self):
+        # Applied by StreamRequestHandler.setup as the socket timeout
+        self.timeout = self.server.header_timeout
+        super().setup()
+        self._header_reader = None
+        if self.server.header_timeout is not None:
+            # The request line and headers must arrive by one deadline,
+            # however slowly the client sends them
+            self.rfile.close()
+            self._header_reader = _DeadlineSocketReader(self.connection)
+            self.rfile = io.BufferedReader(self._header_reader)
+        self.response_status = None
+        self._response_headers = set()
+        if self.server.metrics is not None:
+            self.rfile = CountingStream(self.rfile)
+            self.wfile = CountingStream(self.wfile)
+            self._bytes_in_mark = 0
+            self._bytes_out_mark = 0
+
+    def handle_one_request(self):
+        if self._header_reader is not None:
+            self._header_reader.deadline = time.monotonic() + \
+                self.server.header_timeout
+        super().handle_one_request()
+
+    def parse_request(self):
+        try:
+            return super().parse_request()
+        finally:
+            if self._header_reader is not None:
+                self._header_reader.deadline = None
+
+    def log_request(self, code='-', size='-'):
+        if self.server.log_requests:
+            super().log_request(code, size)
+
+    def send_response_only(self, code, message=None):
+        self.response_status = code
+        self._response_headers = set()
+        super().send_response_only(code, message)
+
+    def send_header(self, keyword, value):
+        if self.response_status is not None:
+            self._response_headers.add(keyword.lower())
+            if keyword.lower() == 'transfer-encoding' and \
+                    str(value).lower().strip().endswith('chunked'):
+                self._response_headers.add('chunked')
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        if self.response_status is not None and (
+                not self.server.keep_alive or not self.response_is_delimited()):
+            if 'connection' not in self._response_headers:
+                self.send_header('Connection', 'close')
+            self.close_connection = True
+        super().end_headers()
+
+    def response_is_delimited(self):
+        """Returns True if the client can find the end of the response being
+        sent without the connection being closed.
+        """
+        return 'content-length' in self._response_headers or \
+            'chunked' in self._response_headers or \
+            self.response_status < 200 or self.response_status in (
+                http.HTTPStatus.NO_CONTENT, http.HTTPStatus.NOT_MODIFIED)
+
     def get_handler(self, method):
-        return self.server.handler_registry.get_handler(method, self.path)
+        return self.server.handler_registry.get_handler(
+            method, self.get_request_path())
+
+    def send_retry_response(self, status, retry_after):
+        """Sends a body-less response asking the client to retry later and
+        closes the connection.
+        """
+        self.send_response(status)
+        self.send_header('Retry-After', max(1, math.ceil(retry_after)))
+        self.send_header('Content-Length', 0)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def run_handler(self, handler):
+        request_handler = handler(self)
+        try:
+            request_handler.handle()
+        except socket.timeout:
+            if self.response_status is None:
+                self.send_error(http.HTTPStatus.REQUEST_TIMEOUT)
+            self.close_connection = True
+            return
+        # The rest of an unread body would be taken for the next request
+        if self.has_request_body() and \
+                not self.discard_request_body(request_handler):
+            self.close_connection = True
+
+    def discard_request_body(self, request_handler):
+        """Reads and drops the rest of the request body that the handler did
+        not read, if it is at most max_discarded_body_bytes and arrives within
+        discard_timeout seconds.
+
+        Returns:
+            bool: True if the body was read to its end
+        """
+        try:
+            body_reader = request_handler.get_body_reader()
+        except ValueError:
+            return False
+        if body_reader.at_eof():
+            return True
+        if body_reader.content_length is not None and \
+                body_reader.content_length - body_reader.bytes_read > \
+                self.max_discarded_body_bytes:
+            return False
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(self.discard_timeout)
+        try:
+            discarded = 0
+            while discarded <= self.max_discarded_body_bytes:
+                data = body_reader.read(8192)
+                if not data:
+                    return True
+                discarded += len(data)
+            return False
+        except (OSError, ValueError):
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+    def has_request_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower().strip() \
+                .endswith('chunked'):
+            return True
+        try:
+            return int(self.headers.get('Content-Length', 0)) != 0
+        except ValueError:
+            return True
+
+    def get_request_path(self):
+        """Returns the request path without the query string."""
+        return self.path.split('?', 1)[0]
+
+    def get_request_query(self):
+        """Returns the query string parameters of the request as a dictionary
+        mapping names to lists of values.
+        """
+        return urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+
+    def run_cached_handler(self, handler, cache, policy):
+        """Serves a GET from the response cache, or runs the handler and
+        caches its response if it is a 200 and the cache was not invalidated
+        meanwhile.
+        """
+        key = policy.get_key(HTTPMethod.GET, self.path, self.headers)
+        response = cache.get(key)
+        if response is not None:
+            self.replay_response(response)
+            return
+        generation = cache.generation
+        wfile = self.wfile
+        self.wfile = RecordingStream(wfile, cache.max_entry_bytes)
+        try:
+            self.run_handler(handler)
+        finally:
+            recording, self.wfile = self.wfile, wfile
+        if self.response_status == http.HTTPStatus.OK and \
+                self.response_is_delimited() and not recording.overflowed:
+            cache.put(key, self.get_request_path(), recording.getvalue(),
+                      policy.ttl, generation)
+
+    def replay_response(self, response):
+        """Writes a cached raw response with a fresh Date header."""
+        head, separator, body = response.partition(b'\r\n\r\n')
+        lines = [line for line in head.split(b'\r\n')
+                 if not line.lower().startswith(b'date:')]
+        lines.append(b'Date: ' + self.date_time_string().encode('latin-1'))
+        if not self.server.keep_alive or \
+                b'connection: close' in head.lower():
+            self.close_connection = True
+        self.response_status = int(response[9:12])
+        self.wfile.write(b'\r\n'.join(lines) + separator + body)
+
+    def dispatch(self, method):
+        self.response_status = None
+        registry = self.server.handler_registry
+        route, handler = registry.resolve_handler(method,
+                                                  self.get_request_path())
+        metrics = self.server.metrics
+        if metrics is not None and not isinstance(self.wfile, CountingStream):
+            metrics = None
+        if metrics is not None:
+            start = metrics.request_started(method, route)
+        try:
+            retry_after = registry.acquire_rate_limit(method, route)
+            cache = self.server.response_cache
+            policy = None if cache is None else registry.get_cache_policy(
+                method, route)
+            if retry_after:
+                self.send_retry_response(
+                    http.HTTPStatus.TOO_MANY_REQUESTS, retry_after)
+            elif handler and policy:
+                self.run_cached_handler(handler, cache, policy)
+            elif handler:
+                self.run_handler(handler)
+                # A successful write makes cached reads of the path, of the
+                # collections above it and of the paths below it stale
+                if cache is not None and method != HTTPMethod.GET and \
+                        self.response_status is not None and \
+                        self.response_status < 400:
+                    cache.invalidate_tree(self.get_request_path())
+        finally:
+            if self.response_status is None:
+                # Closing the connection is the only answer the client gets
+                self.close_connection = True
+            if metrics is not None:
+                self.wfile.flush()
+                bytes_in = self.rfile.bytes_read - self._bytes_in_mark
+                bytes_out = self.wfile.bytes_written - self._bytes_out_mark
+                self._bytes_in_mark = self.rfile.bytes_read
+                self._bytes_out_mark = self.wfile.bytes_written
+                metrics.request_finished(method, route, start,
+                                         self.response_status, bytes_in,
+                                         bytes_out)
 
     def do_GET(self):
-        handler = self.get_handler(HTTPMethod.GET)
-        if handler:
-            handler(self).handle()
+        self.dispatch(HTTPMethod.GET)
 
     def do_POST(self):
-        handler = self.get_handler(HTTPMethod.POST)
-        if handler:
-            handler(self).handle()
+        self.dispatch(HTTPMethod.POST)
 
     def do_PATCH(self):
-        handler = self.get_handler(HTTPMethod.PATCH)
-        if handler:
-            handler(self).handle()
+        self.dispatch(HTTPMethod.PATCH)
 
 
 class MultiHandlerSingleThreadHTTPServer(HTTPServer):
@@ -115,10 +741,19 @@ class MultiHandlerSingleThreadHTTPServer(HTTPServer):
     See register_handler to register handlers for specific paths to this
     server.
     This server uses a http.HTTPServer which is single-threaded. That means it
-    must completely handle a request before it can handle another.
+    must completely handle a request before it can handle another. Use
+    header_timeout and body_timeout so a slow client cannot stall it, and
+    set_rate_limit to shed excess requests on expensive routes.
+    max_connections only takes effect with MultiHandlerThreadingHTTPServer.
     """
 
-    def __init__(self, host='', port=0):
+    # Serving one client for as long as it keeps its connection open would
+    # stall all the others, so connections are closed after every response
+    default_keep_alive = False
+
+    def __init__(self, host='', port=0, max_connections=None,
+                 header_timeout=None, body_timeout=None, request_queue_size=5,
+                 retry_after=1, log_requests=True, keep_alive=None):
         """
         Creates the HTTP Server which binds to the host and port passed.
 
@@ -126,16 +761,103 @@ class MultiHandlerSingleThreadHTTPServer(HTTPServer):
             host (string): Defaults to '' or localhost
             port (int): If nothing is passed, defaults to 0, assigns a random
                 port.
+            max_connections (int): Maximum number of connections handled at
+                once. Connections beyond it are answered with a 503 and
+                closed without being read. Defaults to no limit.
+            header_timeout (float): Seconds allowed for receiving the request
+                line and headers, counted from when the server starts
+                waiting for them. A client exceeding it is disconnected.
+                Defaults to no timeout.
+            body_timeout (float): Seconds allowed for reading a request body
+                through StatelessHTTPHandler.get_body_reader. A request
+                exceeding it is answered with a 408. Defaults to no timeout.
+            request_queue_size (int): Backlog of accepted but not yet handled
+                connections kept by the OS.
+            retry_after (int): Seconds sent in the Retry-After header of 503
+                responses.
+            log_requests (bool): Log every request to stderr. Errors are
+                always logged.
+            keep_alive (bool): Keep connections open for further requests.
+                Defaults to False, and to True for
+                MultiHandlerThreadingHTTPServer.
         """
         if host is None or not isinstance(host, str):
             raise ValueError("Host should be a string!")
         elif port < 0:
             raise ValueError("Port should be non-negative integer")
+        elif max_connections is not None and max_connections <= 0:
+            raise ValueError("Maximum connections should be a positive integer")
+        elif request_queue_size <= 0:
+            raise ValueError("Request queue size should be a positive integer")
+        for timeout in (header_timeout, body_timeout):
+            if timeout is not None and timeout <= 0:
+                raise ValueError("Timeouts should be positive numbers")
+
+        self.request_queue_size = request_queue_size
+        self.max_connections = max_connections
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.retry_after = retry_after
+        self.log_requests = log_requests
+        self.keep_alive = self.default_keep_alive if keep_alive is None \
+            else keep_alive
+        self.active_connections = 0
+        self.rejected_connections = 0
+        self._connections_lock = threading.Lock()
+        self._counted_requests = set()
 
         super().__init__((host, port), HTTPRequestDispatcher)
         self.handler_registry = HTTPHandlerRegistry()
         self.serving = False
         self.server_thread = None
+        self.metrics = None
+        self.metrics_path = None
+        self.response_cache = None
+
+    def verify_request(self, request, client_address):
+        # Runs on the serving thread before process_request, so connections
+        # are admitted or rejected here for both the single-threaded and the
+        # threading server.
+        with self._connections_lock:
+            overloaded = self.max_connections is not None and \
+                self.active_connections >= self.max_connections
+            if overloaded:
+                self.rejected_connections += 1
+            else:
+                self.active_connections += 1
+                self._counted_requests.add(id(request))
+        if overloaded:
+            self.reject_request(request)
+            return False
+        return super().verify_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            if id(request) in self._counted_requests:
+                self._counted_requests.discard(id(request))
+                self.active_connections -= 1
+        super().shutdown_request(request)
+
+    def reject_request(self, request):
+        """Answers a connection with a 503 without reading or dispatching
+        its request. The caller closes the connection.
+        """
+        # Best effort and never blocking, so a client that does not read
+        # cannot stall the serving thread
+        try:
+            request.setblocking(False)
+            try:
+                # Drain what has already arrived so closing does not reset
+                # the connection before the client reads the response
+                request.recv(65536)
+            except OSError:
+                pass
+            request.send(b'HTTP/1.0 503 Service Unavailable\r\n'
+                         b'Retry-After: %d\r\n'
+                         b'Content-Length: 0\r\n'
+                         b'Connection: close\r\n\r\n' % self.retry_after)
+        except OSError:
+            pass
 
     def start_serving_sync(self):
         if not self.serving:
@@ -175,6 +897,22 @@ class MultiHandlerSingleThreadHTTPServer(HTTPServer):
         """
         self.handler_registry.register_request_handler(method, path, handler)
 
+    def register_prefix_handler(self, method, prefix, handler):
+        """Registers a handler to the server for serving requests with the
+        passed method on every path starting with the prefix, unless a
+        handler is registered for the exact path or a longer prefix.
+
+        Overwrites any handler already attached with the (method, prefix) to
+        this server.
+
+        Args:
+            method (HTTPMethod): HTTP verb for the handler
+            prefix (string): Resource path prefix. eg: '/files/'
+            handler (StatelessHTTPHandler): Must implement the handle method
+        """
+        self.handler_registry.register_prefix_request_handler(
+            method, prefix, handler)
+
     def register_default_handler(self, method, handler):
         """Registers a default handler for responding to requests on paths for
         which there is no explicitly attached handler.
@@ -190,14 +928,126 @@ class MultiHandlerSingleThreadHTTPServer(HTTPServer):
     def deregister_handler(self, method, path):
         self.handler_registry.deregister_request_handler(method, path)
 
+    def deregister_prefix_handler(self, method, prefix):
+        self.handler_registry.deregister_prefix_request_handler(method, prefix)
+
     def deregister_default_handler(self, method):
         self.handler_registry.deregister_default_request_handler(method)
 
+    def set_rate_limit(self, method, path, rate, burst=None):
+        """Limits requests with the passed method on the route to `rate` per
+        second with bursts of up to `burst` requests, using a token bucket.
+        Requests over the limit are answered with a 429 and Retry-After.
+
+        The path is a registered handler path, or server.DEFAULT_ROUTE to limit
+        all requests served by the default handler.
+        """
+        self.handler_registry.register_rate_limit(method, path, rate, burst)
+
+    def remove_rate_limit(self, method, path):
+        self.handler_registry.deregister_rate_limit(method, path)
+
+    def enable_response_cache(self, max_bytes=16 * 1024 * 1024,
+                              max_entry_bytes=None):
+        """Enables the in-memory response cache of this server.
+
+        Only GET routes with a cache policy are cached, see set_cache_policy.
+        Only complete 200 responses are cached. They are replayed byte for
+        byte, headers included, except for a fresh Date header. A successful
+        non-GET request on a path invalidates the cached responses of that
+        path, of its ancestors and of the paths below it, eg: a PATCH on
+        /probes/a/b invalidates /probes/a/b, /probes/a and /probes.
+
+        Args:
+            max_bytes (int): Upper bound on the total size of cached responses
+            max_entry_bytes (int): Responses larger than this are not cached
+
+        Returns:
+            HTTPResponseCache: The cache of this server
+        """
+        if self.response_cache is None:
+            self.response_cache = HTTPResponseCache(max_bytes, max_entry_bytes)
+        return self.response_cache
+
+    def disable_response_cache(self):
+        self.response_cache = None
+
+    def set_cache_policy(self, path, ttl, vary_headers=()):
+        """Caches GET responses of the route for ttl seconds once the response
+        cache is enabled.
+
+        Responses are keyed by the request path, including the query string,
+        and by the values of the vary_headers request headers.
+
+        Args:
+            path (string): Registered handler path, or server.DEFAULT_ROUTE
+            ttl (float): Seconds a cached response stays fresh
+            vary_headers (list): Request header names that select the response
+        """
+        self.handler_registry.register_cache_policy(
+            path, CachePolicy(ttl, vary_headers))
+
+    def remove_cache_policy(self, path):
+        self.handler_registry.deregister_cache_policy(path)
+        self.invalidate_cache(path)
+
+    def invalidate_cache(self, path=None):
+        """Drops the cached responses of the path, or all cached responses if
+        no path is passed. Handlers and data owners call this when the data
+        behind a cached route changes.
+        """
+        if self.response_cache is not None:
+            self.response_cache.invalidate(path)
+
+    def enable_metrics(self, path='/metrics'):
+        """Starts recording per-route request metrics and serves them in the
+        Prometheus text format on a GET handler at the passed path.
+
+        Metrics are recorded for connections accepted after this call. Calling
+        it again keeps the recorded metrics and only moves the endpoint.
+
+        Args:
+            path (string): Path of the metrics endpoint. eg: '/metrics'
+
+        Returns:
+            HTTPServerMetrics: The metrics recorded by this server
+        """
+        if self.metrics is None:
+            self.metrics = HTTPServerMetrics()
+        if self.metrics_path is not None:
+            self.deregister_handler(HTTPMethod.GET, self.metrics_path)
+        self.metrics_path = path
+        self.register_handler(HTTPMethod.GET, path, MetricsHandler)
+        return self.metrics
+
+    def disable_metrics(self):
+        """Stops recording metrics and removes the metrics endpoint."""
+        if self.metrics_path is not None:
+            self.deregister_handler(HTTPMethod.GET, self.metrics_path)
+        self.metrics = None
+        self.metrics_path = None
+
     def __del__(self):
-        self.shutdown()
+        # Construction may have failed before the server was fully set up
+        if getattr(self, 'serving', False):
+            self.shutdown()
 
     def __exit__(self, exception_type, exception_value, traceback):
         self.shutdown()
 
     def __enter__(self):
         return self
+
+
+class MultiHandlerThreadingHTTPServer(ThreadingMixIn,
+                                      MultiHandlerSingleThreadHTTPServer):
+    """A MultiHandlerSingleThreadHTTPServer that handles every connection on
+    its own thread.
+
+    A slow request no longer blocks the others. Handlers and the data they
+    touch must be thread-safe. Use max_connections to bound the number of
+    handler threads. Connections are kept open between requests.
+    """
+
+    daemon_threads = True
+    default_keep_alive = True
@@ -1,3 +1,4 @@
 from .type import Singleton
 
-from .container import MutableVariable
+from .container import (MutableVariable, ProbeBlock, ProbeSlot,
+                        VersionedMutableVariable)
@@ -1,3 +1,14 @@
+import array
+import threading
+
+
+# Probe block dtype names and the array typecodes they are stored as
+_probe_block_typecodes = {
+    'int8': 'b', 'uint8': 'B', 'int16': 'h', 'uint16': 'H', 'int32': 'i',
+    'uint32': 'I', 'int64': 'q', 'uint64': 'Q', 'float32': 'f', 'float64': 'd',
+}
+
+
 class MutableVariable(object):
     """Container for any value that is meant to be edited at runtime from
     multiple sites
@@ -7,8 +18,15 @@ class MutableVariable(object):
 
     Example Use-Case: Used by Probe Resource to expose a mutable value to HTTP
     Server.
+
+    Callbacks subscribed with subscribe are called with the MutableVariable
+    after every set_value, on the thread that set the value. Changes made by
+    mutating the contained value in place are not noticed.
     """
 
+    # Instances only get their own list once something subscribes
+    _subscribers = None
+
     def __init__(self, value):
         self._value = value
 
@@ -17,6 +35,31 @@ class MutableVariable(object):
 
     def set_value(self, value):
         self._value = value
+        if self._subscribers:
+            for callback in list(self._subscribers):
+                callback(self)
+
+    def subscribe(self, callback):
+        """Calls callback(mutable_variable) after every set_value."""
+        if self._subscribers is None:
+            self._subscribers = []
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Removes a subscribed callback. Does nothing if it is not
+        subscribed.
+        """
+        if self._subscribers and callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def __getstate__(self):
+        # Subscribers belong to the local process and are not pickled
+        state = self.__dict__.copy()
+        state.pop('_subscribers', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
 
     def __len__(self):
         return len(self._value)
@@ -47,3 +90,241 @@ class MutableVariable(object):
 
     def __iter__(self):
         return self._value.__iter__()
+
+
+class VersionedMutableVariable(MutableVariable):
+    """MutableVariable whose changes are numbered and can be made atomically
+
+    The version starts at 0 and is incremented by every change made through
+    set_value, compare_and_set, update or increment. Changes are serialized by
+    a lock, while get_value stays a plain attribute read without locking. Use
+    get_versioned_value to read the value together with its version.
+
+    Subscribed callbacks are called after the change, outside of the lock.
+    Threads can also block until the next change with wait_for_change.
+    """
+
+    def __init__(self, value):
+        super().__init__(value)
+        self.version = 0
+        self._changed = threading.Condition()
+
+    def _set(self, value):
+        # Must be called holding self._changed
+        self._value = value
+        self.version += 1
+        self._changed.notify_all()
+
+    def _notify_subscribers(self):
+        if self._subscribers:
+            for callback in list(self._subscribers):
+                callback(self)
+
+    def get_version(self):
+        return self.version
+
+    def get_versioned_value(self):
+        """Returns a consistent (version, value) tuple."""
+        with self._changed:
+            return self.version, self._value
+
+    def set_value(self, value):
+        with self._changed:
+            self._set(value)
+        self._notify_subscribers()
+
+    def compare_and_set(self, expected_version, value):
+        """Sets the value only if the variable is still at expected_version.
+
+        Returns:
+            bool: True if the value was set
+        """
+        with self._changed:
+            if self.version != expected_version:
+                return False
+            self._set(value)
+        self._notify_subscribers()
+        return True
+
+    def update(self, function):
+        """Atomically replaces the value with function(value). The function
+        is called holding the lock and should not block.
+
+        Returns:
+            The new value
+        """
+        with self._changed:
+            value = function(self._value)
+            self._set(value)
+        self._notify_subscribers()
+        return value
+
+    def increment(self, amount=1):
+        """Atomically adds amount to the value and returns the new value."""
+        return self.update(lambda value: value + amount)
+
+    def wait_for_change(self, since_version, timeout=None):
+        """Blocks until the version differs from since_version or the timeout
+        in seconds passes.
+
+        Returns:
+            tuple: The current (version, value)
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != since_version,
+                                   timeout)
+            return self.version, self._value
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_changed', None)
+        state.pop('version', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.version = 0
+        self._changed = threading.Condition()
+
+
+class ProbeSlot(object):
+    """Accessor of a single value of a ProbeBlock, see ProbeBlock.slot"""
+
+    __slots__ = ('block', 'index')
+
+    def __init__(self, block, index):
+        self.block = block
+        self.index = index
+
+    def get_value(self):
+        return self.block.buffer[self.index]
+
+    def set_value(self, value):
+        self.block.buffer[self.index] = value
+        if self.block._subscribers:
+            self.block.notify()
+
+
+class ProbeBlock(MutableVariable):
+    """Block of labelled numeric probes of one dtype stored in a single
+    contiguous array.array buffer
+
+    A block is added to a ProbeResource as one probe. Its value is a
+    dictionary mapping the block labels to numbers, and set_value accepts
+    such a dictionary, with any subset of the labels, or a sequence of all
+    values in label order. The whole block is serialized with one copy of the
+    buffer, see tobytes. Like its value, the block itself behaves as a
+    mapping of labels to numbers: it iterates over and counts its labels and
+    compares equal to a dictionary of its values. Blocks are not ordered.
+
+    Hot loops should read and write values through ProbeSlot accessors from
+    slot, which skip the label lookup. Setting a value through set, a slot
+    or set_value notifies subscribers. Writing to buffer directly does not;
+    call notify afterwards to publish such changes.
+    """
+
+    def __init__(self, dtype, labels, values=None):
+        """
+        Args:
+            dtype (str): One of int8, uint8, int16, uint16, int32, uint32,
+                int64, uint64, float32 or float64
+            labels (list): Labels of the values, in buffer order
+            values: Optional initial values, see set_value. Defaults to zeros.
+
+        Raises:
+            ValueError: If the dtype is not supported or labels repeat
+        """
+        if dtype not in _probe_block_typecodes:
+            raise ValueError("Unsupported probe block dtype: " + str(dtype))
+        self.dtype = dtype
+        self.typecode = _probe_block_typecodes[dtype]
+        self.labels = tuple(labels)
+        self.indices = {label: index for index, label in enumerate(self.labels)}
+        if len(self.indices) != len(self.labels):
+            raise ValueError("Probe block labels should be unique")
+        self.buffer = array.array(self.typecode, bytes(
+            array.array(self.typecode).itemsize * len(self.labels)))
+        self._value = self.buffer
+        if values is not None:
+            self._assign(values)
+
+    def _assign(self, values):
+        # Converts every value before writing any, so invalid values leave
+        # the block unchanged
+        if isinstance(values, dict):
+            unknown = [label for label in values if label not in self.indices]
+            if unknown:
+                raise ValueError("Unknown probe block labels: " +
+                                 ', '.join(str(label) for label in unknown))
+            converted = array.array(self.typecode, values.values())
+            for label, value in zip(values, converted):
+                self.buffer[self.indices[label]] = value
+        else:
+            converted = array.array(self.typecode, values)
+            if len(converted) != len(self.buffer):
+                raise ValueError("Expected {} probe block values, got {}".format(
+                    len(self.buffer), len(converted)))
+            self.buffer[:] = converted
+
+    def get_value(self):
+        return dict(zip(self.labels, self.buffer.tolist()))
+
+    def set_value(self, value):
+        self._assign(value)
+        self.notify()
+
+    def notify(self):
+        """Calls the subscribed callbacks, eg: after writing to buffer."""
+        if self._subscribers:
+            for callback in list(self._subscribers):
+                callback(self)
+
+    def get(self, label):
+        return self.buffer[self.indices[label]]
+
+    def set(self, label, value):
+        self.buffer[self.indices[label]] = value
+        if self._subscribers:
+            self.notify()
+
+    def slot(self, label):
+        """Returns a ProbeSlot accessor of the value with the label."""
+        return ProbeSlot(self, self.indices[label])
+
+    def tobytes(self):
+        """Returns a copy of the raw buffer in native byte order."""
+        return self.buffer.tobytes()
+
+    def tolist(self):
+        return self.buffer.tolist()
+
+    def __getitem__(self, label):
+        return self.get(label)
+
+    def __setitem__(self, label, value):
+        self.set(label, value)
+
+    def __contains__(self, label):
+        return label in self.indices
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __reversed__(self):
+        return reversed(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __eq__(self, other):
+        if isinstance(other, ProbeBlock):
+            other = other.get_value()
+        return self.get_value() == other
+
+    def __lt__(self, other):
+        return NotImplemented
+
+    __gt__ = __le__ = __ge__ = __lt__
+
+    def __bool__(self):
+        return len(self.buffer) > 0
@@ -1,7 +1,11 @@
 import multiprocessing
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 from omnilib import compute as c
+from omnilib.compute import cpu
 
 
 class TestMRJob(unittest.TestCase):
@@ -39,6 +43,11 @@ class TestMRJob(unittest.TestCase):
         inputs = c.MRJobInput().add_input(
             [1, 2]).add_input([2, 3]).add_input([3, 4])
         self.assertEqual(job.run(inputs), 15)
+        # The external pool outlives the job
+        del job
+        self.assertEqual(external_pool.apply(abs, (-1,)), 1)
+        external_pool.close()
+        external_pool.join()
 
     def test_mrjobinput_add_input(self):
         inputs = [1, 2, 3, 4, 5]
@@ -73,6 +82,100 @@ class TestMRJob(unittest.TestCase):
 
         self.assertTrue(result_tuple[0] == inputs)
 
+    def test_default_num_processes(self):
+        def map(num):
+            return num
+
+        job = c.MRJob(map_fn=map, reduce_fn=sum)
+        self.assertEqual(job.num_processes, c.get_effective_cpu_count())
+        self.assertEqual(job.run([1, 2, 3]), 6)
+
+    def test_oversubscription_warning(self):
+        def map(num):
+            return num
+
+        with self.assertWarns(RuntimeWarning):
+            job = c.MRJob(num_processes=c.get_effective_cpu_count() + 1,
+                          map_fn=map, reduce_fn=sum)
+        self.assertEqual(job.run([1, 2]), 3)
+
+    @unittest.skipUnless(hasattr(os, 'sched_setaffinity'), "Linux only")
+    def test_cpu_affinity(self):
+        def map(num):
+            return sorted(os.sched_getaffinity(0))
+
+        def reduce(arr):
+            return arr
+
+        available = cpu.get_available_cpus()
+        job = c.MRJob(num_processes=1, map_fn=map, reduce_fn=reduce,
+                      cpu_affinity=c.CPU_AFFINITY_CORE)
+        self.assertEqual(job.run([1, 2]), [available[:1]] * 2)
+        job = c.MRJob(num_processes=1, map_fn=map, reduce_fn=reduce,
+                      cpu_affinity=c.CPU_AFFINITY_NUMA)
+        self.assertEqual(job.run([1])[0], cpu.get_numa_cpu_sets()[0])
+        with self.assertRaises(ValueError):
+            c.MRJob(num_processes=1, map_fn=map, reduce_fn=reduce,
+                    cpu_affinity='socket')
+
+
+class TestCPU(unittest.TestCase):
+    def write(self, root, path, content):
+        filename = os.path.join(root, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(content)
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(cpu.parse_cpu_list('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(cpu.parse_cpu_list(''), [])
+
+    def test_cgroup_v2_limit(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.write(root, 'proc_cgroup', '0::/jobs/worker\n')
+            proc_cgroup = os.path.join(root, 'proc_cgroup')
+            self.write(root, 'cgroup/cpu.max', 'max 100000\n')
+            self.assertIsNone(cpu.get_cgroup_cpu_limit(
+                os.path.join(root, 'cgroup'), proc_cgroup))
+            self.write(root, 'cgroup/jobs/cpu.max', '400000 100000\n')
+            self.write(root, 'cgroup/jobs/worker/cpu.max', '250000 100000\n')
+            self.assertEqual(cpu.get_cgroup_cpu_limit(
+                os.path.join(root, 'cgroup'), proc_cgroup), 2.5)
+
+    def test_cgroup_v1_limit(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.write(root, 'proc_cgroup', '3:cpu,cpuacct:/docker/abc\n')
+            proc_cgroup = os.path.join(root, 'proc_cgroup')
+            self.write(root, 'cgroup/cpu/cpu.cfs_quota_us', '-1\n')
+            self.write(root, 'cgroup/cpu/cpu.cfs_period_us', '100000\n')
+            self.assertIsNone(cpu.get_cgroup_cpu_limit(
+                os.path.join(root, 'cgroup'), proc_cgroup))
+            # The container's own cgroup is mounted at the root
+            self.write(root, 'cgroup/cpu/cpu.cfs_quota_us', '800000\n')
+            self.assertEqual(cpu.get_cgroup_cpu_limit(
+                os.path.join(root, 'cgroup'), proc_cgroup), 8)
+
+    def test_effective_cpu_count(self):
+        count = cpu.get_effective_cpu_count()
+        self.assertGreaterEqual(count, 1)
+        self.assertLessEqual(count, len(cpu.get_available_cpus()))
+
+    def test_numa_cpu_sets(self):
+        available = cpu.get_available_cpus()
+        with tempfile.TemporaryDirectory() as root:
+            self.assertEqual(cpu.get_numa_cpu_sets(root), [available])
+            self.write(root, 'node0/cpulist', '0-{}\n'.format(max(available)))
+            self.write(root, 'node1/cpulist', '{}\n'.format(max(available) + 1))
+            self.assertEqual(cpu.get_numa_cpu_sets(root), [available])
+
+    def test_numa_node_order(self):
+        with tempfile.TemporaryDirectory() as root, mock.patch.object(
+                cpu, 'get_available_cpus', return_value=[0, 1, 2, 3]):
+            self.write(root, 'node10/cpulist', '2-3\n')
+            self.write(root, 'node2/cpulist', '0-1\n')
+            self.write(root, 'node_info/cpulist', '0-3\n')
+            self.assertEqual(cpu.get_numa_cpu_sets(root), [[0, 1], [2, 3]])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,62 @@
+import errno
 import http
+import io
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 import unittest
+from unittest import mock
 
 import jsonpickle
+import numpy
+import omnilib
 from omnilib import http as h
+from omnilib.http import loadtest
 from omnilib import util
 
 
+def send_request(host, port, method, path, body=None, headers={}):
+    """Sends a request on a new connection and returns the response and its
+    content.
+    """
+    connection = http.client.HTTPConnection(host, port)
+    connection.request(method.name, path, body=body, headers=headers)
+    response = connection.getresponse()
+    content = response.read()
+    connection.close()
+    return response, content
+
+
+class ProbeServerTestCase(unittest.TestCase):
+    """Serves the Probe Resources returned by create_probers on a server
+    started for every test.
+    """
+
+    server_class = h.MultiHandlerSingleThreadHTTPServer
+
+    def setUp(self):
+        self.server = self.server_class(log_requests=False)
+        self.host, self.port = self.server.server_address
+        for prober in self.create_probers():
+            h.export_probe_resource_to_server(self.server, prober)
+        self.server.start_serving_async()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def create_probers(self):
+        return []
+
+    def request(self, method, path, body=None, headers={}):
+        return send_request(self.host, self.port, method, path, body, headers)
+
+
 class TestProbeResource(unittest.TestCase):
     def test_prober(self):
         prober_path = 'prober'
@@ -65,6 +115,74 @@ class TestProbeResource(unittest.TestCase):
         self.assertDictEqual(prober.get_probe_values(), {
                              'int_var': int_var, 'bool_var': bool_var})
 
+    def test_encoded_probe_descriptions(self):
+        prober = h.ProbeResource('prober')
+        prober.add_probe('int_var', util.MutableVariable(1), desc='First')
+        encoded = prober.get_encoded_probe_descriptions()
+        self.assertIs(prober.get_encoded_probe_descriptions(), encoded)
+        self.assertEqual(jsonpickle.decode(encoded), {'int_var': 'First'})
+
+        prober.add_probe('bool_var', util.MutableVariable(True), desc='Second')
+        self.assertEqual(jsonpickle.decode(prober.get_encoded_probe_descriptions()),
+                         {'int_var': 'First', 'bool_var': 'Second'})
+
+    def test_encoded_probe_values(self):
+        prober = h.ProbeResource('prober')
+        int_var = util.MutableVariable(1)
+        list_var = util.MutableVariable([1, 2])
+        prober.add_probe('int_var', int_var)
+        prober.add_probe('list_var', list_var)
+
+        decoded = jsonpickle.decode(prober.get_encoded_probe_values())
+        self.assertEqual(decoded['int_var'].get_value(), 1)
+        self.assertEqual(decoded['list_var'].get_value(), [1, 2])
+
+        int_var.set_value(2)
+        list_var.get_value().append(3)
+        decoded = jsonpickle.decode(prober.get_encoded_probe_values())
+        self.assertEqual(decoded['int_var'].get_value(), 2)
+        self.assertEqual(decoded['list_var'].get_value(), [1, 2, 3])
+
+        # An equal value of another type is encoded again
+        int_var.set_value(2.0)
+        self.assertIn('2.0', prober.get_encoded_probe_values())
+
+    def test_encoded_versioned_probe_values(self):
+        prober = h.ProbeResource('prober')
+        list_var = util.VersionedMutableVariable([1, 2])
+        prober.add_probe('list_var', list_var)
+        encoded = prober.get_encoded_probe_values()
+        decoded = jsonpickle.decode(encoded)
+        self.assertIsInstance(decoded['list_var'], util.VersionedMutableVariable)
+        self.assertEqual(decoded['list_var'].get_value(), [1, 2])
+
+        # The encoding follows the version, not in place changes
+        list_var.get_value().append(3)
+        self.assertEqual(prober.get_encoded_probe_values(), encoded)
+        version = prober.version
+        list_var.update(lambda value: value + [4])
+        self.assertEqual(prober.version, version + 1)
+        decoded = jsonpickle.decode(prober.get_encoded_probe_values())
+        self.assertEqual(decoded['list_var'].get_value(), [1, 2, 3, 4])
+
+
+class TestTemplateCache(unittest.TestCase):
+    def test_template_reload_on_change(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'template.html')
+            with open(filename, 'w') as f:
+                f.write('Hello ${name}')
+            template = h.probe.TemplateCache().get_template(filename)
+            self.assertIs(h.probe.TemplateCache().get_template(filename), template)
+            self.assertEqual(template.render(name='World'), 'Hello World')
+
+            with open(filename, 'w') as f:
+                f.write('Bye ${name}')
+            stat = os.stat(filename)
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            template = h.probe.TemplateCache().get_template(filename)
+            self.assertEqual(template.render(name='World'), 'Bye World')
+
 
 class TestProbeResourceHandlers(unittest.TestCase):
     def test_patch_handler(self):
@@ -116,6 +234,22 @@ class TestProbeResourceHandlers(unittest.TestCase):
             # Close connection
             connection.close()
 
+    def test_patch_handler_without_body(self):
+        with h.MultiHandlerSingleThreadHTTPServer() as server:
+            host, port = server.server_address
+            prober = h.ProbeResource('/vars')
+            prober.add_probe('int_var', util.MutableVariable(123))
+            h.export_probe_resource_to_server(server, prober)
+            server.start_serving_async()
+
+            connection = http.client.HTTPConnection(host, port)
+            connection.putrequest(h.HTTPMethod.PATCH.name, "/probes/vars")
+            connection.endheaders()
+            response = connection.getresponse()
+            self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+            self.assertEqual(prober.get_probe_value('int_var'), 123)
+            connection.close()
+
     def test_get_handler(self):
         with h.MultiHandlerSingleThreadHTTPServer() as server:
             host, port = server.server_address
@@ -172,6 +306,928 @@ class TestProbeResourceHandlers(unittest.TestCase):
             connection.close()
 
 
+class TestProbeJSONAPI(ProbeServerTestCase):
+    def create_probers(self):
+        self.int_var = util.MutableVariable(123)
+        self.list_var = util.MutableVariable([1, 2, 3])
+        self.string_var = util.MutableVariable('Test')
+        self.prober = h.ProbeResource('/nested/vars')
+        self.prober.add_probe('int_var', self.int_var)
+        self.prober.add_probe('list_var', self.list_var)
+        self.prober.add_probe('string var', self.string_var)
+        return [self.prober]
+
+    def test_get_probe(self):
+        response, content = self.request(h.HTTPMethod.GET, "/probes/nested/vars/int_var")
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(response.getheader('Content-Type'), 'application/json')
+        self.assertEqual(json.loads(content), 123)
+        response, content = self.request(h.HTTPMethod.GET, "/probes/nested/vars/string%20var")
+        self.assertEqual(json.loads(content), 'Test')
+
+    def test_get_unknown_probe(self):
+        response, _ = self.request(h.HTTPMethod.GET, "/probes/nested/vars/unknown")
+        self.assertEqual(response.status, http.HTTPStatus.NOT_FOUND)
+        response, _ = self.request(h.HTTPMethod.GET, "/probes/unknown/int_var")
+        self.assertEqual(response.status, http.HTTPStatus.NOT_FOUND)
+
+    def test_get_bulk(self):
+        response, content = self.request(h.HTTPMethod.GET, "/probes/nested/vars?format=json")
+        self.assertEqual(json.loads(content), {'int_var': 123, 'list_var': [1, 2, 3],
+                                               'string var': 'Test'})
+        response, content = self.request(h.HTTPMethod.GET,
+                                         "/probes/nested/vars?fields=int_var,list_var")
+        self.assertEqual(json.loads(content), {'int_var': 123, 'list_var': [1, 2, 3]})
+        response, content = self.request(h.HTTPMethod.GET, "/probes/nested/vars",
+                                         headers={'Accept': 'application/json'})
+        self.assertEqual(len(json.loads(content)), 3)
+        response, _ = self.request(h.HTTPMethod.GET, "/probes/nested/vars?fields=unknown")
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+
+    def test_get_html(self):
+        response, content = self.request(h.HTTPMethod.GET, "/probes/nested/vars",
+                                         headers={'Accept': 'text/html,application/json'})
+        self.assertTrue(content.lstrip().startswith(b'<!doctype html>'))
+
+    def test_patch_probe(self):
+        response, content = self.request(h.HTTPMethod.PATCH, "/probes/nested/vars/list_var",
+                                         body=b'[4, 5]')
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(self.list_var.get_value(), [4, 5])
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/nested/vars/int_var",
+                                   body=b'not json')
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/nested/vars/unknown",
+                                   body=b'1')
+        self.assertEqual(response.status, http.HTTPStatus.NOT_FOUND)
+
+    def test_patch_bulk(self):
+        headers = {'Content-Type': 'application/json'}
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/nested/vars",
+                                   body=b'{"int_var": 7, "string var": "New"}',
+                                   headers=headers)
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(self.int_var.get_value(), 7)
+        self.assertEqual(self.string_var.get_value(), 'New')
+
+        # Nothing is updated if any label is unknown
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/nested/vars",
+                                   body=b'{"int_var": 8, "unknown": 1}', headers=headers)
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+        self.assertEqual(self.int_var.get_value(), 7)
+
+
+class TestProbeArrays(ProbeServerTestCase):
+    def create_probers(self):
+        self.array = numpy.arange(24, dtype=numpy.float64).reshape(4, 6)
+        self.array_var = util.MutableVariable(self.array)
+        self.list_var = util.MutableVariable([0, 1, 2, 3])
+        self.prober = h.ProbeResource('/arrays')
+        self.prober.add_probe('array', self.array_var)
+        self.prober.add_probe('list', self.list_var)
+        return [self.prober]
+
+    def test_get_binary(self):
+        response, content = self.request(h.HTTPMethod.GET, "/probes/arrays/array",
+                                         headers={'Accept': 'application/octet-stream'})
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        dtype = numpy.dtype(response.getheader('X-Omnilib-Dtype'))
+        shape = tuple(int(v) for v in response.getheader('X-Omnilib-Shape').split(','))
+        numpy.testing.assert_array_equal(
+            numpy.frombuffer(content, dtype=dtype).reshape(shape), self.array)
+
+    def test_get_binary_slice(self):
+        response, content = self.request(h.HTTPMethod.GET, "/probes/arrays/array?slice=1:3,::2",
+                                         headers={'Accept': 'application/octet-stream'})
+        self.assertEqual(response.getheader('X-Omnilib-Shape'), '2,3')
+        numpy.testing.assert_array_equal(
+            numpy.frombuffer(content, dtype=numpy.float64).reshape(2, 3), self.array[1:3, ::2])
+
+    def test_get_json_slice(self):
+        _, content = self.request(h.HTTPMethod.GET, "/probes/arrays/array?slice=0,-2:")
+        self.assertEqual(json.loads(content), [4.0, 5.0])
+        _, content = self.request(h.HTTPMethod.GET, "/probes/arrays/list?slice=1:3")
+        self.assertEqual(json.loads(content), [1, 2])
+        response, _ = self.request(h.HTTPMethod.GET, "/probes/arrays/list?slice=a:b")
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+        response, _ = self.request(h.HTTPMethod.GET, "/probes/arrays/list",
+                                   headers={'Accept': 'application/octet-stream'})
+        self.assertEqual(response.status, http.HTTPStatus.NOT_ACCEPTABLE)
+
+    def test_patch_json_slice(self):
+        version = self.prober.version
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/array?slice=0,0:3",
+                                   body=b'[-1, -2, -3]')
+        self.assertEqual(response.status, http.HTTPStatus.NO_CONTENT)
+        self.assertIs(self.array_var.get_value(), self.array)
+        numpy.testing.assert_array_equal(self.array[0, :4], [-1, -2, -3, 3])
+        self.assertEqual(self.prober.get_changes(version), (version + 1, ['array']))
+
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/list?slice=::2",
+                                   body=b'[9, 9]')
+        self.assertEqual(self.list_var.get_value(), [9, 1, 9, 3])
+
+    def test_patch_binary_slice(self):
+        body = numpy.array([[100, 101], [102, 103]], dtype=numpy.float64).tobytes()
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/array?slice=2:,4:",
+                                   body=body, headers={'Content-Type': 'application/octet-stream'})
+        self.assertEqual(response.status, http.HTTPStatus.NO_CONTENT)
+        numpy.testing.assert_array_equal(self.array[2:, 4:], [[100, 101], [102, 103]])
+
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/array?slice=2:,4:",
+                                   body=body[:-1],
+                                   headers={'Content-Type': 'application/octet-stream'})
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+
+    def test_patch_binary_size_checked_before_allocating(self):
+        headers = {'Content-Type': 'application/octet-stream',
+                   'X-Omnilib-Dtype': '<f8', 'X-Omnilib-Shape': '100000000000000'}
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/array",
+                                   body=b'x' * 8, headers=headers)
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+
+        # A chunked body is only checked against the cap
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/array",
+                                   body=iter([b'x' * 8]), headers=headers)
+        self.assertEqual(response.status, http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        headers['X-Omnilib-Shape'] = '1'
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/array",
+                                   body=iter([numpy.float64(5).tobytes()]),
+                                   headers=headers)
+        self.assertEqual(response.status, http.HTTPStatus.NO_CONTENT)
+        numpy.testing.assert_array_equal(self.array_var.get_value(), [5.0])
+
+    def test_patch_binary_whole(self):
+        new_array = numpy.arange(3, dtype=numpy.int32)
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/arrays/array",
+                                   body=new_array.tobytes(),
+                                   headers={'Content-Type': 'application/octet-stream',
+                                            'X-Omnilib-Dtype': '<i4', 'X-Omnilib-Shape': '3'})
+        self.assertEqual(response.status, http.HTTPStatus.NO_CONTENT)
+        numpy.testing.assert_array_equal(self.array_var.get_value(), new_array)
+        self.assertEqual(self.array_var.get_value().dtype, numpy.int32)
+
+
+class TestProbeBlocks(ProbeServerTestCase):
+    def create_probers(self):
+        self.block = util.ProbeBlock('float64', ['rate', 'limit', 'scale'],
+                                     [0.5, 10, 2])
+        self.prober = h.ProbeResource('/knobs')
+        self.prober.add_probe('block', self.block)
+        return [self.prober]
+
+    def test_get(self):
+        _, content = self.request(h.HTTPMethod.GET, "/probes/knobs/block")
+        self.assertEqual(json.loads(content), {'rate': 0.5, 'limit': 10.0, 'scale': 2.0})
+        _, content = self.request(h.HTTPMethod.GET, "/probes/knobs/block?slice=1:")
+        self.assertEqual(json.loads(content), [10.0, 2.0])
+        response, content = self.request(h.HTTPMethod.GET, "/probes/knobs/block",
+                                         headers={'Accept': 'application/octet-stream'})
+        self.assertEqual(response.getheader('X-Omnilib-Shape'), '3')
+        self.assertEqual(content, self.block.tobytes())
+
+    def test_patch(self):
+        version = self.prober.version
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/knobs/block",
+                                   body=b'{"limit": 20}')
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(self.block.tolist(), [0.5, 20.0, 2.0])
+        self.assertEqual(self.prober.get_changes(version), (version + 1, ['block']))
+
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/knobs/block?slice=::2",
+                                   body=b'[1, 3]')
+        self.assertEqual(response.status, http.HTTPStatus.NO_CONTENT)
+        self.assertEqual(self.block.tolist(), [1.0, 20.0, 3.0])
+
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/knobs/block",
+                                   body=numpy.array([4, 5, 6], dtype=numpy.float64).tobytes(),
+                                   headers={'Content-Type': 'application/octet-stream'})
+        self.assertEqual(response.status, http.HTTPStatus.NO_CONTENT)
+        self.assertEqual(self.block.tolist(), [4.0, 5.0, 6.0])
+        self.assertEqual(self.prober.get_changes(version)[0], version + 3)
+
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/knobs/block",
+                                   body=b'{"unknown": 1}')
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+        self.assertEqual(self.block.tolist(), [4.0, 5.0, 6.0])
+
+    def test_jsonpickle_roundtrip(self):
+        self.block.set('rate', 0.25)
+        decoded = jsonpickle.decode(self.prober.get_encoded_probe_values())['block']
+        self.assertIsInstance(decoded, util.ProbeBlock)
+        self.assertEqual(decoded.dtype, 'float64')
+        self.assertEqual(decoded.get_value(), {'rate': 0.25, 'limit': 10.0, 'scale': 2.0})
+
+        decoded.set('scale', 4)
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/knobs",
+                                   body=jsonpickle.encode({'block': decoded}))
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(self.block.get('scale'), 4.0)
+
+
+class TestProbeHistory(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.history = h.ProbeHistory(raw_capacity=4, second_capacity=3,
+                                      minute_capacity=2, clock=lambda: self.now)
+
+    def test_raw_ring(self):
+        for index in range(6):
+            self.assertTrue(self.history.record(index, timestamp=990.0 + index))
+        self.assertFalse(self.history.record([1, 2]))
+        for value in ('1.5', float('nan'), float('inf'), 10 ** 400):
+            self.assertFalse(self.history.record(value))
+        self.assertEqual(self.history.get_range(),
+                         {'resolution': 'raw', 't': [992.0, 993.0, 994.0, 995.0],
+                          'v': [2.0, 3.0, 4.0, 5.0]})
+        self.assertEqual(self.history.get_range(start=993, end=-6)['v'], [3.0, 4.0])
+        with self.assertRaises(ValueError):
+            self.history.get_range('1h')
+
+    def test_downsampling(self):
+        for timestamp, value in [(10.0, 1), (10.5, 3), (11.2, 2), (12.0, 5),
+                                 (13.9, 4), (70.0, 6)]:
+            self.history.record(value, timestamp=timestamp)
+        seconds = self.history.get_range('1s')
+        # Only the last 3 completed buckets and the current one are kept
+        self.assertEqual(seconds['t'], [11.0, 12.0, 13.0, 70.0])
+        self.assertEqual(seconds['count'], [1, 1, 1, 1])
+        minutes = self.history.get_range('1m', start=1, end=59.9)
+        self.assertEqual(minutes, {'resolution': '1m', 't': [0.0], 'count': [5],
+                                   'min': [1.0], 'max': [5.0], 'mean': [3.0]})
+        self.assertEqual(self.history.get_range('1s', start=12.2, end=12.4)['mean'], [5.0])
+
+    def test_probe_resource_history(self):
+        prober = h.ProbeResource('/history')
+        int_var = util.MutableVariable(1)
+        prober.add_probe('int_var', int_var)
+        with self.assertRaises(ValueError):
+            prober.enable_history('unknown')
+        history = prober.enable_history('int_var')
+        self.assertIs(prober.enable_history('int_var'), history)
+        int_var.set_value(2)
+        prober.update_probe_values({'int_var': 3})
+        self.assertEqual(history.get_range()['v'], [1.0, 2.0, 3.0])
+        prober.disable_history('int_var')
+        int_var.set_value(4)
+        self.assertIsNone(prober.get_probe_history('int_var'))
+        self.assertEqual(history.get_range()['v'], [1.0, 2.0, 3.0])
+
+    def test_history_endpoint(self):
+        server = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        prober = h.ProbeResource('/history')
+        int_var = util.MutableVariable(1)
+        prober.add_probe('int_var', int_var)
+        prober.add_probe('other_var', util.MutableVariable(1))
+        prober.enable_history('int_var')
+        int_var.set_value(2)
+        h.export_probe_resource_to_server(server, prober)
+        server.start_serving_async()
+        try:
+            def get(path):
+                response, content = send_request(
+                    *server.server_address, h.HTTPMethod.GET, path)
+                return response.status, json.loads(content)
+
+            status, content = get('/probes/history/int_var?history=raw&start=-60')
+            self.assertEqual(status, http.HTTPStatus.OK)
+            self.assertEqual(content['v'], [1.0, 2.0])
+            status, content = get('/probes/history/int_var?history=1m')
+            self.assertEqual(sum(content['count']), 2)
+            status, _ = get('/probes/history/int_var?history=1h')
+            self.assertEqual(status, http.HTTPStatus.BAD_REQUEST)
+            status, _ = get('/probes/history/int_var?history=raw&start=x')
+            self.assertEqual(status, http.HTTPStatus.BAD_REQUEST)
+            status, _ = get('/probes/history/other_var?history=raw')
+            self.assertEqual(status, http.HTTPStatus.NOT_FOUND)
+        finally:
+            server.shutdown()
+
+
+class TestProbeIndex(ProbeServerTestCase):
+    def create_probers(self):
+        self.probers = {}
+        for path in ['workers/3', 'workers/1', 'workers/2', 'db', 'workersx']:
+            prober = h.ProbeResource(path, desc=path + ' probes')
+            prober.add_probe('count', util.MutableVariable(0))
+            if path.startswith('workers/'):
+                prober.add_probe('queue', util.MutableVariable([]))
+            self.probers[path] = prober
+        return list(self.probers.values())
+
+    def get(self, path):
+        response, content = self.request(h.HTTPMethod.GET, path)
+        return response, json.loads(content)
+
+    def get_paths(self, content):
+        return [resource['path'] for resource in content['resources']]
+
+    def test_list(self):
+        response, content = self.get('/probes')
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(self.get_paths(content),
+                         ['db', 'workers/1', 'workers/2', 'workers/3', 'workersx'])
+        self.assertEqual(content['total'], 5)
+        self.assertIsNone(content['next'])
+        self.assertEqual(content['resources'][0],
+                         {'path': 'db', 'desc': 'db probes', 'labels': ['count']})
+
+    def test_pagination_and_filters(self):
+        _, content = self.get('/probes?prefix=workers/&limit=2')
+        self.assertEqual(self.get_paths(content), ['workers/1', 'workers/2'])
+        self.assertEqual((content['total'], content['next']), (3, 'workers/2'))
+        _, content = self.get('/probes?prefix=workers/&limit=2&after=workers/2')
+        self.assertEqual(self.get_paths(content), ['workers/3'])
+        self.assertIsNone(content['next'])
+
+        _, content = self.get('/probes?label=queue')
+        self.assertEqual(self.get_paths(content), ['workers/1', 'workers/2', 'workers/3'])
+        # Labels of probes added after exporting are indexed too
+        self.probers['db'].add_probe('queue', util.MutableVariable([]))
+        _, content = self.get('/probes?label=queue&limit=1')
+        self.assertEqual(self.get_paths(content), ['db'])
+        self.assertEqual((content['total'], content['next']), (4, 'db'))
+        _, content = self.get('/probes?label=unknown')
+        self.assertEqual(content, {'total': 0, 'next': None, 'resources': []})
+
+        for limit in ('x', '0', '-1'):
+            response, _ = self.get('/probes?limit=' + limit)
+            self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+
+    def test_remove_probe_resource(self):
+        h.remove_probe_resource(self.server, self.probers['workers/2'])
+        h.remove_probe_resource(self.server, '/db')
+        h.remove_probe_resource(self.server, 'unknown')
+        _, content = self.get('/probes?label=count')
+        self.assertEqual(self.get_paths(content), ['workers/1', 'workers/3', 'workersx'])
+        _, content = self.get('/probes?label=queue')
+        self.assertEqual(content['total'], 2)
+        self.assertIsNone(self.server.handler_registry.get_request_handler(
+            h.HTTPMethod.GET, '/probes/db'))
+
+        # Removed resources are no longer indexed when probes are added
+        self.probers['db'].add_probe('extra', util.MutableVariable(0))
+        _, content = self.get('/probes?label=extra')
+        self.assertEqual(content['total'], 0)
+
+    def test_probe_added_subscription(self):
+        prober = h.ProbeResource('/subscribed')
+        added = []
+
+        def callback(probe_resource, label):
+            added.append((probe_resource, label))
+
+        prober.subscribe_probe_added(callback)
+        prober.add_probe('a', util.MutableVariable(0))
+        prober.add_probe('a', util.MutableVariable(1))
+        prober.unsubscribe_probe_added(callback)
+        prober.unsubscribe_probe_added(callback)
+        prober.add_probe('b', util.MutableVariable(0))
+        self.assertEqual(added, [(prober, 'a')])
+
+    def test_index_search(self):
+        # Query times are measured by benchmarks/index_benchmark.py
+        index = h.ProbeResourceIndex()
+        for number in range(20000):
+            prober = h.ProbeResource('resources/{:05d}'.format(number))
+            prober.add_probe('even' if number % 2 == 0 else 'odd',
+                             util.MutableVariable(number))
+            index.add(prober)
+        resources, total, next_path = index.find(
+            prefix='resources/1', label='odd', after='resources/15000', limit=10)
+        self.assertEqual([resource.get_path() for resource in resources][:2],
+                         ['resources/15001', 'resources/15003'])
+        self.assertEqual((total, next_path), (5000, 'resources/15019'))
+
+
+class TestProbeSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        h.set_default_snapshot_store(None)
+        self.directory.cleanup()
+
+    def create_prober(self):
+        prober = h.ProbeResource('/tuned/knobs')
+        prober.add_probe('rate', util.MutableVariable(1.0))
+        prober.add_probe('name', util.MutableVariable('default'))
+        prober.add_probe('weights', util.MutableVariable(numpy.zeros(3)))
+        return prober
+
+    def test_restore(self):
+        with h.ProbeSnapshotStore(self.directory.name, interval=60) as store:
+            prober = self.create_prober()
+            self.assertEqual(store.attach(prober), {})
+            prober.update_probe_values({'rate': 2.5, 'weights': numpy.ones(3)})
+            store.flush()
+            prober.get_probe_value('name').set_value('tuned')
+
+        filename = store.get_filename('tuned/knobs')
+        self.assertEqual(os.path.dirname(filename), self.directory.name)
+        # A torn record from a crash during an append is ignored
+        with open(filename, 'ab') as f:
+            f.write(b'\x10\x00\x00')
+
+        with h.ProbeSnapshotStore(self.directory.name) as store:
+            prober = self.create_prober()
+            restored = store.attach(prober)
+            self.assertEqual(sorted(restored), ['name', 'rate', 'weights'])
+            _, values = prober.get_probe_snapshot()
+            self.assertEqual(values['rate'], 2.5)
+            self.assertEqual(values['name'], 'tuned')
+            numpy.testing.assert_array_equal(values['weights'], numpy.ones(3))
+
+    def test_compaction(self):
+        with h.ProbeSnapshotStore(self.directory.name, interval=60,
+                                  compact_min_bytes=0, compact_ratio=2) as store:
+            prober = self.create_prober()
+            store.attach(prober)
+            filename = store.get_filename(prober.get_path())
+            sizes = []
+            for value in range(20):
+                prober.update_probe_values({'rate': float(value)})
+                store.flush()
+                sizes.append(os.path.getsize(filename))
+            self.assertLess(max(sizes), 2 * min(sizes) + 100)
+            self.assertFalse(os.path.exists(filename + '.tmp'))
+        self.assertEqual(h.persistence.read_snapshot_file(filename)['rate'], 19.0)
+
+    def test_background_writes(self):
+        with h.ProbeSnapshotStore(self.directory.name, interval=0.05) as store:
+            prober = self.create_prober()
+            store.attach(prober)
+            prober.update_probe_values({'rate': 3.0})
+            filename = store.get_filename(prober.get_path())
+            deadline = time.monotonic() + 5
+            while not os.path.exists(filename) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(h.persistence.read_snapshot_file(filename), {'rate': 3.0})
+
+    def test_restore_on_export(self):
+        store = h.ProbeSnapshotStore(self.directory.name, interval=60)
+        h.set_default_snapshot_store(store)
+        server = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        try:
+            prober = self.create_prober()
+            h.export_probe_resource_to_server(server, prober)
+            self.assertTrue(store.is_attached(prober))
+            prober.update_probe_values({'rate': 4.0})
+            h.remove_probe_resource(server, prober)
+            self.assertFalse(store.is_attached(prober))
+
+            prober = self.create_prober()
+            h.export_probe_resource_to_server(server, prober)
+            self.assertEqual(prober.get_probe_snapshot(['rate'])[1], {'rate': 4.0})
+        finally:
+            store.close()
+            server.server_close()
+
+    def test_export_overwrites_persisted_resource(self):
+        store = h.ProbeSnapshotStore(self.directory.name, interval=60)
+        h.set_default_snapshot_store(store)
+        server = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        try:
+            old = self.create_prober()
+            h.export_probe_resource_to_server(server, old)
+            old.update_probe_values({'rate': 5.0})
+            new = self.create_prober()
+            h.export_probe_resource_to_server(server, new)
+            self.assertFalse(store.is_attached(old))
+            self.assertTrue(store.is_attached(new))
+            self.assertEqual(new.get_probe_snapshot(['rate'])[1], {'rate': 5.0})
+        finally:
+            store.close()
+            server.server_close()
+
+    def test_export_same_path_to_two_servers(self):
+        store = h.ProbeSnapshotStore(self.directory.name, interval=60)
+        h.set_default_snapshot_store(store)
+        first = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        second = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        try:
+            shared = self.create_prober()
+            h.export_probe_resource_to_server(first, shared)
+            h.export_probe_resource_to_server(second, shared)
+            # The resource stays persisted while a server exports it
+            h.remove_probe_resource(first, shared)
+            self.assertTrue(store.is_attached(shared))
+
+            # Only one resource per path is persisted
+            other = self.create_prober()
+            with self.assertWarns(RuntimeWarning):
+                h.export_probe_resource_to_server(first, other)
+            self.assertFalse(store.is_attached(other))
+            self.assertIs(h.probe.ProbeResourceHandlerRegistry().get_probe_resource(
+                first.server_address, '/probes/tuned/knobs'), other)
+            h.remove_probe_resource(second, shared)
+            self.assertFalse(store.is_attached(shared))
+        finally:
+            store.close()
+            first.server_close()
+            second.server_close()
+
+    def test_torn_record_truncated_on_attach(self):
+        with h.ProbeSnapshotStore(self.directory.name, interval=60) as store:
+            prober = self.create_prober()
+            store.attach(prober)
+            prober.update_probe_values({'rate': 2.0})
+        filename = store.get_filename(prober.get_path())
+        with open(filename, 'ab') as f:
+            f.write(b'\x10\x00')
+
+        with h.ProbeSnapshotStore(self.directory.name, interval=60) as store:
+            prober = self.create_prober()
+            store.attach(prober)
+            prober.update_probe_values({'rate': 3.0})
+        self.assertEqual(h.persistence.read_snapshot_file(filename), {'rate': 3.0})
+
+    def test_write_errors_are_logged(self):
+        with h.ProbeSnapshotStore(self.directory.name, interval=60) as store:
+            broken = h.ProbeResource('/broken')
+            broken.add_probe('rate', util.MutableVariable(1.0))
+            prober = self.create_prober()
+            store.attach(broken)
+            store.attach(prober)
+            os.mkdir(store.get_filename(broken.get_path()))
+            broken.update_probe_values({'rate': 2.0})
+            prober.update_probe_values({'rate': 2.0})
+            with self.assertLogs('omnilib.http.persistence', 'ERROR'):
+                store.flush()
+            filename = store.get_filename(prober.get_path())
+            self.assertEqual(h.persistence.read_snapshot_file(filename), {'rate': 2.0})
+            os.rmdir(store.get_filename(broken.get_path()))
+            store.flush()
+            self.assertEqual(h.persistence.read_snapshot_file(
+                store.get_filename(broken.get_path())), {'rate': 2.0})
+
+    def test_single_owner_per_path(self):
+        with h.ProbeSnapshotStore(self.directory.name, interval=60) as store:
+            store.attach(self.create_prober())
+            with self.assertRaises(ValueError):
+                store.attach(self.create_prober())
+
+    def test_init_called_again(self):
+        with mock.patch.object(omnilib.base, '_omnilib_initialized', True):
+            with self.assertWarns(RuntimeWarning):
+                omnilib.init(probe_snapshot_dir=self.directory.name)
+        self.assertIsNone(h.persistence.get_default_snapshot_store())
+
+
+class TestProbeAtomicUpdates(ProbeServerTestCase):
+    def create_probers(self):
+        self.first = h.ProbeResource('/first')
+        self.first.add_probe('a', util.MutableVariable(1))
+        self.first.add_probe('b', util.MutableVariable(2))
+        self.second = h.ProbeResource('/second')
+        self.second.add_probe('c', util.MutableVariable(3))
+        return [self.first, self.second]
+
+    def test_update_probe_values(self):
+        version = self.first.version
+        changes = []
+        self.first.get_probe_value('a').subscribe(lambda v: changes.append(v.get_value()))
+        self.assertEqual(self.first.update_probe_values({'a': 10, 'b': 20}), version + 1)
+        self.assertEqual(self.first.get_probe_snapshot(), (version + 1, {'a': 10, 'b': 20}))
+        self.assertEqual(self.first.get_changes(version), (version + 1, ['a', 'b']))
+        self.assertEqual(changes, [10])
+
+        with self.assertRaises(h.ProbeVersionConflictError):
+            self.first.update_probe_values({'a': 11}, expected_version=version)
+        with self.assertRaises(ValueError):
+            self.first.update_probe_values({'a': 11, 'unknown': 1})
+        self.assertEqual(self.first.get_probe_snapshot(['a']), (version + 1, {'a': 10}))
+
+    def test_update_probe_resources(self):
+        versions = h.update_probe_resources([(self.first, {'a': 5}, None),
+                                             (self.second, {'c': 6}, self.second.version)])
+        self.assertEqual(versions, [self.first.version, self.second.version])
+        with self.assertRaises(h.ProbeVersionConflictError):
+            h.update_probe_resources([(self.first, {'a': 7}, None),
+                                      (self.second, {'c': 8}, self.second.version - 1)])
+        self.assertEqual(self.first.get_probe_value('a'), 5)
+
+    def test_concurrent_batches_are_atomic(self):
+        def write(value):
+            for _ in range(200):
+                self.first.update_probe_values({'a': value, 'b': value})
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for _ in range(200):
+            _, values = self.first.get_probe_snapshot()
+            self.assertEqual(values['a'], values['b'])
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_add_probe(self):
+        def add(index):
+            for i in range(500):
+                self.second.add_probe('{}_{}'.format(index, i), util.MutableVariable(i))
+
+        # Switches threads often, so the readers overlap the writers
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        threads = [threading.Thread(target=add, args=(index,)) for index in range(4)]
+        try:
+            for thread in threads:
+                thread.start()
+            while any(thread.is_alive() for thread in threads):
+                self.second.get_probe_snapshot()
+                self.second.get_encoded_probe_values()
+        finally:
+            sys.setswitchinterval(switch_interval)
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.second.get_probe_snapshot()[1]), 2001)
+
+    def test_same_path_batches_do_not_deadlock(self):
+        # Resources of the same path, eg: on two servers, locked in opposite
+        # orders by concurrent batches
+        other = h.ProbeResource('/first')
+        other.add_probe('a', util.MutableVariable(1))
+
+        def write(resources):
+            for _ in range(500):
+                h.update_probe_resources([(resource, {'a': 0}, None)
+                                          for resource in resources])
+
+        threads = [threading.Thread(target=write, args=(order,), daemon=True)
+                   for order in ([self.first, other], [other, self.first])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+    def test_patch_if_match(self):
+        response, _ = self.request(h.HTTPMethod.GET, "/probes/first?format=json")
+        etag = response.getheader('ETag')
+        self.assertEqual(etag, '"{}"'.format(self.first.version))
+
+        headers = {'Content-Type': 'application/json', 'If-Match': etag}
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/first",
+                                   body=b'{"a": 100}', headers=headers)
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(response.getheader('ETag'), '"{}"'.format(self.first.version))
+
+        # The same version is now stale
+        response, content = self.request(h.HTTPMethod.PATCH, "/probes/first",
+                                         body=b'{"a": 200}', headers=headers)
+        self.assertEqual(response.status, http.HTTPStatus.PRECONDITION_FAILED)
+        self.assertEqual(json.loads(content)['version'], self.first.version)
+        self.assertEqual(self.first.get_probe_value('a'), 100)
+
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/first/b", body=b'5',
+                                   headers={'If-Match': etag})
+        self.assertEqual(response.status, http.HTTPStatus.PRECONDITION_FAILED)
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes/first/b", body=b'5',
+                                   headers={'If-Match': '"{}"'.format(self.first.version)})
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(self.first.get_probe_value('b'), 5)
+
+    def test_bulk_patch(self):
+        body = json.dumps({'first': {'values': {'a': -1, 'b': -2}},
+                           'second': {'values': {'c': -3}, 'version': self.second.version}})
+        response, content = self.request(h.HTTPMethod.PATCH, "/probes", body=body)
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        self.assertEqual(json.loads(content), {'first': self.first.version,
+                                               'second': self.second.version})
+        self.assertEqual(self.second.get_probe_value('c'), -3)
+
+        body = json.dumps({'first': {'values': {'a': 1}},
+                           'second': {'values': {'unknown': 1}}})
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes", body=body)
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+        self.assertEqual(self.first.get_probe_value('a'), -1)
+
+        body = json.dumps({'missing': {'values': {'a': 1}}})
+        response, _ = self.request(h.HTTPMethod.PATCH, "/probes", body=body)
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+
+
+class TestProbeWatch(ProbeServerTestCase):
+    server_class = h.MultiHandlerThreadingHTTPServer
+
+    def create_probers(self):
+        self.int_var = util.MutableVariable(1)
+        self.string_var = util.MutableVariable('a')
+        self.prober = h.ProbeResource('/watched')
+        self.prober.add_probe('int_var', self.int_var)
+        self.prober.add_probe('string_var', self.string_var)
+        return [self.prober]
+
+    def get(self, path, headers={}):
+        return self.request(h.HTTPMethod.GET, path, headers=headers)
+
+    def set_later(self, delay, *updates):
+        def run():
+            for variable, value in updates:
+                time.sleep(delay)
+                variable.set_value(value)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_resource_versions(self):
+        version = self.prober.version
+        self.int_var.set_value(2)
+        self.assertEqual(self.prober.get_changes(version), (version + 1, ['int_var']))
+        self.assertEqual(self.prober.get_changes(version + 1), (version + 1, []))
+        self.assertEqual(sorted(self.prober.get_changes(version + 100)[1]),
+                         ['int_var', 'string_var'])
+
+        # Replaced probes are no longer watched through the old variable
+        new_var = util.MutableVariable(5)
+        self.prober.set_probe_value('int_var', new_var)
+        version = self.prober.version
+        self.int_var.set_value(3)
+        self.assertEqual(self.prober.version, version)
+        new_var.set_value(6)
+        self.assertEqual(self.prober.get_changes(version), (version + 1, ['int_var']))
+
+    def test_long_poll_timeout(self):
+        version = self.prober.version
+        response, content = self.get(
+            "/probes/watched?since={}&timeout=0.05".format(version))
+        self.assertEqual(json.loads(content), {'version': version, 'values': {}})
+
+    def test_long_poll_change(self):
+        version = self.prober.version
+        thread = self.set_later(0.1, (self.string_var, 'b'))
+        response, content = self.get(
+            "/probes/watched?since={}&timeout=5".format(version))
+        thread.join()
+        self.assertEqual(json.loads(content),
+                         {'version': version + 1, 'values': {'string_var': 'b'}})
+
+    def test_event_stream(self):
+        thread = self.set_later(0.05, (self.int_var, 2), (self.int_var, 3),
+                                (self.string_var, 'c'))
+        response, content = self.get("/probes/watched?watch=sse&max_rate=1000&duration=0.5")
+        thread.join()
+        self.assertEqual(response.getheader('Content-Type'), 'text/event-stream')
+        events = [json.loads(line[len('data: '):]) for line in
+                  content.decode('utf-8').splitlines() if line.startswith('data: ')]
+        self.assertEqual(events[0]['values'], {'int_var': 1, 'string_var': 'a'})
+        self.assertEqual(events[-1]['version'], self.prober.version)
+        merged = {}
+        for event in events:
+            merged.update(event['values'])
+        self.assertEqual(merged, {'int_var': 3, 'string_var': 'c'})
+
+    def test_event_stream_coalescing(self):
+        version = self.prober.version
+        thread = self.set_later(0.01, *[(self.int_var, i) for i in range(20)])
+        response, content = self.get(
+            "/probes/watched?max_rate=2&duration=0.6",
+            headers={'Accept': 'text/event-stream', 'Last-Event-ID': str(version)})
+        thread.join()
+        events = [line for line in content.decode('utf-8').splitlines()
+                  if line.startswith('data: ')]
+        self.assertGreaterEqual(len(events), 1)
+        self.assertLessEqual(len(events), 2)
+
+    def test_event_stream_without_probes(self):
+        h.export_probe_resource_to_server(self.server, h.ProbeResource('/empty'))
+        response, content = self.get("/probes/empty?watch=sse&duration=0.3")
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        # Waits for changes instead of writing heartbeats in a loop
+        self.assertLessEqual(content.count(b': heartbeat'), 2)
+
+
+def publish_worker_probes(address, results):
+    counter = util.MutableVariable(0)
+    mode = util.MutableVariable('run')
+    prober = h.ProbeResource('/worker', desc='Worker probes')
+    prober.add_probe('counter', counter, desc='Items processed')
+    prober.add_probe('mode', mode)
+    with h.ProbePublisher(address, max_rate=100) as publisher:
+        publisher.publish(prober)
+        counter.set_value(5)
+        deadline = time.monotonic() + 10
+        while mode.get_value() != 'stop' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        results.put((counter.get_value(), mode.get_value()))
+
+
+class TestProbeAggregation(ProbeServerTestCase):
+    server_class = h.MultiHandlerThreadingHTTPServer
+
+    def setUp(self):
+        super().setUp()
+        self.aggregator = h.ProbeAggregator(self.server)
+        self.context = multiprocessing.get_context('fork')
+
+    def tearDown(self):
+        self.aggregator.close()
+        super().tearDown()
+
+    def request(self, method, path, body=None):
+        return super().request(method, path, body,
+                               headers={'Accept': 'application/json',
+                                        'Content-Type': 'application/json'})
+
+    def wait_for(self, predicate, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                self.fail("Condition not met in time")
+            time.sleep(0.01)
+
+    def test_publish_and_write_back(self):
+        results = self.context.Queue()
+        process = self.context.Process(
+            target=publish_worker_probes, args=(self.aggregator.address, results))
+        process.start()
+        try:
+            self.wait_for(lambda: 'worker' in self.aggregator.resources)
+            mirror = self.aggregator.resources['worker']
+            self.assertEqual(mirror.get_desc(), 'Worker probes')
+            self.assertEqual(mirror.get_probe_desc('counter'), 'Items processed')
+            self.assertEqual(self.aggregator.get_owner_count('/worker'), 1)
+
+            # Reads are served from the mirror once the change is pushed
+            self.wait_for(lambda: json.loads(
+                self.request(h.HTTPMethod.GET, '/probes/worker')[1])['counter'] == 5)
+
+            # Writes reach the owning process
+            response, _ = self.request(h.HTTPMethod.PATCH, '/probes/worker',
+                                       json.dumps({'mode': 'stop'}))
+            self.assertEqual(response.status, http.HTTPStatus.OK)
+            self.assertEqual(results.get(timeout=10), (5, 'stop'))
+        finally:
+            process.join(10)
+        self.assertEqual(process.exitcode, 0)
+        self.wait_for(lambda: self.aggregator.get_owner_count('worker') == 0)
+        self.assertEqual(mirror.get_probe_snapshot(['mode'])[1], {'mode': 'stop'})
+
+    def test_batched_write_back(self):
+        owner = h.ProbeResource('/batched')
+        owner.add_probe('a', util.MutableVariable(0))
+        owner.add_probe('b', util.MutableVariable(0))
+        with h.ProbePublisher(self.aggregator.address) as publisher:
+            publisher.publish(owner)
+            self.wait_for(lambda: 'batched' in self.aggregator.resources)
+            version = owner.version
+            response, _ = self.request(h.HTTPMethod.PATCH, '/probes/batched',
+                                       json.dumps({'a': 1, 'b': 2}))
+            self.assertEqual(response.status, http.HTTPStatus.OK)
+            self.wait_for(lambda: owner.version != version)
+            # The batch reaches the owner as one change
+            time.sleep(0.1)
+            self.assertEqual(owner.version, version + 1)
+            self.assertEqual(owner.get_probe_snapshot()[1], {'a': 1, 'b': 2})
+
+            # So does a single value set on the mirror
+            self.aggregator.resources['batched'].get_probe_value('a').set_value(3)
+            self.wait_for(lambda: owner.get_probe_value('a') == 3)
+            self.assertEqual(owner.version, version + 2)
+
+    def test_invalid_max_rate(self):
+        with self.assertRaises(ValueError):
+            h.ProbePublisher(self.aggregator.address, max_rate=0)
+
+    def test_accept_errors_back_off(self):
+        class FailingListener(object):
+            calls = 0
+
+            def accept(self):
+                self.calls += 1
+                raise OSError(errno.EMFILE, "Too many open files")
+
+            def close(self):
+                pass
+
+        listener, failing = self.aggregator._listener, FailingListener()
+        self.aggregator._listener = failing
+        # Unblocks the pending accept of the real listener
+        publisher = h.ProbePublisher(self.aggregator.address)
+        time.sleep(0.5)
+        publisher.close()
+        listener.close()
+        self.assertGreater(failing.calls, 0)
+        self.assertLess(failing.calls, 20)
+
+    def test_concurrent_exports(self):
+        def export(index):
+            for i in range(50):
+                prober = h.ProbeResource('/exported/{}/{}'.format(index, i))
+                h.export_probe_resource_to_server(self.server, prober)
+
+        threads = [threading.Thread(target=export, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for _ in range(50):
+            response, _ = self.request(h.HTTPMethod.GET, '/probes/exported/0/0')
+            self.assertIn(response.status, (http.HTTPStatus.OK, http.HTTPStatus.NOT_FOUND))
+        for thread in threads:
+            thread.join()
+        response, content = self.request(h.HTTPMethod.GET, '/probes?prefix=exported/')
+        self.assertEqual(json.loads(content)['total'], 200)
+
+
 class TestHTTPServer(unittest.TestCase):
     class GETStatusOKHandler(h.StatelessHTTPHandler):
         def handle(self):
@@ -201,6 +1257,29 @@ class TestHTTPServer(unittest.TestCase):
         self.assertEqual(response.status, response_code)
         connection.close()
 
+    def test_unread_body_discarded(self):
+        class RejectingHandler(h.StatelessHTTPHandler):
+            def handle(self):
+                self._request_handler.send_response(http.HTTPStatus.BAD_REQUEST)
+                self._request_handler.send_header('Content-Length', 0)
+                self._request_handler.end_headers()
+
+        with h.MultiHandlerThreadingHTTPServer(log_requests=False) as server:
+            server.register_handler(h.HTTPMethod.POST, "/", RejectingHandler)
+            server.start_serving_async()
+            connection = http.client.HTTPConnection(*server.server_address)
+            connection.request(h.HTTPMethod.POST.name, "/", body=b'x' * 1000)
+            self.assertEqual(connection.getresponse().read(), b'')
+            sock = connection.sock
+            # The connection stays usable after small unread bodies
+            connection.request(h.HTTPMethod.POST.name, "/", body=iter([b'y' * 10]),
+                               encode_chunked=True)
+            response = connection.getresponse()
+            self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+            response.read()
+            self.assertIs(connection.sock, sock)
+            connection.close()
+
     def test_server_async(self):
         host, port, server = self.start_server_with_handlers(
             handler_registries=[(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)])
@@ -278,6 +1357,25 @@ class TestHTTPServer(unittest.TestCase):
                 self.assert_response(
                     host, port, h.HTTPMethod.GET, "/", http.HTTPStatus.NOT_FOUND)
 
+    def test_server_prefix_handlers(self):
+        host, port, server = self.start_server_with_handlers(handler_registries=[
+            (h.HTTPMethod.GET, "/files/exact", self.GETStatusOKHandler)])
+        server.register_prefix_handler(h.HTTPMethod.GET, "/files/", self.GETStatusNotFoundHandler)
+        server.register_prefix_handler(h.HTTPMethod.GET, "/files/public/", self.GETStatusOKHandler)
+        with server:
+            server.start_serving_async()
+            self.assert_response(host, port, h.HTTPMethod.GET,
+                                 "/files/exact", http.HTTPStatus.OK)
+            self.assert_response(host, port, h.HTTPMethod.GET,
+                                 "/files/secret", http.HTTPStatus.NOT_FOUND)
+            self.assert_response(host, port, h.HTTPMethod.GET,
+                                 "/files/public/a?b=c", http.HTTPStatus.OK)
+            self.assertEqual(server.handler_registry.resolve_handler(
+                h.HTTPMethod.GET, "/files/public/a")[0], "/files/public/")
+            server.deregister_prefix_handler(h.HTTPMethod.GET, "/files/public/")
+            self.assert_response(host, port, h.HTTPMethod.GET,
+                                 "/files/public/a", http.HTTPStatus.NOT_FOUND)
+
     def test_server_with(self):
         with h.MultiHandlerSingleThreadHTTPServer() as server:
             host, port = server.server_address
@@ -288,5 +1386,603 @@ class TestHTTPServer(unittest.TestCase):
                 host, port, h.HTTPMethod.GET, "/", http.HTTPStatus.OK)
 
 
+class TestStreaming(unittest.TestCase):
+    class EchoHandler(h.StatelessHTTPHandler):
+        def handle(self):
+            with self.start_chunked_response(
+                    headers={'Content-Type': 'application/octet-stream'}) as writer:
+                for chunk in self.get_body_reader().iter_chunks(chunk_size=7):
+                    writer.write(chunk)
+
+    def test_body_reader_content_length(self):
+        reader = h.RequestBodyReader(io.BytesIO(b'0123456789tail'),
+                                     content_length=10)
+        self.assertEqual(reader.read(4), b'0123')
+        self.assertEqual(reader.read(), b'456789')
+        self.assertEqual(reader.read(), b'')
+        self.assertTrue(reader.at_eof())
+        self.assertEqual(reader.bytes_read, 10)
+
+    def test_body_reader_chunked(self):
+        body = b'4\r\nWiki\r\n5;ext=1\r\npedia\r\n0\r\nTrailer: x\r\n\r\nnext'
+        stream = io.BytesIO(body)
+        reader = h.RequestBodyReader(stream, chunked=True)
+        self.assertEqual(list(reader.iter_chunks(chunk_size=3)),
+                         [b'Wik', b'i', b'ped', b'ia'])
+        self.assertTrue(reader.at_eof())
+        self.assertEqual(stream.read(), b'next')
+
+    def test_body_reader_readinto(self):
+        reader = h.RequestBodyReader(io.BytesIO(b'3\r\nabc\r\n4\r\ndefg\r\n0\r\n\r\n'),
+                                     chunked=True)
+        buffer = bytearray(5)
+        self.assertEqual(reader.readinto(buffer), 5)
+        self.assertEqual(buffer, b'abcde')
+        self.assertEqual(reader.readinto(buffer), 2)
+        self.assertEqual(buffer[:2], b'fg')
+        self.assertTrue(reader.at_eof())
+
+    def test_body_reader_invalid_chunk(self):
+        reader = h.RequestBodyReader(io.BytesIO(b'zz\r\n'), chunked=True)
+        with self.assertRaises(ValueError):
+            reader.read()
+
+    def test_chunked_request_and_response(self):
+        with h.MultiHandlerSingleThreadHTTPServer() as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.POST, "/echo", self.EchoHandler)
+            server.start_serving_async()
+
+            payload = [b'x' * 1000, b'y' * 10, b'z' * 5000]
+            connection = http.client.HTTPConnection(host, port)
+            connection.request(h.HTTPMethod.POST.name, "/echo",
+                               body=iter(payload), encode_chunked=True)
+            response = connection.getresponse()
+            self.assertEqual(response.status, http.HTTPStatus.OK)
+            self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(response.read(), b''.join(payload))
+            connection.close()
+
+    def test_content_length_request_chunked_response(self):
+        with h.MultiHandlerSingleThreadHTTPServer() as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.POST, "/echo", self.EchoHandler)
+            server.start_serving_async()
+
+            connection = http.client.HTTPConnection(host, port)
+            connection.request(h.HTTPMethod.POST.name, "/echo", body=b'abc' * 10)
+            response = connection.getresponse()
+            self.assertEqual(response.read(), b'abc' * 10)
+            connection.close()
+
+
+class TestHTTPServerMetrics(unittest.TestCase):
+    class GETStatusOKHandler(h.StatelessHTTPHandler):
+        def handle(self):
+            body = b'hello'
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', len(body))
+            self._request_handler.end_headers()
+            self._request_handler.wfile.write(body)
+
+    def request(self, host, port, method, path, body=None):
+        response, content = send_request(host, port, method, path, body)
+        return response.status, content
+
+    def test_metrics_disabled_by_default(self):
+        with h.MultiHandlerSingleThreadHTTPServer() as server:
+            self.assertIsNone(server.metrics)
+            self.assertIsNone(server.handler_registry.get_handler(
+                h.HTTPMethod.GET, '/metrics'))
+
+    def test_metrics_endpoint(self):
+        with h.MultiHandlerSingleThreadHTTPServer() as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            metrics = server.enable_metrics()
+            server.start_serving_async()
+
+            for _ in range(3):
+                self.request(host, port, h.HTTPMethod.GET, "/")
+            with self.assertRaises(http.client.RemoteDisconnected):
+                self.request(host, port, h.HTTPMethod.PATCH, "/", body=b'x' * 10)
+
+            self.assertEqual(metrics.get_request_count(h.HTTPMethod.GET, "/"), 3)
+            self.assertEqual(metrics.get_request_count(
+                h.HTTPMethod.GET, "/", http.HTTPStatus.OK), 3)
+            self.assertEqual(metrics.get_request_count(
+                h.HTTPMethod.PATCH, h.server.UNHANDLED_ROUTE), 1)
+
+            status, content = self.request(host, port, h.HTTPMethod.GET, "/metrics")
+            self.assertEqual(status, http.HTTPStatus.OK)
+            text = content.decode('utf-8')
+            self.assertIn('omnilib_http_requests_total{method="GET",route="/",status="200"} 3',
+                          text)
+            self.assertIn('omnilib_http_request_duration_seconds_count{method="GET",route="/"} 3',
+                          text)
+            self.assertIn('omnilib_http_requests_in_flight{method="GET",route="/"} 0', text)
+            self.assertIn('omnilib_http_request_bytes_total{method="PATCH",route="<unhandled>"}',
+                          text)
+            for line in text.splitlines():
+                if line.startswith('omnilib_http_response_bytes_total{method="GET",route="/"}'):
+                    self.assertGreater(int(line.split()[-1]), 3 * len(b'hello'))
+
+    def test_disable_metrics(self):
+        with h.MultiHandlerSingleThreadHTTPServer() as server:
+            server.enable_metrics('/stats')
+            server.disable_metrics()
+            self.assertIsNone(server.metrics)
+            self.assertIsNone(server.handler_registry.get_request_handler(
+                h.HTTPMethod.GET, '/stats'))
+
+
+class TestOverloadProtection(unittest.TestCase):
+    class GETStatusOKHandler(h.StatelessHTTPHandler):
+        def handle(self):
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', 0)
+            self._request_handler.end_headers()
+
+    class SlowHandler(h.StatelessHTTPHandler):
+        release = None
+
+        def handle(self):
+            self.release.wait(5)
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', 0)
+            self._request_handler.end_headers()
+
+    class BodyLengthHandler(h.StatelessHTTPHandler):
+        def handle(self):
+            body = bytes(str(len(self.read_body())), 'utf-8')
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', len(body))
+            self._request_handler.end_headers()
+            self._request_handler.wfile.write(body)
+
+    def get_status(self, host, port, path):
+        connection = http.client.HTTPConnection(host, port)
+        connection.request(h.HTTPMethod.GET.name, path)
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response.status, response.getheader('Retry-After')
+
+    def test_token_bucket(self):
+        bucket = h.TokenBucket(rate=1, burst=2)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertGreater(bucket.try_acquire(), 0.0)
+        with self.assertRaises(ValueError):
+            h.TokenBucket(rate=0)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            h.MultiHandlerSingleThreadHTTPServer(max_connections=0)
+        with self.assertRaises(ValueError):
+            h.MultiHandlerSingleThreadHTTPServer(header_timeout=-1)
+
+    def test_rate_limit(self):
+        with h.MultiHandlerSingleThreadHTTPServer() as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            server.register_handler(h.HTTPMethod.GET, "/free", self.GETStatusOKHandler)
+            server.set_rate_limit(h.HTTPMethod.GET, "/", rate=0.01, burst=2)
+            server.start_serving_async()
+
+            self.assertEqual(self.get_status(host, port, "/")[0], http.HTTPStatus.OK)
+            self.assertEqual(self.get_status(host, port, "/")[0], http.HTTPStatus.OK)
+            status, retry_after = self.get_status(host, port, "/")
+            self.assertEqual(status, http.HTTPStatus.TOO_MANY_REQUESTS)
+            self.assertGreaterEqual(int(retry_after), 1)
+            self.assertEqual(self.get_status(host, port, "/free")[0], http.HTTPStatus.OK)
+
+            server.remove_rate_limit(h.HTTPMethod.GET, "/")
+            self.assertEqual(self.get_status(host, port, "/")[0], http.HTTPStatus.OK)
+
+    def test_max_connections(self):
+        release = threading.Event()
+        handler = type('Slow', (self.SlowHandler,), {'release': release})
+        with h.MultiHandlerThreadingHTTPServer(max_connections=1, retry_after=3) as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/slow", handler)
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            server.start_serving_async()
+
+            slow_connection = http.client.HTTPConnection(host, port)
+            slow_connection.request(h.HTTPMethod.GET.name, "/slow")
+            deadline = time.time() + 5
+            while server.active_connections < 1 and time.time() < deadline:
+                time.sleep(0.01)
+
+            self.assertEqual(self.get_status(host, port, "/"),
+                             (http.HTTPStatus.SERVICE_UNAVAILABLE, '3'))
+            self.assertEqual(server.rejected_connections, 1)
+
+            release.set()
+            self.assertEqual(slow_connection.getresponse().status, http.HTTPStatus.OK)
+            slow_connection.close()
+            deadline = time.time() + 5
+            while server.active_connections > 0 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.get_status(host, port, "/")[0], http.HTTPStatus.OK)
+
+    def test_header_timeout(self):
+        with h.MultiHandlerSingleThreadHTTPServer(header_timeout=0.2) as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            server.start_serving_async()
+
+            # A client that never sends its request must not stall the server
+            idle = socket.create_connection((host, port))
+            self.assertEqual(self.get_status(host, port, "/")[0], http.HTTPStatus.OK)
+            idle.close()
+
+    def test_header_deadline(self):
+        with h.MultiHandlerSingleThreadHTTPServer(header_timeout=0.3) as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            server.start_serving_async()
+
+            # Sending a byte before every receive times out must not extend
+            # the time allowed for the headers
+            slow = socket.create_connection((host, port))
+            slow.sendall(b'GET / HTTP/1.1\r\n')
+            slow.settimeout(0.05)
+            start = time.monotonic()
+            closed = False
+            while not closed and time.monotonic() - start < 3:
+                try:
+                    slow.sendall(b'X')
+                    closed = slow.recv(1024) == b''
+                except socket.timeout:
+                    pass
+                except OSError:
+                    closed = True
+            slow.close()
+            self.assertTrue(closed)
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(self.get_status(host, port, "/")[0], http.HTTPStatus.OK)
+
+    def test_body_timeout_restores_socket_timeout(self):
+        server, client = socket.socketpair()
+        with server, client:
+            server.settimeout(7)
+            client.sendall(b'abc')
+            reader = h.RequestBodyReader(server.makefile('rb'), content_length=3,
+                                         connection=server, timeout=5)
+            self.assertEqual(reader.read(), b'abc')
+            self.assertEqual(server.gettimeout(), 7)
+
+    def test_body_timeout(self):
+        with h.MultiHandlerSingleThreadHTTPServer(body_timeout=0.2) as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.POST, "/", self.BodyLengthHandler)
+            server.start_serving_async()
+
+            slow = socket.create_connection((host, port))
+            slow.sendall(b'POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 100\r\n\r\nabc')
+            slow.settimeout(5)
+            self.assertTrue(slow.recv(1024).startswith(b'HTTP/1.1 408'))
+            slow.close()
+
+            connection = http.client.HTTPConnection(host, port)
+            connection.request(h.HTTPMethod.POST.name, "/", body=b'x' * 100)
+            self.assertEqual(connection.getresponse().read(), b'100')
+            connection.close()
+
+
+class TestResponseCache(unittest.TestCase):
+    class CountingHandler(h.StatelessHTTPHandler):
+        calls = 0
+
+        def handle(self):
+            type(self).calls += 1
+            body = bytes('{} {}'.format(type(self).calls, self._request_handler.path), 'utf-8')
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', len(body))
+            self._request_handler.end_headers()
+            self._request_handler.wfile.write(body)
+
+    class PATCHOKHandler(h.StatelessHTTPHandler):
+        def handle(self):
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', 0)
+            self._request_handler.end_headers()
+
+    def get(self, host, port, path, headers={}):
+        return send_request(host, port, h.HTTPMethod.GET, path, headers=headers)[1]
+
+    def start_server(self, ttl=60, vary_headers=()):
+        handler = type('Counting', (self.CountingHandler,), {'calls': 0})
+        server = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        server.register_handler(h.HTTPMethod.GET, "/data", handler)
+        server.register_handler(h.HTTPMethod.PATCH, "/data", self.PATCHOKHandler)
+        server.enable_response_cache()
+        server.set_cache_policy("/data", ttl, vary_headers=vary_headers)
+        server.start_serving_async()
+        host, port = server.server_address
+        return host, port, server, handler
+
+    def test_cache_hit(self):
+        host, port, server, handler = self.start_server()
+        with server:
+            self.assertEqual(self.get(host, port, "/data"), b'1 /data')
+            self.assertEqual(self.get(host, port, "/data"), b'1 /data')
+            self.assertEqual(self.get(host, port, "/data?x=1"), b'2 /data?x=1')
+            self.assertEqual(handler.calls, 2)
+            self.assertEqual(server.response_cache.hits, 1)
+
+    def test_cache_ttl(self):
+        host, port, server, handler = self.start_server(ttl=0.05)
+        with server:
+            self.assertEqual(self.get(host, port, "/data"), b'1 /data')
+            time.sleep(0.1)
+            self.assertEqual(self.get(host, port, "/data"), b'2 /data')
+
+    def test_cache_vary_headers(self):
+        host, port, server, handler = self.start_server(vary_headers=['Accept'])
+        with server:
+            self.get(host, port, "/data", {'Accept': 'text/html'})
+            self.get(host, port, "/data", {'Accept': 'application/json'})
+            self.get(host, port, "/data", {'Accept': 'text/html'})
+            self.assertEqual(handler.calls, 2)
+
+    def test_cache_invalidation(self):
+        host, port, server, handler = self.start_server()
+        with server:
+            self.get(host, port, "/data")
+            self.get(host, port, "/data?x=1")
+            server.invalidate_cache("/data")
+            self.assertEqual(self.get(host, port, "/data"), b'3 /data')
+
+            # A successful PATCH on the path invalidates it as well
+            connection = http.client.HTTPConnection(host, port)
+            connection.request(h.HTTPMethod.PATCH.name, "/data", body=b'{}')
+            connection.getresponse().read()
+            connection.close()
+            self.assertEqual(self.get(host, port, "/data"), b'4 /data')
+
+    def test_probe_writes_invalidate_resource(self):
+        server = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        prober = h.ProbeResource('/cached/vars')
+        prober.add_probe('int_var', util.MutableVariable(1))
+        h.export_probe_resource_to_server(server, prober)
+        server.enable_response_cache()
+        server.set_cache_policy("/probes/cached/vars", 60)
+        server.start_serving_async()
+        host, port = server.server_address
+        with server:
+            json_headers = {'Accept': 'application/json'}
+            self.assertEqual(json.loads(self.get(host, port, "/probes/cached/vars",
+                                                 json_headers)), {'int_var': 1})
+            # Writes through the single probe and the bulk PATCH handlers
+            for path, body, value in (
+                    ("/probes/cached/vars/int_var", b'2', 2),
+                    ("/probes", b'{"cached/vars": {"values": {"int_var": 3}}}', 3)):
+                response, _ = send_request(host, port, h.HTTPMethod.PATCH, path, body,
+                                           {'Content-Type': 'application/json'})
+                self.assertEqual(response.status, http.HTTPStatus.OK)
+                self.assertEqual(json.loads(self.get(host, port, "/probes/cached/vars",
+                                                     json_headers)), {'int_var': value})
+
+    def test_probe_export_and_removal_invalidate(self):
+        server = h.MultiHandlerSingleThreadHTTPServer(log_requests=False)
+        prober = h.ProbeResource('/vars')
+        prober.add_probe('x', util.MutableVariable(1))
+        h.export_probe_resource_to_server(server, prober)
+        server.enable_response_cache()
+        server.set_cache_policy("/probes", 60)
+        server.set_cache_policy("/probes/", 60)
+        server.start_serving_async()
+        host, port = server.server_address
+        with server:
+            def get_paths():
+                content = json.loads(self.get(host, port, "/probes"))
+                return [resource['path'] for resource in content['resources']]
+
+            self.assertEqual(get_paths(), ['vars'])
+            self.assertEqual(self.get(host, port, "/probes/vars/x"), b'1')
+            h.export_probe_resource_to_server(server, h.ProbeResource('/other'))
+            self.assertEqual(get_paths(), ['other', 'vars'])
+            h.remove_probe_resource(server, prober)
+            self.assertEqual(get_paths(), ['other'])
+            self.assertIn(b'error', self.get(host, port, "/probes/vars/x"))
+
+    def test_replayed_date_header(self):
+        host, port, server, handler = self.start_server()
+        with server:
+            server.response_cache.put(('GET', '/data'), '/data',
+                                      b'HTTP/1.1 200 OK\r\n'
+                                      b'Date: Mon, 01 Jan 2001 00:00:00 GMT\r\n'
+                                      b'Content-Length: 3\r\n\r\nold', ttl=60)
+            connection = http.client.HTTPConnection(host, port)
+            connection.request(h.HTTPMethod.GET.name, "/data")
+            response = connection.getresponse()
+            self.assertEqual(response.read(), b'old')
+            self.assertNotIn('2001', response.getheader('Date'))
+            connection.close()
+            self.assertEqual(handler.calls, 0)
+
+    def test_invalidate_tree(self):
+        cache = h.HTTPResponseCache()
+        for path in ('/', '/a', '/a/b', '/a/b/c', '/ab', '/x'):
+            cache.put(path, path, b'1', ttl=60)
+        cache.invalidate_tree('/a/b')
+        self.assertEqual(sorted(key for key in ('/', '/a', '/a/b', '/a/b/c', '/ab', '/x')
+                                if cache.get(key) is not None), ['/ab', '/x'])
+
+    def test_lru_eviction(self):
+        cache = h.HTTPResponseCache(max_bytes=10)
+        cache.put('a', '/a', b'12345', ttl=60)
+        cache.put('b', '/b', b'12345', ttl=60)
+        self.assertEqual(cache.get('a'), b'12345')
+        cache.put('c', '/c', b'12345', ttl=60)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'12345')
+        self.assertEqual(cache.size, 10)
+        self.assertFalse(cache.put('d', '/d', b'x' * 11, ttl=60))
+        generation = cache.generation
+        cache.invalidate('/x')
+        self.assertFalse(cache.put('e', '/e', b'1', ttl=60, generation=generation))
+        self.assertTrue(cache.put('e', '/e', b'1', ttl=60, generation=cache.generation))
+        cache.invalidate_prefix('/')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+class TestProfiling(ProbeServerTestCase):
+    server_class = h.MultiHandlerThreadingHTTPServer
+
+    def setUp(self):
+        super().setUp()
+        h.register_profiling_handlers(self.server)
+        self.stop = threading.Event()
+        self.worker = threading.Thread(target=busy_loop, args=(self.stop,),
+                                       name='BusyWorker')
+        self.worker.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.worker.join()
+        super().tearDown()
+
+    def get(self, path):
+        response, content = self.request(h.HTTPMethod.GET, path)
+        return response, content.decode('utf-8')
+
+    def test_cpu_profile(self):
+        response, content = self.get('/debug/profile/cpu?seconds=0.2&interval=5')
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        lines = content.splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+        busy = [line for line in lines if line.startswith('BusyWorker;')]
+        self.assertTrue(any('busy_loop (test_http.py:' in line for line in busy))
+
+        for query in ('seconds=x', 'seconds=nan', 'seconds=inf', 'interval=nan'):
+            response, _ = self.get('/debug/profile/cpu?' + query)
+            self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+        response, _ = self.get('/debug/profile/allocations?seconds=nan')
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+        # The rejected requests did not keep the profiler busy
+        response, _ = self.get('/debug/profile/cpu?seconds=0.1')
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+
+    def test_allocation_profile(self):
+        # Allocations made while tracing, which outlive the profile, so the
+        # top sites do not depend on what other threads allocate meanwhile
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        retained = [bytearray(1024) for _ in range(100)]
+        response, content = self.get(
+            '/debug/profile/allocations?seconds=0.1&limit=5&group_by=filename')
+        self.assertEqual(response.status, http.HTTPStatus.OK)
+        result = json.loads(content)
+        self.assertLessEqual(len(result['top']), 5)
+        self.assertTrue(result['top'])
+        self.assertIn('size_bytes', result['top'][0])
+        self.assertIn('size_diff_bytes', result['diff'][0])
+        # The tracing started here is left running
+        self.assertTrue(tracemalloc.is_tracing())
+        del retained
+
+        response, _ = self.get('/debug/profile/allocations?group_by=module')
+        self.assertEqual(response.status, http.HTTPStatus.BAD_REQUEST)
+
+    def test_one_profile_at_a_time(self):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.get('/debug/profile/cpu?seconds=1')[0].status))
+        thread.start()
+        time.sleep(0.3)
+        response, _ = self.get('/debug/profile/allocations?seconds=0')
+        self.assertEqual(response.status, http.HTTPStatus.CONFLICT)
+        thread.join()
+        self.assertEqual(results, [http.HTTPStatus.OK])
+
+        h.deregister_profiling_handlers(self.server)
+        self.assertIsNone(self.server.handler_registry.get_request_handler(
+            h.HTTPMethod.GET, '/debug/profile/cpu'))
+
+
+class TestLoadTest(unittest.TestCase):
+    class GETStatusOKHandler(h.StatelessHTTPHandler):
+        def handle(self):
+            self._request_handler.send_response(http.HTTPStatus.OK)
+            self._request_handler.send_header('Content-Length', 2)
+            self._request_handler.end_headers()
+            self._request_handler.wfile.write(b'ok')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 0.5), 50)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile(values, 0.999), 100)
+        self.assertIsNone(loadtest.percentile([], 0.5))
+
+    def test_run_load_test(self):
+        with h.MultiHandlerThreadingHTTPServer(log_requests=False) as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            server.start_serving_async()
+
+            result = loadtest.run_load_test(host, port, path="/", concurrency=3,
+                                            requests=31, keep_alive=False)
+            summary = result.to_dict()
+            self.assertEqual(summary['requests'], 31)
+            self.assertEqual(summary['errors'], 0)
+            self.assertEqual(summary['status_counts'], {'200': 31})
+            self.assertEqual(summary['bytes_received'], 62)
+            self.assertEqual(result.connections_opened, 31)
+            self.assertLessEqual(summary['latency_seconds']['p50'],
+                                 summary['latency_seconds']['p999'])
+            self.assertGreater(summary['throughput_rps'], 0)
+
+    def test_run_load_test_keep_alive(self):
+        with h.MultiHandlerThreadingHTTPServer(log_requests=False) as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            server.start_serving_async()
+
+            result = loadtest.run_load_test(host, port, path="/", concurrency=2,
+                                            requests=20, keep_alive=True)
+            self.assertEqual(result.status_counts, {200: 20})
+            self.assertEqual(result.connections_opened, 2)
+
+        # The single-threaded server closes connections unless told otherwise
+        with h.MultiHandlerSingleThreadHTTPServer(log_requests=False) as server:
+            host, port = server.server_address
+            server.register_handler(h.HTTPMethod.GET, "/", self.GETStatusOKHandler)
+            server.start_serving_async()
+
+            result = loadtest.run_load_test(host, port, path="/", requests=5,
+                                            keep_alive=True)
+            self.assertEqual(result.connections_opened, 5)
+
+    def test_run_load_test_errors(self):
+        with h.MultiHandlerSingleThreadHTTPServer(log_requests=False) as server:
+            host, port = server.server_address
+            server.start_serving_async()
+
+            # Requests without a handler are closed without a response
+            result = loadtest.run_load_test(host, port, path="/", requests=5)
+            self.assertEqual(result.requests, 5)
+            self.assertEqual(result.errors, 5)
+            self.assertEqual(result.error_rate, 1.0)
+
+    def test_run_load_test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            loadtest.run_load_test('127.0.0.1', 1, requests=10, duration=1)
+        with self.assertRaises(ValueError):
+            loadtest.run_load_test('127.0.0.1', 1, concurrency=0, requests=10)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,46 @@
+import subprocess
+import sys
+import unittest
+
+# Import times are checked by benchmarks/import_benchmark.py, as timings are
+# not reliable on shared test machines
+PACKAGES = ('omnilib', 'omnilib.util', 'omnilib.compute', 'omnilib.http')
+
+
+def run_python(code):
+    process = subprocess.run([sys.executable, '-c', code],
+                             stdout=subprocess.PIPE, universal_newlines=True,
+                             check=True)
+    return process.stdout.strip()
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_lazy_modules(self):
+        for package in PACKAGES:
+            with self.subTest(package=package):
+                output = run_python(
+                    'import sys\n'
+                    'import {}\n'
+                    'print([name for name in ("jsonpickle", "numpy", "mako") '
+                    'if name in sys.modules])'.format(package))
+                self.assertEqual(output, '[]')
+
+    def test_first_use(self):
+        output = run_python(
+            'import sys\n'
+            'from omnilib import http, util\n'
+            'prober = http.ProbeResource("lazy")\n'
+            'prober.add_probe("var", util.MutableVariable(1))\n'
+            'print(prober.get_encoded_probe_values())\n'
+            'print("jsonpickle" in sys.modules, "mako" in sys.modules)')
+        encoded, imported = output.splitlines()
+        self.assertIn('"_value": 1', encoded)
+        self.assertEqual(imported, 'True False')
+
+    def test_init_preload(self):
+        output = run_python(
+            'import sys, omnilib\n'
+            'omnilib.init(preload=True)\n'
+            'print(all(name in sys.modules for name in '
+            '("jsonpickle", "numpy", "mako")))')
+        self.assertEqual(output, 'True')
@@ -1,3 +1,5 @@
+import pickle
+import threading
 import unittest
 
 from omnilib import util
@@ -68,6 +70,140 @@ class TestMutableVariable(unittest.TestCase):
         for i in range(len(var)):
             self.assertEqual(test_list[i], var[i])
 
+    def test_subscribe(self):
+        var = util.MutableVariable(1)
+        changes = []
+        callback = lambda v: changes.append(v.get_value())
+        var.subscribe(callback)
+        var.set_value(2)
+        var.set_value(3)
+        var.unsubscribe(callback)
+        var.set_value(4)
+        self.assertEqual(changes, [2, 3])
+
+    def test_pickle_without_subscribers(self):
+        var = util.MutableVariable([1, 2])
+        var.subscribe(lambda v: None)
+        copy = pickle.loads(pickle.dumps(var))
+        self.assertEqual(copy.get_value(), [1, 2])
+        copy.set_value(3)
+
+
+class TestVersionedMutableVariable(unittest.TestCase):
+    def test_versions(self):
+        var = util.VersionedMutableVariable(1)
+        self.assertEqual(var.get_versioned_value(), (0, 1))
+        var.set_value(2)
+        self.assertEqual(var.get_versioned_value(), (1, 2))
+        self.assertEqual(var.get_value(), 2)
+        self.assertEqual(var, 2)
+
+    def test_compare_and_set(self):
+        var = util.VersionedMutableVariable('a')
+        self.assertTrue(var.compare_and_set(0, 'b'))
+        self.assertFalse(var.compare_and_set(0, 'c'))
+        self.assertEqual(var.get_versioned_value(), (1, 'b'))
+
+    def test_update_and_increment(self):
+        var = util.VersionedMutableVariable(0)
+        changes = []
+        var.subscribe(lambda v: changes.append(v.get_value()))
+        self.assertEqual(var.update(lambda value: value + 10), 10)
+        self.assertEqual(var.increment(), 11)
+        self.assertEqual(var.increment(-2), 9)
+        self.assertEqual(changes, [10, 11, 9])
+        self.assertEqual(var.get_version(), 3)
+
+    def test_concurrent_increments(self):
+        var = util.VersionedMutableVariable(0)
+
+        def run():
+            for _ in range(1000):
+                var.increment()
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(var.get_versioned_value(), (4000, 4000))
+
+    def test_wait_for_change(self):
+        var = util.VersionedMutableVariable(1)
+        self.assertEqual(var.wait_for_change(0, timeout=0.01), (0, 1))
+        timer = threading.Timer(0.05, var.set_value, args=(2,))
+        timer.start()
+        self.assertEqual(var.wait_for_change(0, timeout=5), (1, 2))
+        timer.join()
+
+    def test_pickle(self):
+        var = util.VersionedMutableVariable([1, 2])
+        var.set_value([3])
+        copy = pickle.loads(pickle.dumps(var))
+        self.assertEqual(copy.get_versioned_value(), (0, [3]))
+        copy.increment([4])
+        self.assertEqual(copy.get_versioned_value(), (1, [3, 4]))
+
+
+class TestProbeBlock(unittest.TestCase):
+    def test_values(self):
+        block = util.ProbeBlock('int32', ['a', 'b', 'c'])
+        self.assertEqual(block.get_value(), {'a': 0, 'b': 0, 'c': 0})
+        block.set_value({'b': 2})
+        block['c'] = 3
+        self.assertEqual(block.tolist(), [0, 2, 3])
+        self.assertEqual(block['b'], 2)
+        self.assertIn('a', block)
+        block.set_value([4, 5, 6])
+        self.assertEqual(block.get_value(), {'a': 4, 'b': 5, 'c': 6})
+        self.assertEqual(len(block.tobytes()), 3 * 4)
+
+    def test_invalid_values(self):
+        with self.assertRaises(ValueError):
+            util.ProbeBlock('object', ['a'])
+        with self.assertRaises(ValueError):
+            util.ProbeBlock('int8', ['a', 'a'])
+        block = util.ProbeBlock('int8', ['a', 'b'], [1, 2])
+        with self.assertRaises(ValueError):
+            block.set_value({'a': 3, 'c': 4})
+        with self.assertRaises(ValueError):
+            block.set_value([1, 2, 3])
+        with self.assertRaises(TypeError):
+            block.set_value({'a': 3, 'b': 'x'})
+        self.assertEqual(block.tolist(), [1, 2])
+
+    def test_slots(self):
+        block = util.ProbeBlock('float64', ['a', 'b'])
+        changes = []
+        block.subscribe(lambda v: changes.append(v.tolist()))
+        slot = block.slot('b')
+        slot.set_value(1.5)
+        self.assertEqual(slot.get_value(), 1.5)
+        block.buffer[0] = 2.5
+        self.assertEqual(changes, [[0.0, 1.5]])
+        block.notify()
+        self.assertEqual(changes, [[0.0, 1.5], [2.5, 1.5]])
+        with self.assertRaises(AttributeError):
+            slot.other = 1
+
+    def test_mapping_protocol(self):
+        block = util.ProbeBlock('int16', ['a', 'b'], [1, 2])
+        self.assertEqual(list(block), ['a', 'b'])
+        self.assertEqual(list(reversed(block)), ['b', 'a'])
+        self.assertEqual(len(block), 2)
+        self.assertEqual({label: block[label] for label in block}, {'a': 1, 'b': 2})
+        self.assertEqual(block, {'a': 1, 'b': 2})
+        self.assertEqual(block, util.ProbeBlock('int64', ['a', 'b'], [1, 2]))
+        self.assertNotEqual(block, [1, 2])
+        with self.assertRaises(TypeError):
+            block < {'a': 2}
+
+    def test_pickle(self):
+        block = util.ProbeBlock('uint16', ['a', 'b'], [1, 2])
+        copy = pickle.loads(pickle.dumps(block))
+        self.assertEqual(copy.get_value(), {'a': 1, 'b': 2})
+        copy.set('a', 3)
+        self.assertEqual(block.get('a'), 1)
+
 
 class TestSingleton(unittest.TestCase):
     def test_object(self):